@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Callable
+from fastapi.testclient import TestClient
+from offgrid_api import app, result_cache
+from OffGridDB import OffGridDB, ConnectionPool, MemoryReplica, AsyncOffGridDB
+
+BENCH_DIR = "bench_data"
+RESULTS_FILE = "offgrid_bench_results.json"
+DEFAULT_SIZES = [10, 1000, 100000]
+DEFAULT_REPEAT = 20
+REGRESSION_THRESHOLD = 0.25  # Flag metrics more than 25% worse than the baseline
+ITEMS_PER_LEVEL = 100000
+FULL_RESULT_MAX_ITEMS = 1000000  # Unpaginated /query/fixed and /report bodies grow with the catalog
+LOAD_MODES = {"insert": {}, "bulk": {"bulk": True}, "stream": {"stream": True}}
+
+MONTHLY_NAMES = ["food", "propane", "gas", "Starlink Residential Premium", "maintenance", "water", "insurance"]
+FIXED_CATALOG = [
+    ("LiFePO4 Battery 100Ah", "battery", "Renogy", 300, 900),
+    ("Monocrystalline Solar Panel 200W", "panel", "Renogy", 150, 400),
+    ("Pure Sine Inverter 3000W", "unit", "Victron", 600, 1500),
+    ("MPPT Charge Controller", "unit", "Victron", 150, 700),
+    ("Starlink Standard Kit", "unit", "Starlink", 350, 600),
+    ("Water Filtration System", "unit", "Berkey", 200, 450),
+    ("Composting Toilet", "unit", "Nature's Head", 900, 1100),
+    ("Propane Heater", "unit", "Mr. Heater", 100, 300),
+    ("Rainwater Tank 500gal", "tank", "Norwesco", 400, 800),
+    ("Wood Stove", "unit", "Cubic Mini", 500, 1200),
+]
+
+
+def catalog_path(items: int, seed: int = 0) -> str:
+    """Path of the generated catalog for `items` cost items."""
+    return os.path.join(BENCH_DIR, f"catalog_{items}_{seed}.json")
+
+
+def write_catalog(path: str, items: int, seed: int = 0) -> Dict[str, int]:
+    """Write a deterministic costdata.json-shaped catalog with `items` cost items.
+
+    Levels hold up to ITEMS_PER_LEVEL items each: a few monthly costs and the
+    rest fixed costs. The file is written item by item, so 10M-item catalogs
+    never sit in memory. Returns the level/monthly/fixed counts.
+    """
+    rng = random.Random(seed)
+    levels = max(1, -(-items // ITEMS_PER_LEVEL))
+    counts = {"levels": levels, "monthly_costs": 0, "fixed_costs": 0}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        f.write('{\n  "levels": [\n')
+        for level in range(1, levels + 1):
+            level_items = items // levels + (1 if level <= items % levels else 0)
+            monthly = [{"name": name, "amount": rng.randint(10, 600)}
+                       for name in MONTHLY_NAMES[:max(1, min(len(MONTHLY_NAMES), level_items // 2))]]
+            header = {"level": level, "name": f"Benchmark Level {level}",
+                      "description": f"Synthetic level {level} with {level_items} items (seed {seed})."}
+            f.write("    " + json.dumps(header)[:-1] + ', "monthly_costs": ' + json.dumps(monthly) + ', "fixed_costs": [')
+            total_fixed = 0
+            for i in range(level_items - len(monthly)):
+                name, unit_type, seller, low, high = FIXED_CATALOG[rng.randrange(len(FIXED_CATALOG))]
+                units = rng.randint(1, 4)
+                unit_cost = rng.randint(low, high)
+                total_fixed += units * unit_cost
+                item = {"name": f"{name} #{i}", "units": units, "unit_type": unit_type, "unit_cost": unit_cost,
+                        "total": units * unit_cost, "seller_source": seller}
+                f.write(("," if i else "") + "\n      " + json.dumps(item))
+            f.write(f'\n    ], "total_monthly": {sum(m["amount"] for m in monthly)}, "total_fixed": {total_fixed}}}')
+            f.write(",\n" if level < levels else "\n")
+            counts["monthly_costs"] += len(monthly)
+            counts["fixed_costs"] += level_items - len(monthly)
+        f.write("  ]\n}\n")
+    return counts
+
+
+def percentile(samples: List[float], p: float) -> float:
+    """Linear-interpolated percentile of `samples` (p in 0..100)."""
+    ordered = sorted(samples)
+    position = p / 100 * (len(ordered) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def _reset_peak_rss() -> bool:
+    """Reset the process high-water RSS mark (Linux only); False when unsupported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss() -> Optional[int]:
+    """Peak RSS in bytes since the last reset, from /proc/self/status."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def measure(fn: Callable[[], int], repeat: int, before: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+    """Run `fn` (returning the rows it handled) `repeat` times and summarise.
+
+    `before` runs untimed ahead of every call (e.g. to drop caches). Peak
+    memory is the process RSS high-water mark where the platform can reset
+    it, otherwise the tracemalloc peak of one extra run.
+    """
+    rss = _reset_peak_rss()
+    latencies, rows = [], 0
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        rows = fn()
+        latencies.append(time.perf_counter() - start)
+    if rss:
+        peak = _peak_rss()
+    else:
+        if before:
+            before()
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    mean = sum(latencies) / len(latencies)
+    return {
+        "runs": repeat,
+        "rows": rows,
+        "mean": round(mean, 6),
+        "p50": round(percentile(latencies, 50), 6),
+        "p95": round(percentile(latencies, 95), 6),
+        "p99": round(percentile(latencies, 99), 6),
+        "max": round(max(latencies), 6),
+        "rows_per_sec": round(rows / mean) if mean > 0 else rows,
+        "peak_memory_bytes": peak,
+    }
+
+
+def _release_handles():
+    """Drop every pooled handle so a database file can be replaced."""
+    AsyncOffGridDB.close_all()
+    MemoryReplica.close_all()
+    ConnectionPool.close_all()
+
+
+def _remove_db(db_path: str):
+    _release_handles()
+    for path in (db_path, db_path + "-wal", db_path + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def bench_load(json_path: str, db_path: str, items: int, modes: List[str], repeat: int) -> Dict[str, Any]:
+    """Time OffGridDB.load_json in each mode into a fresh database."""
+    results = {}
+    for mode in modes:
+        def load() -> int:
+            with OffGridDB(db_path) as db:
+                return db.load_json(json_path, drop_if_exists=True, **LOAD_MODES[mode])["rows"]
+        results[f"load_{mode}"] = measure(load, repeat, before=lambda: _remove_db(db_path))
+    return results
+
+
+def api_variants(items: int, db_path: str) -> Dict[str, str]:
+    """The /query/{query_type} and /report requests timed for a catalog of `items` items."""
+    db = f"db={db_path}"
+    report_path = os.path.join(BENCH_DIR, "bench_report.md")
+    variants = {
+        "query_levels": f"/query/levels?{db}",
+        "query_monthly": f"/query/monthly?{db}",
+        "query_monthly_level": f"/query/monthly?{db}&level=1",
+        "query_fixed_level": f"/query/fixed?{db}&level=1",
+        "query_fixed_page": f"/query/fixed?{db}&after={items // 2}&limit=1000",
+        "query_fixed_level_page": f"/query/fixed?{db}&level=1&after={items // 4}&limit=1000",
+        "query_fixed_level_stream": f"/query/fixed?{db}&level=1&stream=true",
+        "report_level": f"/report?{db}&level=1&output={report_path}",
+        "report_level_stream": f"/report?{db}&level=1&stream=true&output={report_path}",
+    }
+    if items <= FULL_RESULT_MAX_ITEMS:
+        variants["query_fixed"] = f"/query/fixed?{db}"
+        variants["query_fixed_stream"] = f"/query/fixed?{db}&stream=true"
+        variants["report"] = f"/report?{db}&output={report_path}"
+    return variants
+
+
+def _response_rows(response) -> int:
+    """Rows in a /query or /report response (lines for NDJSON and Markdown)."""
+    if response.status_code != 200:
+        raise Exception(f"{response.request.url} failed with {response.status_code}: {response.text[:200]}")
+    media_type = response.headers.get("content-type", "")
+    if "ndjson" in media_type or "markdown" in media_type:
+        return response.content.count(b"\n")
+    body = response.json()
+    return len(body) if isinstance(body, list) else body["report"].count("\n")
+
+
+def bench_api(client: TestClient, db_path: str, items: int, repeat: int) -> Dict[str, Any]:
+    """Time each API variant through the TestClient, uncached and (for one variant) cached."""
+    results = {}
+    for name, url in api_variants(items, db_path).items():
+        results[name] = measure(lambda: _response_rows(client.get(url)), repeat, before=result_cache.clear)
+    url = f"/query/fixed?{'db=' + db_path}&level=1"
+    client.get(url)
+    results["query_fixed_level_cached"] = measure(lambda: _response_rows(client.get(url)), repeat)
+    return results
+
+
+def run(sizes: List[int], repeat: int, load_repeat: int, modes: List[str], seed: int = 0) -> Dict[str, Any]:
+    """Generate catalogs, run every benchmark and return the results document."""
+    benchmarks: Dict[str, Dict[str, Any]] = {}
+    db_path = os.path.join(BENCH_DIR, "bench.db")
+    client = TestClient(app)
+    for items in sizes:
+        json_path = catalog_path(items, seed)
+        if not os.path.exists(json_path):
+            print(f"Generating {items} items -> {json_path}")
+            write_catalog(json_path, items, seed)
+        print(f"Benchmarking {items} items")
+        for name, result in bench_load(json_path, db_path, items, modes, load_repeat).items():
+            benchmarks[f"{items}/{name}"] = result
+        # Query the catalog as the bulk loader leaves it
+        with OffGridDB(db_path) as db:
+            db.load_json(json_path, drop_if_exists=True, bulk=True)
+        for name, result in bench_api(client, db_path, items, repeat).items():
+            benchmarks[f"{items}/{name}"] = result
+        _remove_db(db_path)
+    return {
+        "generated": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "seed": seed,
+        "benchmarks": benchmarks,
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float = REGRESSION_THRESHOLD) -> List[Dict[str, Any]]:
+    """Return the metrics of `results` more than `threshold` worse than `baseline`.
+
+    Latency (p50, p95) and peak memory regress when they grow; throughput
+    when it drops. Benchmarks missing from either side are skipped.
+    """
+    regressions = []
+    for name, current in results["benchmarks"].items():
+        previous = baseline.get("benchmarks", {}).get(name)
+        if previous is None:
+            continue
+        for metric, higher_is_worse in (("p50", True), ("p95", True), ("peak_memory_bytes", True), ("rows_per_sec", False)):
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old if higher_is_worse else (old - new) / old
+            if change > threshold:
+                regressions.append({"benchmark": name, "metric": metric, "baseline": old, "current": new,
+                                    "change": round(change, 4)})
+    return regressions
+
+
+def print_summary(results: Dict[str, Any]):
+    print(f"{'benchmark':<40} {'rows':>10} {'p50 ms':>10} {'p95 ms':>10} {'rows/sec':>12} {'peak MiB':>10}")
+    for name, r in results["benchmarks"].items():
+        peak = f"{r['peak_memory_bytes'] / 1048576:.1f}" if r["peak_memory_bytes"] else "-"
+        print(f"{name:<40} {r['rows']:>10} {r['p50'] * 1000:>10.2f} {r['p95'] * 1000:>10.2f} {r['rows_per_sec']:>12} {peak:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark OffGridDB loads, /query and /report on synthetic catalogs.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Catalog sizes in cost items (10 to 10000000)")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Timed runs per API variant")
+    parser.add_argument("--load-repeat", type=int, default=3, help="Timed runs per load mode")
+    parser.add_argument("--load-modes", nargs="+", choices=list(LOAD_MODES), default=list(LOAD_MODES))
+    parser.add_argument("--seed", type=int, default=0, help="Catalog generator seed")
+    parser.add_argument("--output", default=RESULTS_FILE, help="Where to write the JSON results")
+    parser.add_argument("--compare", metavar="BASELINE", help="Flag regressions against a saved results file")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="Allowed relative slowdown (default: 0.25)")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat, args.load_repeat, args.load_modes, args.seed)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_summary(results)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['benchmark']} {r['metric']}: {r['baseline']} -> {r['current']} ({r['change']:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
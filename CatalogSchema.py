@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import threading
+from typing import List, Dict, Any, Optional, Tuple, Callable
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_scehma_2025-05-28.sch")
+MAX_REPORTED_ERRORS = 1000
+# Fields whose type is narrower than the example values suggest
+INTEGER_FIELDS = {"level"}
+# Used when the schema file is missing
+BUILTIN_SCHEMA = {
+    "type": "object",
+    "required": ["levels"],
+    "properties": {
+        "levels": {"type": "array", "items": {
+            "type": "object",
+            "required": ["level", "name", "description", "monthly_costs", "fixed_costs", "total_monthly", "total_fixed"],
+            "properties": {
+                "level": {"type": "integer"},
+                "name": {"type": "string"},
+                "description": {"type": "string"},
+                "monthly_costs": {"type": "array", "items": {
+                    "type": "object",
+                    "required": ["name", "amount"],
+                    "properties": {"name": {"type": "string"}, "amount": {"type": "number"}},
+                }},
+                "fixed_costs": {"type": "array", "items": {
+                    "type": "object",
+                    "required": ["name", "units", "unit_type", "unit_cost", "total", "seller_source"],
+                    "properties": {
+                        "name": {"type": "string"}, "units": {"type": "number"}, "unit_type": {"type": "string"},
+                        "unit_cost": {"type": "number"}, "total": {"type": "number"}, "seller_source": {"type": "string"},
+                    },
+                }},
+                "total_monthly": {"type": "number"},
+                "total_fixed": {"type": "number"},
+            },
+        }},
+    },
+}
+
+# type(value) checks per JSON Schema type; bool is deliberately not a number
+_TYPE_TESTS = {
+    "object": "type(v) is dict",
+    "array": "type(v) is list",
+    "string": "type(v) is str",
+    "integer": "type(v) is int",
+    "number": "(type(v) is int or type(v) is float)",
+    "boolean": "type(v) is bool",
+    "null": "v is None",
+}
+_JSON_TYPE_NAMES = {dict: "object", list: "array", str: "string", int: "integer", float: "number", bool: "boolean", type(None): "null"}
+
+
+class SchemaValidationError(Exception):
+    """Raised with every schema violation found in a catalog, each as (JSON path, message)."""
+
+    def __init__(self, errors: List[Tuple[str, str]], total: Optional[int] = None):
+        self.errors = errors
+        self.total = total if total is not None else len(errors)
+        shown = "; ".join(f"{path}: {message}" for path, message in errors[:5])
+        more = f" (and {self.total - 5} more)" if self.total > 5 else ""
+        super().__init__(f"Invalid JSON schema: {self.total} error{'s' if self.total != 1 else ''}: {shown}{more}")
+
+
+class ErrorList(list):
+    """(path, message) list that stops storing after `limit` entries but keeps counting."""
+
+    def __init__(self, limit: int = MAX_REPORTED_ERRORS):
+        super().__init__()
+        self.limit = limit
+        self.total = 0
+
+    def append(self, error: Tuple[str, str]):
+        self.total += 1
+        if len(self) < self.limit:
+            super().append(error)
+
+    def raise_if_any(self):
+        if self.total:
+            raise SchemaValidationError(list(self), self.total)
+
+
+def infer_schema(example: Any) -> Dict[str, Any]:
+    """Derive a JSON Schema from an example document.
+
+    Object keys present in every example become required; numbers are typed
+    "number" (examples rarely show fractional prices) except INTEGER_FIELDS.
+    Keys starting with '$' are annotations and ignored.
+    """
+    return _infer([example])
+
+
+def _infer(values: List[Any], name: str = "") -> Dict[str, Any]:
+    types = {_JSON_TYPE_NAMES[type(value)] for value in values}
+    if types <= {"integer", "number"}:
+        return {"type": "integer" if name in INTEGER_FIELDS else "number"}
+    if types == {"object"}:
+        keys: Dict[str, List[Any]] = {}
+        for value in values:
+            for key, item in value.items():
+                if not key.startswith("$"):
+                    keys.setdefault(key, []).append(item)
+        return {
+            "type": "object",
+            "required": [key for key, items in keys.items() if len(items) == len(values)],
+            "properties": {key: _infer(items, key) for key, items in keys.items()},
+        }
+    if types == {"array"}:
+        items = [item for value in values for item in value]
+        return {"type": "array", "items": _infer(items) if items else {}}
+    if len(types) == 1:
+        return {"type": types.pop()}
+    return {}
+
+
+def _compile_object(schema: Dict[str, Any], name: str) -> Callable:
+    """Generate and compile `check(obj, parent, index, errors) -> bool` for one object schema.
+
+    The JSON path of a failing value is only formatted on error, so valid
+    items cost one dict lookup and one type test per field.
+    """
+    lines = [
+        f"def {name}(obj, parent, index, errors):",
+        "    if type(obj) is not dict:",
+        "        errors.append((f'{parent}[{index}]' if index is not None else parent, 'expected an object'))",
+        "        return False",
+        "    ok = True",
+    ]
+    required = set(schema.get("required", []))
+    for key, spec in schema.get("properties", {}).items():
+        path = f"(f'{{parent}}[{{index}}]' if index is not None else parent) + {repr('.' + key)}"
+        lines.append(f"    v = obj.get({key!r}, _MISSING)")
+        if key in required:
+            lines += [
+                "    if v is _MISSING:",
+                f"        errors.append(({path}, 'missing required field')); ok = False",
+            ]
+        else:
+            lines.append("    if v is _MISSING: pass")
+        test = _TYPE_TESTS.get(spec.get("type", ""))
+        if test:
+            lines += [
+                f"    elif not {test}:",
+                f"        errors.append(({path}, 'expected {spec['type']}, got ' + _type_name(v))); ok = False",
+            ]
+    lines.append("    return ok")
+    namespace = {"_MISSING": object(), "_type_name": lambda v: _JSON_TYPE_NAMES.get(type(v), type(v).__name__)}
+    exec(compile("\n".join(lines), f"<schema:{name}>", "exec"), namespace)
+    return namespace[name]
+
+
+class CatalogValidator:
+    """Catalog checker compiled once from a schema file.
+
+    The schema file may be a JSON Schema (type/properties/required/items) or,
+    like data_scehma_2025-05-28.sch, an example catalog whose shape is
+    inferred. check_root/check_level/check_monthly/check_fixed validate one
+    node each and append (JSON path, message) errors instead of raising, so
+    the bulk, stream and delta loaders can report every bad row in one pass.
+    """
+
+    _cache: Dict[Tuple[str, float], "CatalogValidator"] = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, schema: Dict[str, Any]):
+        """Compile the root, level, monthly cost and fixed cost checkers."""
+        self.schema = schema
+        level = schema.get("properties", {}).get("levels", {}).get("items", {})
+        level_properties = level.get("properties", {})
+        self.check_root = _compile_object(schema, "check_root")
+        self.check_level = _compile_object(level, "check_level")
+        self.check_monthly = _compile_object(level_properties.get("monthly_costs", {}).get("items", {}), "check_monthly")
+        self.check_fixed = _compile_object(level_properties.get("fixed_costs", {}).get("items", {}), "check_fixed")
+
+    @classmethod
+    def from_file(cls, path: str = SCHEMA_FILE) -> "CatalogValidator":
+        """Return the validator for a schema file, compiling it once per file version."""
+        try:
+            key = (os.path.abspath(path), os.path.getmtime(path))
+        except OSError:
+            logging.getLogger(__name__).warning(f"Schema file {path} not found; using the built-in schema")
+            key = ("<builtin>", 0)
+        with cls._cache_lock:
+            validator = cls._cache.get(key)
+            if validator is None:
+                if key[0] == "<builtin>":
+                    schema = BUILTIN_SCHEMA
+                else:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        document = json.load(f)
+                    schema = document if "properties" in document or "type" in document else infer_schema(document)
+                validator = cls(schema)
+                cls._cache[key] = validator
+            return validator
+
+    def level_items(self, level: Dict[str, Any], path: str, errors: List) -> Dict[str, List[Dict[str, Any]]]:
+        """Check a parsed level's cost items; returns the valid ones per cost list."""
+        valid = {}
+        for key, check in (("monthly_costs", self.check_monthly), ("fixed_costs", self.check_fixed)):
+            items = level.get(key)
+            if type(items) is not list:
+                valid[key] = []
+                continue
+            parent = f"{path}.{key}"
+            valid[key] = [item for index, item in enumerate(items) if check(item, parent, index, errors)]
+        return valid
+
+    def validate(self, data: Any) -> ErrorList:
+        """Check a whole parsed catalog and return every error (capped at MAX_REPORTED_ERRORS stored)."""
+        errors = ErrorList()
+        if not self.check_root(data, "$", None, errors):
+            return errors
+        levels = data.get("levels")
+        if type(levels) is not list:
+            return errors
+        for index, level in enumerate(levels):
+            if self.check_level(level, "$.levels", index, errors) or type(level) is dict:
+                self.level_items(level, f"$.levels[{index}]", errors)
+        return errors
@@ -1,10 +1,84 @@
+import hashlib
+import io
 import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 import pathspec
 
+READ_WORKERS = 8
+# Never worth descending into, whether or not .gitignore lists them
+ALWAYS_SKIPPED = {'.git'}
+CACHE_FILE = '.code_summary_cache.db'
+# A file written this close to its cached mtime could change again within the same mtime tick
+RACY_SECONDS = 2
+
+class SummaryCache:
+    """SQLite manifest of rendered code blocks keyed by scan root and relative path.
+
+    An entry is reused while the file's size and mtime match; its sha256 is
+    the hash of the rendered block (not of the raw file) and only decides
+    whether the stored block needs rewriting.
+    """
+
+    def __init__(self, cache_path, root):
+        self.root = os.path.abspath(root)
+        self.conn = sqlite3.connect(cache_path)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(manifest)")]
+        if columns and 'root' not in columns:
+            self.conn.execute("DROP TABLE manifest")  # written before entries were keyed by root
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest (root TEXT, path TEXT, size INTEGER, mtime_ns INTEGER, "
+            "sha256 TEXT, block TEXT, PRIMARY KEY (root, path))"
+        )
+        self.entries = {path: (size, mtime_ns, sha256) for path, size, mtime_ns, sha256
+                        in self.conn.execute("SELECT path, size, mtime_ns, sha256 FROM manifest WHERE root = ?", (self.root,))}
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, rel_path, st):
+        """Return the cached block if the file's size and mtime are unchanged, else None."""
+        self.seen.add(rel_path)
+        entry = self.entries.get(rel_path)
+        if entry is None or entry[:2] != (st.st_size, st.st_mtime_ns):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.conn.execute("SELECT block FROM manifest WHERE root = ? AND path = ?", (self.root, rel_path)).fetchone()[0]
+
+    def store(self, rel_path, st, block):
+        """Record a freshly rendered block; the stored block is only rewritten if the block's hash changed."""
+        sha256 = hashlib.sha256(block.encode('utf-8', 'surrogatepass')).hexdigest()
+        mtime_ns = st.st_mtime_ns
+        if time.time_ns() - mtime_ns < RACY_SECONDS * 1_000_000_000:
+            mtime_ns = -1  # re-read next time rather than trust a possibly stale mtime
+        entry = self.entries.get(rel_path)
+        if entry is not None and entry[2] == sha256:
+            self.conn.execute("UPDATE manifest SET size = ?, mtime_ns = ? WHERE root = ? AND path = ?",
+                              (st.st_size, mtime_ns, self.root, rel_path))
+        else:
+            self.conn.execute("INSERT OR REPLACE INTO manifest (root, path, size, mtime_ns, sha256, block) VALUES (?, ?, ?, ?, ?, ?)",
+                              (self.root, rel_path, st.st_size, mtime_ns, sha256, block))
+
+    def close(self, complete=True):
+        """Commit; after a complete pass, also drop this root's entries for files that no longer exist."""
+        if complete:
+            self.conn.executemany("DELETE FROM manifest WHERE root = ? AND path = ?",
+                                  [(self.root, path) for path in self.entries if path not in self.seen])
+        self.conn.commit()
+        self.conn.close()
+
 class CodeEnumerator:
-    def __init__(self, root_dir, additional_types=[]):
+    def __init__(self, root_dir, additional_types=[], workers=READ_WORKERS, cache_path=None, output_path=None):
         self.root_dir = root_dir
+        # The summary file is never scanned, so a previous (or half-written) summary cannot end up in its own output
+        self.output_path = os.path.abspath(output_path) if output_path else None
         self.extensions = ['.py'] + additional_types
+        self.workers = workers
+        # A relative cache path lives in the scanned tree, so each root keeps its own manifest
+        self.cache_path = os.path.join(root_dir, cache_path) if cache_path and not os.path.isabs(cache_path) else cache_path
         self.ext_to_lang = {'.py': 'python', '.csv': 'csv', '.json': 'json', '.txt': 'text', '.html': 'html', '.css': 'css', '.md': 'markdown'}
         self.gitignore_spec = self._load_gitignore()
 
@@ -15,26 +89,35 @@ class CodeEnumerator:
                 return pathspec.PathSpec.from_lines('gitwildmatch', f)
         return None
 
-    def _is_ignored(self, path):
+    def _is_ignored(self, path, is_dir=False):
         if self.gitignore_spec is None:
             return False
         rel_path = os.path.relpath(path, self.root_dir)
+        if is_dir:
+            rel_path += '/'  # so directory patterns such as venv/ match the directory itself
         return self.gitignore_spec.match_file(rel_path)
 
+    def _walk(self, dir_path):
+        """Yield relevant files under dir_path (sorted, files before subdirectories), never entering ignored directories."""
+        suffixes = tuple(self.extensions)
+        subdirs = []
+        with os.scandir(dir_path) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in ALWAYS_SKIPPED and not self._is_ignored(entry.path, is_dir=True):
+                        subdirs.append(entry.path)
+                elif (entry.name.endswith(suffixes) and not self._is_ignored(entry.path)
+                      and os.path.abspath(entry.path) != self.output_path):
+                    yield entry.path
+        for subdir in subdirs:
+            yield from self._walk(subdir)
+
     def get_relevant_files(self):
-        files = []
-        for dirpath, _, filenames in os.walk(self.root_dir):
-            if self._is_ignored(dirpath):
-                continue
-            for f in filenames:
-                file_path = os.path.join(dirpath, f)
-                if not self._is_ignored(file_path) and any(f.endswith(ext) for ext in self.extensions):
-                    files.append(file_path)
-        return files
-
-    def build_tree(self):
+        return list(self._walk(self.root_dir))
+
+    def build_tree(self, files=None):
         tree = {}
-        for file_path in self.get_relevant_files():
+        for file_path in (self.get_relevant_files() if files is None else files):
             rel_path = os.path.relpath(file_path, self.root_dir)
             parts = rel_path.split(os.sep)
             current = tree
@@ -51,27 +134,85 @@ class CodeEnumerator:
                 lines.extend(self.print_tree(value, indent + 1))
         return lines
 
+    def _code_block(self, file_path):
+        rel_path = os.path.relpath(file_path, self.root_dir)
+        ext = os.path.splitext(file_path)[1]
+        lang = self.ext_to_lang.get(ext, 'text')
+        with open(file_path, 'r') as f:
+            content = f.read()
+        return f"{rel_path}\n```{lang}\n{content}\n```"
+
+    def iter_code_blocks(self, files=None):
+        """Yield code blocks in file order; a thread pool reads a bounded window of files ahead.
+
+        With a cache_path, files whose size and mtime match the manifest are
+        served from it without being read, and the manifest is updated with
+        new, modified and deleted files.
+        """
+        files = self.get_relevant_files() if files is None else files
+        cache = SummaryCache(self.cache_path, self.root_dir) if self.cache_path else None
+        complete = False
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                pending = deque()
+                for file_path in files:
+                    if cache is None:
+                        pending.append((None, None, pool.submit(self._code_block, file_path)))
+                    else:
+                        rel_path = os.path.relpath(file_path, self.root_dir)
+                        st = os.stat(file_path)
+                        block = cache.lookup(rel_path, st)
+                        pending.append((rel_path, st, block if block is not None else pool.submit(self._code_block, file_path)))
+                    if len(pending) >= 2 * self.workers:
+                        yield self._finish_block(cache, *pending.popleft())
+                while pending:
+                    yield self._finish_block(cache, *pending.popleft())
+            complete = True
+        finally:
+            if cache is not None:
+                cache.close(complete)
+
+    @staticmethod
+    def _finish_block(cache, rel_path, st, block):
+        if isinstance(block, Future):
+            block = block.result()
+            if cache is not None:
+                cache.store(rel_path, st, block)
+        return block
+
     def get_code_blocks(self):
-        blocks = []
-        for file_path in self.get_relevant_files():
-            rel_path = os.path.relpath(file_path, self.root_dir)
-            ext = os.path.splitext(file_path)[1]
-            lang = self.ext_to_lang.get(ext, 'text')
-            with open(file_path, 'r') as f:
-                content = f.read()
-            blocks.append(f"{rel_path}\n```{lang}\n{content}\n```")
-        return blocks
+        return list(self.iter_code_blocks())
 
-    def generate_output(self):
-        tree = "Folder Tree:\n" + "\n".join(self.print_tree(self.build_tree()))
+    def write_output(self, out):
+        """Stream the summary to a text file object, holding at most a window of code blocks in memory."""
         with open('header.txt', 'r') as f:
             header = f.read()
-        code_blocks = "\n\n".join(self.get_code_blocks())
         with open('footer.txt', 'r') as f:
             footer = f.read()
         with open('additional.txt', 'r') as f:
             additional = f"'{f.read()}'"
-        return f"{tree}\n\n{header}\n\n{code_blocks}\n\n{footer}\n\n{additional}"
+        files = self.get_relevant_files()
+        out.write("Folder Tree:\n" + "\n".join(self.print_tree(self.build_tree(files))))
+        out.write(f"\n\n{header}\n\n")
+        for i, block in enumerate(self.iter_code_blocks(files)):
+            out.write(f"\n\n{block}" if i else block)
+        out.write(f"\n\n{footer}\n\n{additional}")
+
+    def write_summary(self):
+        """Write the summary to output_path through a temp file, so a failed run leaves the previous summary intact."""
+        tmp_path = self.output_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                self.write_output(f)
+            os.replace(tmp_path, self.output_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def generate_output(self):
+        output = io.StringIO()
+        self.write_output(output)
+        return output.getvalue()
 
 if __name__ == "__main__":
     # Specify the root directory to scan
@@ -80,12 +221,8 @@ if __name__ == "__main__":
     additional_types = ['.csv', '.json', '.txt', '.html', '.css', '.md']
     
     # Create CodeEnumerator instance
-    enumerator = CodeEnumerator(root_directory, additional_types)
-    
-    # Generate and print the output
-    output = enumerator.generate_output()
-    print(output)
+    enumerator = CodeEnumerator(root_directory, additional_types, cache_path=CACHE_FILE, output_path='code_summary.md')
     
-    # Optionally, save to a file
-    with open('code_summary.md', 'w') as f:
-        f.write(output)
\ No newline at end of file
+    # Stream the output to the summary file, replacing it only once complete
+    enumerator.write_summary()
+    print("Wrote code_summary.md")
\ No newline at end of file
@@ -0,0 +1,138 @@
+import numpy as np
+from typing import Dict, Any, Optional, Sequence
+
+from OffGridDB import OffGridDB
+
+
+class CostProjection:
+    """Vectorised multi-month cost projection over the OffGridDB cost tables.
+
+    The cost tables are loaded once into per-level arrays; every call to
+    simulate() then evaluates all scenarios for all levels with array
+    operations only (no per-row Python loops).
+    """
+
+    def __init__(self, levels: Sequence[int], monthly_names: Sequence[str], monthly: np.ndarray,
+                 fixed_levels: np.ndarray, fixed_names: np.ndarray, fixed_totals: np.ndarray):
+        """
+        - levels: Level ids, one per row of `monthly`.
+        - monthly_names: Lower-cased monthly cost names, one per column of `monthly`.
+        - monthly: (levels x names) matrix of monthly amounts.
+        - fixed_levels, fixed_names, fixed_totals: One entry per fixed cost item
+          (level index, lower-cased name, total).
+        """
+        self.levels = np.asarray(levels, dtype=np.int64)
+        self.monthly_names = list(monthly_names)
+        self.monthly = monthly
+        self.fixed_levels = fixed_levels
+        self.fixed_totals = fixed_totals
+        # Shocks are matched per distinct name, then broadcast back to the items
+        self.fixed_names, self.fixed_name_index = np.unique(fixed_names.astype(str), return_inverse=True)
+
+    @classmethod
+    def from_db(cls, db: OffGridDB) -> "CostProjection":
+        """Load levels, monthly_costs and fixed_costs into arrays."""
+        levels = [row[0] for row in db.query("SELECT level FROM levels ORDER BY level")]
+        level_index = {level: i for i, level in enumerate(levels)}
+
+        monthly_rows = db.query("SELECT level_id, LOWER(name), amount FROM monthly_costs")
+        monthly_rows = [row for row in monthly_rows if row[0] in level_index]
+        names, name_index = np.unique([row[1] for row in monthly_rows] or np.empty(0, dtype=str), return_inverse=True)
+        monthly = np.zeros((len(levels), len(names)))
+        if monthly_rows:
+            rows = np.fromiter((level_index[row[0]] for row in monthly_rows), dtype=np.int64, count=len(monthly_rows))
+            amounts = np.fromiter((row[2] for row in monthly_rows), dtype=np.float64, count=len(monthly_rows))
+            np.add.at(monthly, (rows, name_index), amounts)
+
+        fixed_rows = db.query("SELECT level_id, LOWER(name), total FROM fixed_costs")
+        fixed_rows = [row for row in fixed_rows if row[0] in level_index]
+        fixed_levels = np.fromiter((level_index[row[0]] for row in fixed_rows), dtype=np.int64, count=len(fixed_rows))
+        fixed_names = np.array([row[1] for row in fixed_rows], dtype=object)
+        fixed_totals = np.fromiter((row[2] for row in fixed_rows), dtype=np.float64, count=len(fixed_rows))
+        return cls(levels, list(names), monthly, fixed_levels, fixed_names, fixed_totals)
+
+    def _shock_vector(self, names: Sequence[str], shocks: Dict[str, float]) -> np.ndarray:
+        """Multiplier per name: 1 + shock for names containing a shocked term, else 1."""
+        multipliers = np.ones(len(names))
+        for term, change in shocks.items():
+            term = term.lower()
+            matches = np.fromiter((term in name for name in names), dtype=bool, count=len(names))
+            multipliers[matches] *= 1.0 + change
+        return multipliers
+
+    @staticmethod
+    def _sorted_percentiles(ordered: np.ndarray, percentiles: Sequence[float]) -> np.ndarray:
+        """Linear-interpolated percentiles along axis 0 of an already sorted array (as np.percentile)."""
+        position = np.asarray(percentiles, dtype=np.float64) / 100.0 * (ordered.shape[0] - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        weight = (position - lower).reshape((-1,) + (1,) * (ordered.ndim - 1))
+        return ordered[lower] * (1.0 - weight) + ordered[upper] * weight
+
+    def simulate(self, months: int = 36, scenarios: int = 1000, inflation: float = 0.03,
+                 inflation_std: float = 0.01, volatility: float = 0.1, shocks: Optional[Dict[str, float]] = None,
+                 levels: Optional[Sequence[int]] = None, percentiles: Sequence[float] = (5, 50, 95),
+                 seed: Optional[int] = None) -> Dict[str, Any]:
+        """Run a Monte Carlo projection of cumulative cost.
+
+        - months: Projection horizon (at least 1); month 0 carries the fixed costs.
+        - scenarios: Number of random scenarios.
+        - inflation, inflation_std: Mean and spread of the annual inflation rate, drawn once per scenario.
+        - volatility: Lognormal spread of each monthly cost name's price level and of the fixed cost price level.
+        - shocks: Deterministic price changes by (substring of) item name, e.g. {"propane": 0.2}.
+        - levels: Restrict to these level ids (default: all).
+        - percentiles: Percentile bands to report.
+        - seed: Seed for reproducible runs.
+
+        Returns per-level cumulative cost curves (one value per month) for each
+        percentile plus the mean, and the distribution of the final total.
+        """
+        if months < 1:
+            raise ValueError("months must be at least 1")
+        rng = np.random.default_rng(seed)
+        shocks = shocks or {}
+        selected = np.arange(len(self.levels))
+        if levels is not None:
+            selected = np.flatnonzero(np.isin(self.levels, list(levels)))
+
+        # Per-scenario, per-name monthly price levels: (scenarios x names)
+        monthly_mult = self._shock_vector(self.monthly_names, shocks) * np.exp(
+            rng.normal(-0.5 * volatility ** 2, volatility, size=(scenarios, len(self.monthly_names))))
+        base_monthly = monthly_mult @ self.monthly[selected].T  # (scenarios x levels)
+
+        # Fixed costs: shocks per item, one random price level per scenario
+        fixed_items = self.fixed_totals
+        if shocks:
+            fixed_items = fixed_items * self._shock_vector(self.fixed_names, shocks)[self.fixed_name_index]
+        fixed_by_level = np.bincount(self.fixed_levels, weights=fixed_items, minlength=len(self.levels))[selected]
+        fixed_mult = np.exp(rng.normal(-0.5 * volatility ** 2, volatility, size=scenarios))
+        base_fixed = fixed_mult[:, None] * fixed_by_level[None, :]  # (scenarios x levels)
+
+        # Compounded monthly inflation factors and their running sum: (scenarios x months)
+        annual = rng.normal(inflation, inflation_std, size=scenarios)
+        monthly_rate = np.power(1.0 + annual, 1.0 / 12.0) - 1.0
+        growth = np.power(1.0 + monthly_rate[:, None], np.arange(months)[None, :])
+        cumulative_growth = np.cumsum(growth, axis=1)
+
+        # Cumulative cost: (scenarios x levels x months)
+        cumulative = np.multiply(base_monthly[:, :, None], cumulative_growth[:, None, :])
+        cumulative += base_fixed[:, :, None]
+        mean = cumulative.mean(axis=0)
+        # One in-place sort serves every percentile band (cheaper than np.percentile per band)
+        cumulative.sort(axis=0)
+        bands = self._sorted_percentiles(cumulative, percentiles)  # (percentiles x levels x months)
+        final = cumulative[:, :, -1]
+
+        result: Dict[str, Any] = {"months": months, "scenarios": scenarios, "percentiles": list(percentiles), "levels": []}
+        for j, level_idx in enumerate(selected):
+            curves = {f"p{p:g}": np.round(bands[i, j], 2).tolist() for i, p in enumerate(percentiles)}
+            curves["mean"] = np.round(mean[j], 2).tolist()
+            result["levels"].append({
+                "level": int(self.levels[level_idx]),
+                "cumulative": curves,
+                "final_total": {
+                    "mean": round(float(final[:, j].mean()), 2),
+                    **{f"p{p:g}": round(float(bands[i, j, -1]), 2) for i, p in enumerate(percentiles)},
+                },
+            })
+        return result
@@ -1,19 +1,853 @@
 import sqlite3
 import json
 import logging
+import os
+import queue
+import re
+import threading
+import asyncio
+import glob
+import hashlib
+import multiprocessing
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Callable, Iterable, Iterator
+from OffGridMetrics import metrics, statement_label
+from CatalogSchema import CatalogValidator, ErrorList
+
+INSERT_SQL = {
+    "level": "INSERT OR REPLACE INTO levels (level, name, description, total_monthly, total_fixed) VALUES (?, ?, ?, ?, ?)",
+    "monthly": "INSERT INTO monthly_costs (level_id, name, amount) VALUES (?, ?, ?)",
+    "fixed": "INSERT INTO fixed_costs (level_id, name, units, unit_type, unit_cost, total, seller_source) VALUES (?, ?, ?, ?, ?, ?, ?)",
+}
+UPDATE_SQL = {
+    "level": "UPDATE levels SET name = ?, description = ?, total_monthly = ?, total_fixed = ? WHERE level = ?",
+    "monthly": "UPDATE monthly_costs SET level_id = ?, name = ?, amount = ? WHERE id = ?",
+    "fixed": "UPDATE fixed_costs SET level_id = ?, name = ?, units = ?, unit_type = ?, unit_cost = ?, total = ?, seller_source = ? WHERE id = ?",
+}
+DELETE_SQL = {
+    "level": "DELETE FROM levels WHERE level = ?",
+    "monthly": "DELETE FROM monthly_costs WHERE id = ?",
+    "fixed": "DELETE FROM fixed_costs WHERE id = ?",
+}
+# Current rows in insert-record shape, prefixed with their primary key
+CURRENT_ROWS_SQL = {
+    "level": "SELECT level, level, name, description, total_monthly, total_fixed FROM levels ORDER BY level",
+    "monthly": "SELECT id, level_id, name, amount FROM monthly_costs ORDER BY id",
+    "fixed": "SELECT id, level_id, name, units, unit_type, unit_cost, total, seller_source FROM fixed_costs ORDER BY id",
+}
+BULK_BATCH_SIZE = 10000
+BULK_CACHE_SIZE_KIB = 262144
+SECONDARY_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_monthly_costs_level ON monthly_costs(level_id, name, amount)",
+    "CREATE INDEX IF NOT EXISTS idx_monthly_costs_level_id ON monthly_costs(level_id)",
+    "CREATE INDEX IF NOT EXISTS idx_monthly_costs_name ON monthly_costs(name, level_id)",
+    "CREATE INDEX IF NOT EXISTS idx_fixed_costs_level ON fixed_costs(level_id, name, total)",
+    "CREATE INDEX IF NOT EXISTS idx_fixed_costs_level_id ON fixed_costs(level_id)",
+    "CREATE INDEX IF NOT EXISTS idx_fixed_costs_name ON fixed_costs(name, level_id)",
+    "CREATE INDEX IF NOT EXISTS idx_fixed_costs_seller ON fixed_costs(seller_source, level_id)",
+    "CREATE INDEX IF NOT EXISTS idx_fixed_costs_unit_type ON fixed_costs(unit_type, level_id)",
+]
+AGGREGATE_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS level_totals (
+        level_id INTEGER PRIMARY KEY,
+        monthly_total REAL NOT NULL DEFAULT 0,
+        monthly_items INTEGER NOT NULL DEFAULT 0,
+        fixed_total REAL NOT NULL DEFAULT 0,
+        fixed_items INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS level_unit_type_totals (
+        level_id INTEGER NOT NULL,
+        unit_type TEXT NOT NULL,
+        units INTEGER NOT NULL DEFAULT 0,
+        fixed_total REAL NOT NULL DEFAULT 0,
+        items INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (level_id, unit_type)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS level_seller_totals (
+        level_id INTEGER NOT NULL,
+        seller_source TEXT NOT NULL,
+        units INTEGER NOT NULL DEFAULT 0,
+        fixed_total REAL NOT NULL DEFAULT 0,
+        items INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (level_id, seller_source)
+    ) WITHOUT ROWID
+    """,
+]
+
+
+def _monthly_rollup(ref: str, sign: str) -> str:
+    """Trigger body adding (sign '+') or removing (sign '-') the monthly_costs row `ref` from the rollups."""
+    if sign == "+":
+        return f"""
+        INSERT INTO level_totals (level_id, monthly_total, monthly_items) VALUES ({ref}.level_id, {ref}.amount, 1)
+            ON CONFLICT(level_id) DO UPDATE SET monthly_total = monthly_total + excluded.monthly_total, monthly_items = monthly_items + 1;"""
+    return f"""
+        UPDATE level_totals SET monthly_total = monthly_total - {ref}.amount, monthly_items = monthly_items - 1 WHERE level_id = {ref}.level_id;
+        DELETE FROM level_totals WHERE level_id = {ref}.level_id AND monthly_items = 0 AND fixed_items = 0;"""
+
+
+def _fixed_rollup(ref: str, sign: str) -> str:
+    """Trigger body adding (sign '+') or removing (sign '-') the fixed_costs row `ref` from the rollups."""
+    if sign == "+":
+        return f"""
+        INSERT INTO level_totals (level_id, fixed_total, fixed_items) VALUES ({ref}.level_id, {ref}.total, 1)
+            ON CONFLICT(level_id) DO UPDATE SET fixed_total = fixed_total + excluded.fixed_total, fixed_items = fixed_items + 1;
+        INSERT INTO level_unit_type_totals (level_id, unit_type, units, fixed_total, items) VALUES ({ref}.level_id, {ref}.unit_type, {ref}.units, {ref}.total, 1)
+            ON CONFLICT(level_id, unit_type) DO UPDATE SET units = units + excluded.units, fixed_total = fixed_total + excluded.fixed_total, items = items + 1;
+        INSERT INTO level_seller_totals (level_id, seller_source, units, fixed_total, items) VALUES ({ref}.level_id, {ref}.seller_source, {ref}.units, {ref}.total, 1)
+            ON CONFLICT(level_id, seller_source) DO UPDATE SET units = units + excluded.units, fixed_total = fixed_total + excluded.fixed_total, items = items + 1;"""
+    return f"""
+        UPDATE level_totals SET fixed_total = fixed_total - {ref}.total, fixed_items = fixed_items - 1 WHERE level_id = {ref}.level_id;
+        DELETE FROM level_totals WHERE level_id = {ref}.level_id AND monthly_items = 0 AND fixed_items = 0;
+        UPDATE level_unit_type_totals SET units = units - {ref}.units, fixed_total = fixed_total - {ref}.total, items = items - 1
+            WHERE level_id = {ref}.level_id AND unit_type = {ref}.unit_type;
+        DELETE FROM level_unit_type_totals WHERE level_id = {ref}.level_id AND unit_type = {ref}.unit_type AND items = 0;
+        UPDATE level_seller_totals SET units = units - {ref}.units, fixed_total = fixed_total - {ref}.total, items = items - 1
+            WHERE level_id = {ref}.level_id AND seller_source = {ref}.seller_source;
+        DELETE FROM level_seller_totals WHERE level_id = {ref}.level_id AND seller_source = {ref}.seller_source AND items = 0;"""
+
+
+AGGREGATE_TRIGGERS = [
+    f"CREATE TRIGGER IF NOT EXISTS trg_monthly_costs_insert AFTER INSERT ON monthly_costs BEGIN {_monthly_rollup('NEW', '+')} END",
+    f"CREATE TRIGGER IF NOT EXISTS trg_monthly_costs_delete AFTER DELETE ON monthly_costs BEGIN {_monthly_rollup('OLD', '-')} END",
+    f"CREATE TRIGGER IF NOT EXISTS trg_monthly_costs_update AFTER UPDATE OF level_id, amount ON monthly_costs BEGIN "
+    f"{_monthly_rollup('OLD', '-')} {_monthly_rollup('NEW', '+')} END",
+    f"CREATE TRIGGER IF NOT EXISTS trg_fixed_costs_insert AFTER INSERT ON fixed_costs BEGIN {_fixed_rollup('NEW', '+')} END",
+    f"CREATE TRIGGER IF NOT EXISTS trg_fixed_costs_delete AFTER DELETE ON fixed_costs BEGIN {_fixed_rollup('OLD', '-')} END",
+    f"CREATE TRIGGER IF NOT EXISTS trg_fixed_costs_update AFTER UPDATE OF level_id, units, unit_type, total, seller_source ON fixed_costs BEGIN "
+    f"{_fixed_rollup('OLD', '-')} {_fixed_rollup('NEW', '+')} END",
+]
+REBUILD_AGGREGATES_SQL = [
+    "DELETE FROM level_totals",
+    "DELETE FROM level_unit_type_totals",
+    "DELETE FROM level_seller_totals",
+    """
+    INSERT INTO level_totals (level_id, monthly_total, monthly_items, fixed_total, fixed_items)
+    SELECT level_id, SUM(monthly_total), SUM(monthly_items), SUM(fixed_total), SUM(fixed_items) FROM (
+        SELECT level_id, SUM(amount) AS monthly_total, COUNT(*) AS monthly_items, 0 AS fixed_total, 0 AS fixed_items
+        FROM monthly_costs GROUP BY level_id
+        UNION ALL
+        SELECT level_id, 0, 0, SUM(total), COUNT(*) FROM fixed_costs GROUP BY level_id
+    ) GROUP BY level_id
+    """,
+    """
+    INSERT INTO level_unit_type_totals (level_id, unit_type, units, fixed_total, items)
+    SELECT level_id, unit_type, SUM(units), SUM(total), COUNT(*) FROM fixed_costs GROUP BY level_id, unit_type
+    """,
+    """
+    INSERT INTO level_seller_totals (level_id, seller_source, units, fixed_total, items)
+    SELECT level_id, seller_source, SUM(units), SUM(total), COUNT(*) FROM fixed_costs GROUP BY level_id, seller_source
+    """,
+]
+# Full-text index over cost item names and sellers. Rowids encode the source
+# row: monthly_costs id * 2, fixed_costs id * 2 + 1.
+SEARCH_TABLE = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS cost_search USING fts5(
+        name, seller_source, kind UNINDEXED, level_id UNINDEXED, price UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    )
+"""
+SEARCH_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS trg_monthly_costs_search_insert AFTER INSERT ON monthly_costs BEGIN "
+    "INSERT INTO cost_search (rowid, name, seller_source, kind, level_id, price) VALUES (NEW.id * 2, NEW.name, '', 'monthly', NEW.level_id, NEW.amount); END",
+    "CREATE TRIGGER IF NOT EXISTS trg_monthly_costs_search_delete AFTER DELETE ON monthly_costs BEGIN "
+    "DELETE FROM cost_search WHERE rowid = OLD.id * 2; END",
+    "CREATE TRIGGER IF NOT EXISTS trg_monthly_costs_search_update AFTER UPDATE OF level_id, name, amount ON monthly_costs BEGIN "
+    "UPDATE cost_search SET name = NEW.name, level_id = NEW.level_id, price = NEW.amount WHERE rowid = NEW.id * 2; END",
+    "CREATE TRIGGER IF NOT EXISTS trg_fixed_costs_search_insert AFTER INSERT ON fixed_costs BEGIN "
+    "INSERT INTO cost_search (rowid, name, seller_source, kind, level_id, price) VALUES (NEW.id * 2 + 1, NEW.name, NEW.seller_source, 'fixed', NEW.level_id, NEW.total); END",
+    "CREATE TRIGGER IF NOT EXISTS trg_fixed_costs_search_delete AFTER DELETE ON fixed_costs BEGIN "
+    "DELETE FROM cost_search WHERE rowid = OLD.id * 2 + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS trg_fixed_costs_search_update AFTER UPDATE OF level_id, name, total, seller_source ON fixed_costs BEGIN "
+    "UPDATE cost_search SET name = NEW.name, seller_source = NEW.seller_source, level_id = NEW.level_id, price = NEW.total "
+    "WHERE rowid = NEW.id * 2 + 1; END",
+]
+REBUILD_SEARCH_SQL = [
+    "DELETE FROM cost_search",
+    "INSERT INTO cost_search (rowid, name, seller_source, kind, level_id, price) "
+    "SELECT id * 2, name, '', 'monthly', level_id, amount FROM monthly_costs",
+    "INSERT INTO cost_search (rowid, name, seller_source, kind, level_id, price) "
+    "SELECT id * 2 + 1, name, seller_source, 'fixed', level_id, total FROM fixed_costs",
+]
+SEARCH_KINDS = ("monthly", "fixed")
+SEARCH_NAME_WEIGHT = 10.0
+SEARCH_SELLER_WEIGHT = 1.0
+SEARCH_DEFAULT_LIMIT = 50
+# Append-only price history. price_items gives each cost item a stable id
+# (kind, level, name, n-th occurrence of that name); price_history and
+# level_history hold one row per change, keyed (id, effective_at) WITHOUT
+# ROWID so the key index covers as-of lookups. removed = 1 marks a deletion.
+HISTORY_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS price_items (
+        item_id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        level_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        occurrence INTEGER NOT NULL,
+        UNIQUE (kind, level_id, name, occurrence)
+    )
+    """,
+    # Rowid (item_id) order within a kind / level keeps as-of keyset pages seeks, as on the cost tables
+    "CREATE INDEX IF NOT EXISTS idx_price_items_kind ON price_items(kind)",
+    "CREATE INDEX IF NOT EXISTS idx_price_items_level ON price_items(kind, level_id)",
+    "CREATE INDEX IF NOT EXISTS idx_price_items_name ON price_items(kind, name, level_id)",
+    """
+    CREATE TABLE IF NOT EXISTS price_history (
+        item_id INTEGER NOT NULL,
+        effective_at INTEGER NOT NULL,
+        amount REAL,
+        unit_cost REAL,
+        units INTEGER,
+        unit_type TEXT,
+        seller_source TEXT,
+        removed INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (item_id, effective_at)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_price_history_seller "
+    "ON price_history(seller_source, item_id, effective_at, amount, unit_cost, units, removed)",
+    """
+    CREATE TABLE IF NOT EXISTS level_history (
+        level INTEGER NOT NULL,
+        effective_at INTEGER NOT NULL,
+        name TEXT,
+        description TEXT,
+        total_monthly REAL,
+        total_fixed REAL,
+        removed INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (level, effective_at)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS history_loads (
+        effective_at INTEGER PRIMARY KEY,
+        changed INTEGER NOT NULL,
+        removed INTEGER NOT NULL
+    )
+    """,
+]
+# Latest history entry of the item/level on the outer row, at or before :t
+_LATEST_PRICE = "h.effective_at = (SELECT MAX(effective_at) FROM price_history WHERE item_id = i.item_id{bound})"
+_LATEST_LEVEL = "h.effective_at = (SELECT MAX(effective_at) FROM level_history WHERE level = h.level{bound})"
+# (count key, statement) pairs run by record_price_history with :t bound to the effective time.
+# Current rows are numbered per (level, name) in id order to match them to price_items.
+RECORD_HISTORY_SQL = [
+    (None, "DROP TABLE IF EXISTS temp.current_items"),
+    (None, """
+        CREATE TEMP TABLE current_items AS
+        SELECT 'monthly' AS kind, level_id, name,
+               ROW_NUMBER() OVER (PARTITION BY level_id, name ORDER BY id) - 1 AS occurrence,
+               amount, NULL AS unit_cost, NULL AS units, NULL AS unit_type, NULL AS seller_source
+        FROM monthly_costs
+        UNION ALL
+        SELECT 'fixed', level_id, name, ROW_NUMBER() OVER (PARTITION BY level_id, name ORDER BY id) - 1,
+               total, unit_cost, units, unit_type, seller_source
+        FROM fixed_costs
+    """),
+    (None, "CREATE INDEX temp.idx_current_items ON current_items(kind, level_id, name, occurrence)"),
+    (None, "INSERT OR IGNORE INTO price_items (kind, level_id, name, occurrence) "
+           "SELECT kind, level_id, name, occurrence FROM temp.current_items"),
+    # CROSS JOIN keeps price_items as the outer loop, so the cost follows the items, not the history length
+    ("removed", f"""
+        INSERT OR REPLACE INTO price_history (item_id, effective_at, removed)
+        SELECT i.item_id, :t, 1 FROM price_items i
+        CROSS JOIN price_history h ON h.item_id = i.item_id AND {_LATEST_PRICE.format(bound="")}
+        WHERE h.removed = 0 AND NOT EXISTS (
+            SELECT 1 FROM temp.current_items c
+            WHERE c.kind = i.kind AND c.level_id = i.level_id AND c.name = i.name AND c.occurrence = i.occurrence)
+    """),
+    ("changed", f"""
+        INSERT OR REPLACE INTO price_history (item_id, effective_at, amount, unit_cost, units, unit_type, seller_source)
+        SELECT i.item_id, :t, c.amount, c.unit_cost, c.units, c.unit_type, c.seller_source
+        FROM temp.current_items c
+        JOIN price_items i ON i.kind = c.kind AND i.level_id = c.level_id AND i.name = c.name AND i.occurrence = c.occurrence
+        LEFT JOIN price_history h ON h.item_id = i.item_id AND {_LATEST_PRICE.format(bound="")}
+        WHERE h.item_id IS NULL OR h.removed OR h.amount IS NOT c.amount OR h.unit_cost IS NOT c.unit_cost
+           OR h.units IS NOT c.units OR h.unit_type IS NOT c.unit_type OR h.seller_source IS NOT c.seller_source
+    """),
+    ("removed", f"""
+        INSERT OR REPLACE INTO level_history (level, effective_at, removed)
+        SELECT h.level, :t, 1 FROM level_history h
+        WHERE {_LATEST_LEVEL.format(bound="")} AND h.removed = 0
+          AND NOT EXISTS (SELECT 1 FROM levels l WHERE l.level = h.level)
+    """),
+    ("changed", f"""
+        INSERT OR REPLACE INTO level_history (level, effective_at, name, description, total_monthly, total_fixed)
+        SELECT l.level, :t, l.name, l.description, l.total_monthly, l.total_fixed FROM levels l
+        LEFT JOIN level_history h ON h.level = l.level AND {_LATEST_LEVEL.format(bound="")}
+        WHERE h.level IS NULL OR h.removed OR h.name IS NOT l.name OR h.description IS NOT l.description
+           OR h.total_monthly IS NOT l.total_monthly OR h.total_fixed IS NOT l.total_fixed
+    """),
+    (None, "DROP TABLE temp.current_items"),
+]
+# Per-row history statements used by delta_load, which knows exactly which items changed
+HISTORY_ITEM_SQL = "INSERT OR IGNORE INTO price_items (kind, level_id, name, occurrence) VALUES (?, ?, ?, ?)"
+HISTORY_PRICE_SQL = (
+    "INSERT OR REPLACE INTO price_history (item_id, effective_at, amount, unit_cost, units, unit_type, seller_source, removed) "
+    "SELECT item_id, ?, ?, ?, ?, ?, ?, ? FROM price_items WHERE kind = ? AND level_id = ? AND name = ? AND occurrence = ?"
+)
+HISTORY_LEVEL_SQL = (
+    "INSERT OR REPLACE INTO level_history (level, effective_at, name, description, total_monthly, total_fixed, removed) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+# Row sources with the columns of QUERY_TABLES as they stood at a time bound as the first parameter;
+# ids are price_items.item_id, which stay stable across reloads unlike the cost tables' ids
+AS_OF_SQL = {
+    "levels": ("SELECT h.level, h.name, h.description, h.total_monthly, h.total_fixed FROM level_history h "
+               f"WHERE {_LATEST_LEVEL.format(bound=' AND effective_at <= ?')} AND h.removed = 0"),
+    "monthly": ("SELECT i.item_id AS id, i.level_id, i.name, h.amount FROM price_items i "
+                f"JOIN price_history h ON h.item_id = i.item_id AND {_LATEST_PRICE.format(bound=' AND effective_at <= ?')} "
+                "WHERE i.kind = 'monthly' AND h.removed = 0"),
+    "fixed": ("SELECT i.item_id AS id, i.level_id, i.name, h.units, h.unit_type, h.unit_cost, h.amount AS total, "
+              "h.seller_source FROM price_items i "
+              f"JOIN price_history h ON h.item_id = i.item_id AND {_LATEST_PRICE.format(bound=' AND effective_at <= ?')} "
+              "WHERE i.kind = 'fixed' AND h.removed = 0"),
+}
+AGGREGATE_SQL = {
+    "level": """
+        SELECT l.level, l.name, l.total_monthly, l.total_fixed,
+               COALESCE(t.monthly_total, 0) AS monthly_total, COALESCE(t.monthly_items, 0) AS monthly_items,
+               COALESCE(t.fixed_total, 0) AS fixed_total, COALESCE(t.fixed_items, 0) AS fixed_items
+        FROM levels l LEFT JOIN level_totals t ON t.level_id = l.level
+    """,
+    "unit_type": "SELECT level_id, unit_type, units, fixed_total, items FROM level_unit_type_totals",
+    "seller_source": "SELECT level_id, seller_source, units, fixed_total, items FROM level_seller_totals",
+}
+AGGREGATE_LEVEL_COLUMNS = {"level": "l.level", "unit_type": "level_id", "seller_source": "level_id"}
+QUERY_TABLES = {
+    "levels": ("levels", "level", "level"),
+    "monthly": ("monthly_costs", "level_id", "id"),
+    "fixed": ("fixed_costs", "level_id", "id"),
+}
+QUERY_COLUMNS = {
+    "levels": ["level", "name", "description", "total_monthly", "total_fixed"],
+    "monthly": ["id", "level_id", "name", "amount"],
+    "fixed": ["id", "level_id", "name", "units", "unit_type", "unit_cost", "total", "seller_source"],
+}
+# Filters /query pushes down into SQL: filter name -> (column, operator) per query type
+QUERY_FILTERS = {
+    "levels": {},
+    "monthly": {"name": ("name", "="), "min_amount": ("amount", ">="), "max_amount": ("amount", "<=")},
+    "fixed": {
+        "name": ("name", "="), "seller": ("seller_source", "="), "unit_type": ("unit_type", "="),
+        "min_total": ("total", ">="), "max_total": ("total", "<="),
+    },
+}
+QUERY_CACHED_STATEMENTS = 512  # Per-connection prepared statement cache (sqlite3 default: 128)
+QUERY_FETCH_SIZE = 1000
+REPORT_CHUNK_ENTRIES = 1000
+STREAM_CHUNK_SIZE = 65536
+STREAM_MAX_VALUE_BYTES = 16 * 1024 * 1024
+NDJSON_SUFFIXES = (".ndjson", ".jsonl")
+CATALOG_SUFFIXES = (".json",) + NDJSON_SUFFIXES
+SLOW_QUERY_SECONDS = 0.25
+PROGRESS_STEPS = 1000  # SQLite VM instructions between progress-handler calls
+DEFAULT_MAX_OPEN_DBS = 32  # Warm AsyncOffGridDB handles kept by the DatabaseRegistry
+FANOUT_WORKERS = 8  # Databases queried at once by DatabaseRegistry.fan_out
+
+QUERY_SECONDS = metrics.histogram("offgrid_db_query_seconds", "Time executing and fetching OffGridDB queries.", ["statement"])
+QUERY_ROWS = metrics.counter("offgrid_db_query_rows_total", "Rows returned by OffGridDB queries.", ["statement"])
+QUERY_VM_STEPS = metrics.counter("offgrid_db_query_vm_steps_total", "SQLite VM instructions run by OffGridDB queries (progress handler).", ["statement"])
+SLOW_QUERIES = metrics.counter("offgrid_db_slow_queries_total", "Queries slower than the slow-query threshold.", ["statement"])
+LOAD_SECONDS = metrics.histogram("offgrid_db_load_seconds", "Duration of load_json calls.", ["mode"])
+LOAD_ROWS = metrics.counter("offgrid_db_load_rows_total", "Rows written by load_json.", ["mode"])
+REPORT_SECONDS = metrics.histogram("offgrid_db_report_seconds", "Duration of report rendering.")
+STATEMENT_SECONDS = metrics.counter("offgrid_db_statement_seconds_total", "Approximate time per traced SQLite statement.", ["statement"])
+OPEN_DATABASES = metrics.gauge("offgrid_open_databases", "Warm database handles held by the registry.")
+DATABASE_EVICTIONS = metrics.counter("offgrid_database_evictions_total", "Warm database handles closed to stay under the open limit.")
+STATEMENT_EXECUTIONS = metrics.counter("offgrid_db_statement_executions_total", "Executions per traced SQLite statement.", ["statement"])
+
+
+def level_row(level: Dict[str, Any]) -> Tuple:
+    """Row for INSERT_SQL["level"]."""
+    return (level["level"], level["name"], level["description"], level["total_monthly"], level["total_fixed"])
+
+
+def monthly_row(level_id: int, item: Dict[str, Any]) -> Tuple:
+    """Row for INSERT_SQL["monthly"]."""
+    return (level_id, item["name"], item["amount"])
+
+
+def fixed_row(level_id: int, item: Dict[str, Any]) -> Tuple:
+    """Row for INSERT_SQL["fixed"]."""
+    return (level_id, item["name"], item["units"], item["unit_type"], item["unit_cost"], item["total"], item["seller_source"])
+
+
+def catalog_paths(source: str) -> List[str]:
+    """Resolve a catalog directory (its .json/.ndjson/.jsonl files) or glob pattern to sorted file paths."""
+    if os.path.isdir(source):
+        return sorted(entry.path for entry in os.scandir(source) if entry.is_file() and entry.name.endswith(CATALOG_SUFFIXES))
+    return sorted(path for path in glob.glob(source) if os.path.isfile(path))
+
+
+def parse_catalog_file(path: str) -> Dict[str, Any]:
+    """Parse and validate one catalog into insert rows per table (runs in a load_many worker process).
+
+    Returns {"path", "rows": {kind: [row, ...]}} or {"path", "error"}.
+    """
+    try:
+        parser = OffGridDB(path)  # Never connects; used for its parsing and validation
+        if path.endswith(NDJSON_SUFFIXES):
+            with open(path, 'r', encoding='utf-8') as f:
+                records = list(parser.stream_records(f, ndjson=True))
+        else:
+            records = parser.level_records(parser._read_json(path)["levels"])
+        rows: Dict[str, List[Tuple]] = {kind: [] for kind in INSERT_SQL}
+        for kind, row in records:
+            rows[kind].append(row)
+        return {"path": path, "rows": rows}
+    except Exception as e:
+        return {"path": path, "error": str(e)}
+
+
+class JsonStreamReader:
+    """Incremental JSON reader over a text file.
+
+    Keeps only the current chunk and the value being decoded in memory, so
+    structural tokens can be consumed one by one while individual values
+    (cost items, scalar fields) are decoded with JSONDecoder.raw_decode.
+    """
+
+    def __init__(self, f, chunk_size: int = STREAM_CHUNK_SIZE, max_value_bytes: int = STREAM_MAX_VALUE_BYTES):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.max_value_bytes = max_value_bytes
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        """Append the next chunk to the unread part of the buffer."""
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if len(self.buf) - self.pos > self.max_value_bytes:
+            raise Exception(f"JSON value exceeds the {self.max_value_bytes} byte streaming limit")
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Return the next non-whitespace character without consuming it ('' at EOF)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str):
+        """Consume `char` or raise."""
+        found = self.peek()
+        if found != char:
+            raise Exception(f"Invalid JSON: expected '{char}' but found '{found or 'EOF'}'")
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Decode and consume the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as e:
+                if not self._fill():
+                    raise Exception(f"Invalid JSON: {e}")
+                continue
+            # A number ending exactly at the buffer edge may continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return obj
+
+    def items(self) -> Iterator[Any]:
+        """Consume a JSON array, yielding its elements one at a time."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == "]":
+                self.pos += 1
+                return
+            self.expect(",")
+
+    def members(self) -> Iterator[str]:
+        """Consume a JSON object key by key; the caller must consume each member's value."""
+        self.expect("{")
+        first = True
+        while True:
+            if self.peek() == "}":
+                self.pos += 1
+                return
+            if not first:
+                self.expect(",")
+            first = False
+            key = self.value()
+            self.expect(":")
+            yield key
+
+
+class ConnectionPool:
+    """Bounded pool of reusable SQLite connections for one database file."""
+
+    _pools: Dict[str, "ConnectionPool"] = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, db_path: str, size: int = 8, timeout: float = 30.0,
+                 cache_size_kib: int = 16384, mmap_size: int = 268435456):
+        """Create an empty pool; connections are opened lazily up to `size`."""
+        if db_path == ":memory:":
+            raise ValueError("Connection pooling is not supported for ':memory:' databases")
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._file_id: Optional[Tuple[int, int]] = None
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def for_path(cls, db_path: str, **kwargs) -> "ConnectionPool":
+        """Return the shared pool for `db_path`, creating it on first use."""
+        key = os.path.abspath(db_path)
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = cls(db_path, **kwargs)
+                cls._pools[key] = pool
+            return pool
+
+    @classmethod
+    def close_path(cls, db_path: str):
+        """Close and forget the shared pool for `db_path`, if any."""
+        with cls._pools_lock:
+            pool = cls._pools.pop(os.path.abspath(db_path), None)
+        if pool is not None:
+            pool.close()
+
+    @classmethod
+    def close_all(cls):
+        """Close every shared pool, e.g. on application shutdown."""
+        with cls._pools_lock:
+            pools = list(cls._pools.values())
+            cls._pools.clear()
+        for pool in pools:
+            pool.close()
+
+    def _current_file_id(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.db_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def _open(self) -> sqlite3.Connection:
+        """Open and configure a new pooled connection."""
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False,
+                               cached_statements=QUERY_CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kib)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        self.logger.info(f"Opened pooled connection to {self.db_path}")
+        return conn
+
+    def _discard_idle(self):
+        """Close idle connections, e.g. after the database file was replaced."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+    def acquire(self) -> sqlite3.Connection:
+        """Check out a connection, blocking up to `timeout` when the pool is exhausted."""
+        file_id = self._current_file_id()
+        if file_id != self._file_id:
+            # The file was deleted or swapped underneath us; idle handles point at stale data
+            self._discard_idle()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if can_open:
+            try:
+                conn = self._open()
+            except sqlite3.Error:
+                with self._lock:
+                    self._opened -= 1
+                raise
+            self._file_id = self._current_file_id()
+            return conn
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No pooled connection for {self.db_path} became available within {self.timeout}s")
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection to the pool, rolling back any open transaction."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._current_file_id() != self._file_id:
+                raise sqlite3.Error("database file replaced")
+            self._idle.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+    def close(self):
+        """Close all idle connections; checked-out ones are closed on release."""
+        self._file_id = None
+        self._discard_idle()
+
+
+class MemoryReplica:
+    """In-memory copy of a database file that serves read-only connections.
+
+    refresh() copies the file into a fresh shared-cache in-memory database with
+    the SQLite backup API and only then swaps it in, so readers see either the
+    previous or the new dataset, never a partial one. Connections checked out
+    before a swap keep reading the old copy until they are released. Writes
+    must go through the file (and load_json) for the replica to pick them up.
+    """
+
+    _replicas: Dict[str, "MemoryReplica"] = {}
+    _replicas_lock = threading.Lock()
+
+    def __init__(self, db_path: str, size: int = 8):
+        """Create an empty replica; the first acquire() loads it."""
+        if db_path == ":memory:":
+            raise ValueError("Read replicas are not supported for ':memory:' databases")
+        self.db_path = db_path
+        self.size = size
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._sequence = 0
+        self._current: Optional[Tuple[int, str, sqlite3.Connection, "queue.LifoQueue[sqlite3.Connection]"]] = None
+        self._checked_out: Dict[sqlite3.Connection, int] = {}
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def for_path(cls, db_path: str, **kwargs) -> "MemoryReplica":
+        """Return the shared replica for `db_path`, creating it on first use."""
+        key = os.path.abspath(db_path)
+        with cls._replicas_lock:
+            replica = cls._replicas.get(key)
+            if replica is None:
+                replica = cls(db_path, **kwargs)
+                cls._replicas[key] = replica
+            return replica
+
+    @classmethod
+    def refresh_path(cls, db_path: str):
+        """Refresh the replica of `db_path` if one is being served, e.g. after a load."""
+        replica = cls._replicas.get(os.path.abspath(db_path))
+        if replica is not None:
+            replica.refresh()
+
+    @classmethod
+    def close_path(cls, db_path: str):
+        """Drop the shared replica of `db_path`, if any."""
+        with cls._replicas_lock:
+            replica = cls._replicas.pop(os.path.abspath(db_path), None)
+        if replica is not None:
+            replica.close()
+
+    @classmethod
+    def close_all(cls):
+        """Drop every shared replica, e.g. on application shutdown."""
+        with cls._replicas_lock:
+            replicas = list(cls._replicas.values())
+            cls._replicas.clear()
+        for replica in replicas:
+            replica.close()
+
+    def refresh(self):
+        """Copy the database file into a new in-memory database and swap it in."""
+        with self._refresh_lock:
+            start = time.perf_counter()
+            self._sequence += 1
+            uri = f"file:offgrid-replica-{os.getpid()}-{id(self)}-{self._sequence}?mode=memory&cache=shared"
+            # The anchor connection keeps the in-memory database alive while it is current
+            anchor = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            try:
+                source = sqlite3.connect(self.db_path)
+                try:
+                    source.backup(anchor)
+                finally:
+                    source.close()
+            except sqlite3.Error:
+                anchor.close()
+                raise
+            with self._lock:
+                old = self._current
+                self._current = (self._sequence, uri, anchor, queue.LifoQueue(maxsize=self.size))
+            if old is not None:
+                # Readers may have cached results computed against the old copy
+                OffGridDB.bump_generation(self.db_path)
+                self._close_generation(old)
+            self.logger.info(f"Refreshed in-memory replica of {self.db_path} in {time.perf_counter() - start:.3f}s")
+
+    @staticmethod
+    def _close_generation(generation: Tuple):
+        """Close a retired copy's idle connections and anchor; checked-out ones close on release."""
+        _, _, anchor, idle = generation
+        while True:
+            try:
+                idle.get_nowait().close()
+            except queue.Empty:
+                break
+        anchor.close()
+
+    def acquire(self) -> sqlite3.Connection:
+        """Check out a read-only connection to the current copy."""
+        if self._current is None:
+            self.refresh()
+        with self._lock:
+            sequence, uri, _, idle = self._current
+            try:
+                conn = idle.get_nowait()
+            except queue.Empty:
+                conn = None
+            if conn is None:
+                conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=QUERY_CACHED_STATEMENTS)
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA query_only=ON")
+            self._checked_out[conn] = sequence
+            return conn
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection, closing it if its copy has been swapped out."""
+        with self._lock:
+            sequence = self._checked_out.pop(conn, None)
+            current = self._current
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if current is None or sequence != current[0]:
+                raise sqlite3.Error("replica swapped")
+            current[3].put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.close()
+
+    def close(self):
+        """Retire the current copy."""
+        with self._lock:
+            current, self._current = self._current, None
+        if current is not None:
+            self._close_generation(current)
+
+
+class RowGroups:
+    """Peekable reader over (level_id, value) rows ordered by level_id."""
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.rows = iter(cursor)
+        self.current = next(self.rows, None)
+
+    def take(self, level_id: int) -> Iterator[Any]:
+        """Yield the values for `level_id`, skipping rows of lower (orphaned) levels."""
+        while self.current is not None and self.current[0] < level_id:
+            self.current = next(self.rows, None)
+        while self.current is not None and self.current[0] == level_id:
+            yield self.current[1]
+            self.current = next(self.rows, None)
+
 
 class OffGridDB:
-    def __init__(self, db_path: str, log_file: Optional[str] = None):
-        """Initialize SQLite database connection."""
+    _generations: Dict[str, int] = {}
+    _generations_lock = threading.Lock()
+    slow_query_seconds = SLOW_QUERY_SECONDS  # Queries at least this slow are logged with their plan
+    trace_statements = False  # Time every statement SQLite runs (including trigger bodies) via the trace hook
+    record_history = True  # Append price changes to the history tables after every load
+
+    def __init__(self, db_path: str, log_file: Optional[str] = None, pooled: bool = False, replica: bool = False):
+        """Initialize SQLite database connection.
+
+        With `pooled=True`, connect() checks out a connection from the shared
+        ConnectionPool for `db_path` and close() returns it instead of closing it.
+        With `replica=True` the connection is a read-only one to the shared
+        in-memory MemoryReplica of `db_path` instead.
+        """
         self.db_path = db_path
+        self.pooled = pooled
+        self.replica = replica
+        if replica:
+            self.pool = MemoryReplica.for_path(db_path)
+        else:
+            self.pool = ConnectionPool.for_path(db_path) if pooled else None
         self.conn = None
         self.cursor = None
+        self.vm_progress = 0
+        # Optional callback(phase, rows_done, rows_total) for long loads and reports (e.g. background jobs)
+        self.progress_callback: Optional[Callable[[str, Optional[int], Optional[int]], None]] = None
+        self._traced: Optional[Tuple[str, float]] = None
         if log_file:
-            logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+            self.configure_logging(log_file)
         self.logger = logging.getLogger(__name__)
 
+    @classmethod
+    def bump_generation(cls, db_path: str) -> int:
+        """Record that `db_path` was rewritten by this process; returns the new generation."""
+        key = os.path.abspath(db_path)
+        with cls._generations_lock:
+            cls._generations[key] = cls._generations.get(key, 0) + 1
+            return cls._generations[key]
+
+    @classmethod
+    def change_token(cls, db_path: str) -> Tuple:
+        """Cheap token that changes whenever the data in `db_path` may have changed.
+
+        Combines the in-process load generation with the size and mtime of the
+        database file and its WAL, so commits from other processes are seen too.
+        No SQLite connection is needed to compute it.
+        """
+        key = os.path.abspath(db_path)
+        token: List[Any] = [cls._generations.get(key, 0)]
+        for path in (db_path, db_path + "-wal"):
+            try:
+                st = os.stat(path)
+                token.extend((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                token.extend((0, 0))
+        return tuple(token)
+
+    @staticmethod
+    def configure_logging(log_file: str):
+        """Configure file logging for OffGridDB (no-op once logging is set up)."""
+        logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
     def __enter__(self):
         """Context manager entry."""
         self.connect()
@@ -25,20 +859,67 @@ class OffGridDB:
 
     def connect(self):
         """Connect to SQLite database."""
-        if self.conn is None or self.conn.closed:  # Check if connection is closed
+        if self.conn is None:
             try:
-                self.conn = sqlite3.connect(self.db_path)
-                self.conn.row_factory = sqlite3.Row  # Enable row factory for dict-like access
+                if self.pool is not None:
+                    self.conn = self.pool.acquire()
+                else:
+                    self.conn = sqlite3.connect(self.db_path, cached_statements=QUERY_CACHED_STATEMENTS)
+                    self.conn.row_factory = sqlite3.Row  # Enable row factory for dict-like access
+                    self.logger.info(f"Connected to database: {self.db_path}")
                 self.cursor = self.conn.cursor()
-                self.logger.info(f"Connected to database: {self.db_path}")
-            except sqlite3.Error as e:
+                self.conn.set_progress_handler(self._on_progress, PROGRESS_STEPS)
+                if self.trace_statements:
+                    self.conn.set_trace_callback(self._on_statement)
+            except (sqlite3.Error, TimeoutError) as e:
                 self.logger.error(f"Database connection failed: {e}")
                 raise Exception(f"Database connection failed: {e}")
 
+    def _on_progress(self) -> int:
+        """Progress handler: count VM work in units of PROGRESS_STEPS; never interrupts."""
+        self.vm_progress += 1
+        return 0
+
+    def _on_statement(self, sql: str):
+        """Trace hook: a statement starts, so the previous one has finished."""
+        now = time.perf_counter()
+        self._flush_trace(now)
+        self._traced = (sql, now)
+
+    def _flush_trace(self, now: Optional[float] = None):
+        if self._traced is not None:
+            sql, start = self._traced
+            label = statement_label(sql)
+            STATEMENT_SECONDS.inc((now or time.perf_counter()) - start, label)
+            STATEMENT_EXECUTIONS.inc(1, label)
+            self._traced = None
+
+    def _record_query(self, sql: str, params: Tuple, rows: int, seconds: float, progress: int):
+        """Update the query metrics and log the statement with its plan if it was slow."""
+        label = statement_label(sql)
+        QUERY_SECONDS.observe(seconds, label)
+        QUERY_ROWS.inc(rows, label)
+        QUERY_VM_STEPS.inc(progress * PROGRESS_STEPS, label)
+        if seconds >= self.slow_query_seconds and not sql.lstrip().upper().startswith("EXPLAIN"):
+            SLOW_QUERIES.inc(1, label)
+            try:
+                plan = [row[3] for row in self.conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            except (sqlite3.Error, AttributeError) as e:  # AttributeError: connection already closed
+                plan = [f"unavailable: {e}"]
+            self.logger.warning(
+                f"Slow query ({seconds:.3f}s, {rows} rows, ~{progress * PROGRESS_STEPS} VM steps): {label} "
+                f"params={params!r} plan={plan}"
+            )
+
     def create_tables(self, drop_if_exists: bool = False):
-        """Create tables for levels, monthly_costs, and fixed_costs."""
+        """Create tables for levels, monthly_costs, fixed_costs and the price history."""
         try:
             if drop_if_exists:
+                self.cursor.execute("DROP TABLE IF EXISTS cost_search")
+                self.cursor.execute("DROP TABLE IF EXISTS level_seller_totals")
+                self.cursor.execute("DROP TABLE IF EXISTS level_unit_type_totals")
+                self.cursor.execute("DROP TABLE IF EXISTS level_totals")
+                self.cursor.execute("DROP TABLE IF EXISTS content_hashes")
                 self.cursor.execute("DROP TABLE IF EXISTS fixed_costs")
                 self.cursor.execute("DROP TABLE IF EXISTS monthly_costs")
                 self.cursor.execute("DROP TABLE IF EXISTS levels")
@@ -74,7 +955,1253 @@ class OffGridDB:
                     FOREIGN KEY (level_id) REFERENCES levels(level)
                 )
             """)
+            self.cursor.execute("""
+                CREATE TABLE IF NOT EXISTS content_hashes (
+                    kind TEXT NOT NULL,
+                    item_key TEXT NOT NULL,
+                    row_id INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    PRIMARY KEY (kind, item_key)
+                ) WITHOUT ROWID
+            """)
+            for sql in SECONDARY_INDEXES:
+                self.cursor.execute(sql)
+            for sql in AGGREGATE_TABLES + AGGREGATE_TRIGGERS + [SEARCH_TABLE] + SEARCH_TRIGGERS:
+                self.cursor.execute(sql)
+            # Price history is append-only and survives drop_if_exists reloads
+            for sql in HISTORY_TABLES:
+                self.cursor.execute(sql)
+            # Backfill rollups and the search index for databases created before they existed
+            self.cursor.execute(
+                "SELECT EXISTS(SELECT 1 FROM level_totals), EXISTS(SELECT 1 FROM cost_search), "
+                "EXISTS(SELECT 1 FROM monthly_costs) OR EXISTS(SELECT 1 FROM fixed_costs)"
+            )
+            has_totals, has_search, has_costs = self.cursor.fetchone()
+            if has_costs and not has_totals:
+                self.rebuild_aggregates()
+            if has_costs and not has_search:
+                self.rebuild_search_index()
             self.conn.commit()
             self.logger.info("Tables created successfully")
         except sqlite3.Error as e:
-            self.logger.error(f"Table creation failed: {e}")
\ No newline at end of file
+            self.logger.error(f"Table creation failed: {e}")
+
+    def validate(self, data: Dict[str, Any]):
+        """Check a parsed catalog against the compiled schema, raising SchemaValidationError with every error."""
+        errors = CatalogValidator.from_file().validate(data)
+        if errors.total:
+            self.logger.error(f"Catalog failed validation with {errors.total} errors")
+        errors.raise_if_any()
+
+    @staticmethod
+    def level_records(levels: Iterable[Dict[str, Any]]) -> Iterator[Tuple[str, Tuple]]:
+        """Flatten parsed levels into ("level" | "monthly" | "fixed", row) insert records."""
+        for level in levels:
+            yield "level", level_row(level)
+            for item in level["monthly_costs"]:
+                yield "monthly", monthly_row(level["level"], item)
+            for item in level["fixed_costs"]:
+                yield "fixed", fixed_row(level["level"], item)
+
+    @staticmethod
+    def _stream_level(reader: JsonStreamReader, validator: CatalogValidator, errors: ErrorList,
+                      parent: str, index: int) -> Iterator[Tuple[str, Tuple]]:
+        """Stream one level object, validating and yielding each cost item as it is read.
+
+        Items are emitted immediately once the level's "level" key has been seen
+        (exported catalogs list it first); items that precede it are held back.
+        Invalid items are recorded in `errors` and skipped, so parsing carries on
+        and the caller can report every error at the end. A level that is not
+        an object, or cost lists that are not arrays, are decoded whole and left
+        to the validator, so they get the same errors as in a document load.
+        """
+        if reader.peek() != "{":
+            validator.check_level(reader.value(), parent, index, errors)
+            return
+        level: Dict[str, Any] = {}
+        pending: List[Tuple[str, Dict[str, Any]]] = []
+        path = f"{parent}[{index}]"
+        for key in reader.members():
+            if key in ("monthly_costs", "fixed_costs") and reader.peek() == "[":
+                kind, check = ("monthly", validator.check_monthly) if key == "monthly_costs" else ("fixed", validator.check_fixed)
+                items = f"{path}.{key}"
+                for item_index, item in enumerate(reader.items()):
+                    if not check(item, items, item_index, errors):
+                        continue
+                    if "level" in level:
+                        yield kind, (monthly_row if kind == "monthly" else fixed_row)(level["level"], item)
+                    else:
+                        pending.append((kind, item))
+                level[key] = []
+            else:
+                level[key] = reader.value()
+        if not validator.check_level(level, parent, index, errors):
+            return
+        for kind, item in pending:
+            yield kind, (monthly_row if kind == "monthly" else fixed_row)(level["level"], item)
+        yield "level", level_row(level)
+
+    def stream_records(self, f, ndjson: bool = False) -> Iterator[Tuple[str, Tuple]]:
+        """Incrementally parse a catalog file into insert records.
+
+        Walks levels[*].monthly_costs[*] and levels[*].fixed_costs[*] without
+        materialising the document. With `ndjson=True` the file holds one level
+        object per line instead of a {"levels": [...]} document. Every item is
+        checked by the compiled schema validator; once the whole file has been
+        read, SchemaValidationError lists all errors (the caller's transaction
+        rolls back).
+        """
+        validator = CatalogValidator.from_file()
+        errors = ErrorList()
+        reader = JsonStreamReader(f)
+        if ndjson:
+            index = 0
+            while reader.peek():
+                yield from self._stream_level(reader, validator, errors, "$", index)
+                index += 1
+        else:
+            seen_levels = False
+            for key in reader.members():
+                if key == "levels":
+                    seen_levels = True
+                    reader.expect("[")
+                    if reader.peek() == "]":
+                        reader.pos += 1
+                        continue
+                    index = 0
+                    while True:
+                        yield from self._stream_level(reader, validator, errors, "$.levels", index)
+                        index += 1
+                        if reader.peek() == "]":
+                            reader.pos += 1
+                            break
+                        reader.expect(",")
+                else:
+                    reader.value()
+            if not seen_levels:
+                errors.append(("$.levels", "missing required field"))
+        if errors.total:
+            self.logger.error(f"Catalog failed validation with {errors.total} errors")
+        errors.raise_if_any()
+
+    def _read_json(self, json_path: str) -> Dict[str, Any]:
+        """Parse and validate a whole catalog file."""
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            self.logger.error(f"JSON file not found: {json_path}")
+            raise
+        self.validate(data)
+        return data
+
+    def _progress(self, phase: str, done: Optional[int] = None, total: Any = None):
+        """Report progress to progress_callback, if set; `total` may be a callable estimating it from `done`."""
+        if self.progress_callback is not None:
+            self.progress_callback(phase, done, total(done) if callable(total) else total)
+
+    def load_json(self, json_path: str, drop_if_exists: bool = False, bulk: bool = False,
+                  stream: bool = False, delta: bool = False, effective_at: Optional[int] = None) -> Dict[str, Any]:
+        """Load levels, monthly_costs, and fixed_costs from a JSON file.
+
+        With `bulk=True` rows go through bulk_insert (batched executemany in one
+        transaction). With `stream=True` the file is parsed incrementally by
+        stream_records and fed to bulk_insert as it is read, so memory stays flat;
+        files ending in .ndjson/.jsonl are read as one level per line.
+        Returns row counts, elapsed seconds and rows/sec.
+
+        With `delta=True` the file is diffed against the stored content hashes
+        and only changed rows are written (see delta_load); `bulk`/`stream` are
+        ignored and the counts are inserted/updated/deleted/unchanged instead.
+
+        While record_history is set, the resulting price changes are appended to
+        the history at `effective_at` (Unix seconds, default: now), which may
+        not precede the latest recorded change.
+        """
+        if delta:
+            if drop_if_exists:
+                raise ValueError("A delta load cannot be combined with drop_if_exists")
+            self._progress("parse")
+            data = self._read_json(json_path)
+            self.connect()
+            self.create_tables()
+            # Deltas append only the rows they write; the first recording snapshots every row
+            history_at, snapshot = None, False
+            if self.record_history:
+                effective_at = self._history_timestamp(effective_at)
+                snapshot = self.cursor.execute("SELECT 1 FROM history_loads LIMIT 1").fetchone() is None
+                history_at = None if snapshot else effective_at
+            self._progress("diff")
+            stats = self.delta_load(data["levels"], effective_at=history_at)
+            if snapshot:
+                stats["history"] = self.record_price_history(effective_at)
+            self.cursor.execute("PRAGMA optimize")
+            if stats["inserted"] or stats["updated"] or stats["deleted"]:
+                self.bump_generation(self.db_path)
+                MemoryReplica.refresh_path(self.db_path)
+            LOAD_SECONDS.observe(stats["seconds"], "delta")
+            LOAD_ROWS.inc(stats["inserted"] + stats["updated"] + stats["deleted"], "delta")
+            self.logger.info(f"Delta loaded {json_path}: {stats}")
+            return stats
+        if stream:
+            try:
+                f = open(json_path, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                self.logger.error(f"JSON file not found: {json_path}")
+                raise
+            with f:
+                self.connect()
+                self.create_tables(drop_if_exists=drop_if_exists)
+                if self.record_history:
+                    effective_at = self._history_timestamp(effective_at)
+                self._clear_content_hashes()
+                start = time.perf_counter()
+                size = os.fstat(f.fileno()).st_size
+
+                def estimate(done: int) -> int:
+                    """Extrapolate the total rows from the share of the file read so far."""
+                    return int(done * size / max(f.buffer.tell(), 1))
+
+                counts = self.bulk_insert(self.stream_records(f, ndjson=json_path.endswith(NDJSON_SUFFIXES)), total=estimate)
+        else:
+            self._progress("parse")
+            data = self._read_json(json_path)
+            self.connect()
+            self.create_tables(drop_if_exists=drop_if_exists)
+            if self.record_history:
+                effective_at = self._history_timestamp(effective_at)
+            self._clear_content_hashes()
+            start = time.perf_counter()
+            records = self.level_records(data["levels"])
+            total = sum(1 + len(level["monthly_costs"]) + len(level["fixed_costs"]) for level in data["levels"])
+            if bulk:
+                counts = self.bulk_insert(records, total=total)
+            else:
+                counts = {kind: 0 for kind in INSERT_SQL}
+                try:
+                    for done, (kind, row) in enumerate(records, 1):
+                        self.cursor.execute(INSERT_SQL[kind], row)
+                        counts[kind] += 1
+                        if done % BULK_BATCH_SIZE == 0:
+                            self._progress("insert", done, total)
+                    self.conn.commit()
+                except sqlite3.Error as e:
+                    self.conn.rollback()
+                    self.logger.error(f"Loading JSON failed: {e}")
+                    raise Exception(f"Loading JSON failed: {e}")
+        history = self.record_price_history(effective_at) if self.record_history else None
+        self.cursor.execute("PRAGMA optimize")  # Refresh planner statistics for the indexes
+        self.bump_generation(self.db_path)
+        MemoryReplica.refresh_path(self.db_path)
+        stats = self._load_stats(counts, time.perf_counter() - start)
+        if history is not None:
+            stats["history"] = history
+        mode = "stream" if stream else "bulk" if bulk else "insert"
+        LOAD_SECONDS.observe(stats["seconds"], mode)
+        LOAD_ROWS.inc(stats["rows"], mode)
+        self.logger.info(f"Loaded {stats['levels']} levels ({stats['rows']} rows, {stats['rows_per_sec']} rows/sec) from {json_path}")
+        return stats
+
+    def _clear_content_hashes(self):
+        """Forget stored hashes after a full load; the next delta load rebuilds them from the rows."""
+        self.cursor.execute("DELETE FROM content_hashes")
+        self.conn.commit()
+
+    @staticmethod
+    def content_hash(row: Tuple) -> str:
+        """Hash a row's values; numbers are normalised so 50 and 50.0 hash alike."""
+        digest = hashlib.blake2b(digest_size=16)
+        for value in row:
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = repr(float(value))
+            digest.update(str(value).encode())
+            digest.update(b"\x1f")
+        return digest.hexdigest()
+
+    @staticmethod
+    def item_key(kind: str, row: Tuple, seen: Dict[Tuple, int]) -> str:
+        """Stable identity of an insert record.
+
+        Levels are identified by their number and cost items by (level, name,
+        occurrence), so repeated names within a level stay distinct; `seen`
+        tracks occurrences across calls for one pass over the data.
+        """
+        if kind == "level":
+            return str(row[0])
+        ident = (kind, row[0], row[1])
+        occurrence = seen.get(ident, 0)
+        seen[ident] = occurrence + 1
+        return json.dumps([row[0], row[1], occurrence])
+
+    def _rebuild_content_hashes(self):
+        """Hash the current rows when no hashes are stored (e.g. after a full load)."""
+        if self.cursor.execute("SELECT 1 FROM content_hashes LIMIT 1").fetchone():
+            return
+        for kind, sql in CURRENT_ROWS_SQL.items():
+            seen: Dict[Tuple, int] = {}
+            hashes = (
+                (kind, self.item_key(kind, tuple(row[1:]), seen), row[0], self.content_hash(tuple(row[1:])))
+                for row in self.conn.cursor().execute(sql)
+            )
+            self.cursor.executemany(
+                "INSERT INTO content_hashes (kind, item_key, row_id, content_hash) VALUES (?, ?, ?, ?)", hashes
+            )
+        self.conn.commit()
+
+    def delta_load(self, levels: Iterable[Dict[str, Any]], effective_at: Optional[int] = None) -> Dict[str, Any]:
+        """Apply a catalog as a delta against the stored content hashes.
+
+        Every level and cost item is hashed and compared with content_hashes;
+        only new, changed and vanished rows are inserted, updated or deleted,
+        in one short transaction. With `effective_at` the same rows are
+        appended to the price history in that transaction. Returns the counts
+        and elapsed seconds.
+        """
+        start = time.perf_counter()
+        self.connect()
+        self._rebuild_content_hashes()
+        existing = {
+            (row["kind"], row["item_key"]): (row["row_id"], row["content_hash"])
+            for row in self.conn.cursor().execute("SELECT kind, item_key, row_id, content_hash FROM content_hashes")
+        }
+        new, changed, unchanged = [], [], 0
+        seen: Dict[Tuple, int] = {}
+        for kind, row in self.level_records(levels):
+            key = self.item_key(kind, row, seen)
+            digest = self.content_hash(row)
+            current = existing.pop((kind, key), None)
+            if current is None:
+                new.append((kind, key, row, digest))
+            elif current[1] != digest:
+                changed.append((kind, key, current[0], row, digest))
+            else:
+                unchanged += 1
+
+        try:
+            for (kind, key), (row_id, _) in existing.items():
+                self.cursor.execute(DELETE_SQL[kind], (row_id,))
+                self.cursor.execute("DELETE FROM content_hashes WHERE kind = ? AND item_key = ?", (kind, key))
+            for kind, key, row_id, row, digest in changed:
+                params = row[1:] + (row[0],) if kind == "level" else row + (row_id,)
+                self.cursor.execute(UPDATE_SQL[kind], params)
+                self.cursor.execute("UPDATE content_hashes SET content_hash = ? WHERE kind = ? AND item_key = ?", (digest, kind, key))
+            for kind, key, row, digest in new:
+                self.cursor.execute(INSERT_SQL[kind], row)
+                row_id = row[0] if kind == "level" else self.cursor.lastrowid
+                self.cursor.execute(
+                    "INSERT INTO content_hashes (kind, item_key, row_id, content_hash) VALUES (?, ?, ?, ?)",
+                    (kind, key, row_id, digest)
+                )
+            if effective_at is not None and (new or changed or existing):
+                history = self._record_delta_history(effective_at, new + changed, existing)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            self.logger.error(f"Delta load failed: {e}")
+            raise Exception(f"Delta load failed: {e}")
+        stats = {
+            "inserted": len(new),
+            "updated": len(changed),
+            "deleted": len(existing),
+            "unchanged": unchanged,
+            "seconds": round(time.perf_counter() - start, 4),
+        }
+        if effective_at is not None and (new or changed or existing):
+            stats["history"] = history
+        return stats
+
+    def _record_delta_history(self, effective_at: int, written: List[Tuple], deleted: Dict[Tuple, Any]) -> Dict[str, int]:
+        """Append delta_load's new/changed records and tombstones for its deleted keys (inside its transaction)."""
+        for kind, key, *_, row, _digest in written:
+            if kind == "level":
+                self.cursor.execute(HISTORY_LEVEL_SQL, (row[0], effective_at) + row[1:] + (0,))
+                continue
+            ident = (kind,) + tuple(json.loads(key))
+            values = (row[2], None, None, None, None) if kind == "monthly" else (row[5], row[4], row[2], row[3], row[6])
+            self.cursor.execute(HISTORY_ITEM_SQL, ident)
+            self.cursor.execute(HISTORY_PRICE_SQL, (effective_at,) + values + (0,) + ident)
+        for kind, key in deleted:
+            if kind == "level":
+                self.cursor.execute(HISTORY_LEVEL_SQL, (int(key), effective_at, None, None, None, None, 1))
+            else:
+                self.cursor.execute(HISTORY_PRICE_SQL, (effective_at, None, None, None, None, None, 1, kind) + tuple(json.loads(key)))
+        counts = {"changed": len(written), "removed": len(deleted)}
+        self.cursor.execute("INSERT OR REPLACE INTO history_loads (effective_at, changed, removed) VALUES (?, ?, ?)",
+                            (effective_at, counts["changed"], counts["removed"]))
+        return counts
+
+    @staticmethod
+    def _load_stats(counts: Dict[str, int], seconds: float) -> Dict[str, Any]:
+        rows = sum(counts.values())
+        return {
+            "levels": counts["level"],
+            "monthly_costs": counts["monthly"],
+            "fixed_costs": counts["fixed"],
+            "rows": rows,
+            "seconds": round(seconds, 4),
+            "rows_per_sec": round(rows / seconds) if seconds > 0 else rows,
+        }
+
+    def _drop_deferred_objects(self) -> List[str]:
+        """Drop user-defined indexes and triggers on the cost tables, returning their CREATE statements."""
+        self.cursor.execute(
+            "SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND sql IS NOT NULL "
+            "AND tbl_name IN ('levels', 'monthly_costs', 'fixed_costs')"
+        )
+        objects = self.cursor.fetchall()
+        for obj in objects:
+            self.cursor.execute(f'DROP {obj["type"].upper()} "{obj["name"]}"')
+        return [obj["sql"] for obj in objects]
+
+    def rebuild_aggregates(self):
+        """Recompute the rollup tables from scratch (the caller commits)."""
+        for sql in REBUILD_AGGREGATES_SQL:
+            self.cursor.execute(sql)
+
+    def rebuild_search_index(self):
+        """Repopulate cost_search from the cost tables (the caller commits)."""
+        for sql in REBUILD_SEARCH_SQL:
+            self.cursor.execute(sql)
+
+    @staticmethod
+    def parse_timestamp(value: str, end_of_day: bool = False) -> int:
+        """Parse an ISO date or datetime into Unix seconds; times without an offset are UTC.
+
+        A bare date means the start of that day, or its last second with
+        `end_of_day=True` (so as_of=2025-01-31 includes changes made that day).
+        Raises ValueError for anything else.
+        """
+        try:
+            parsed = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid date '{value}': expected ISO format, e.g. 2025-01-31 or 2025-01-31T12:00:00Z")
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        seconds = int(parsed.timestamp())
+        if end_of_day and len(value) == 10:
+            seconds += 86399
+        return seconds
+
+    @staticmethod
+    def format_timestamp(seconds: int) -> str:
+        """Format Unix seconds as an ISO datetime in UTC."""
+        return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+
+    def _history_timestamp(self, effective_at: Optional[int] = None) -> int:
+        """Return the time to record a load's changes at (default: now), which may not precede the last one."""
+        latest = self.cursor.execute("SELECT MAX(effective_at) FROM history_loads").fetchone()[0]
+        if effective_at is None:
+            return max(int(time.time()), latest or 0)
+        if latest is not None and effective_at < latest:
+            raise ValueError(f"effective_at {self.format_timestamp(effective_at)} is before the latest recorded "
+                             f"change ({self.format_timestamp(latest)}); price history is append-only")
+        return int(effective_at)
+
+    def record_price_history(self, effective_at: Optional[int] = None) -> Dict[str, int]:
+        """Append new, changed and removed prices and levels to the history at `effective_at` (default: now).
+
+        Current rows are matched to their price_items by (kind, level, name,
+        occurrence) and compared with each item's latest history entry in a
+        few set-based statements, so only differences are written and an
+        unchanged reload adds nothing but a history_loads row. Called after
+        every load while record_history is set. Returns the changed/removed counts.
+        """
+        self.connect()
+        self.create_tables()
+        effective_at = self._history_timestamp(effective_at)
+        self._progress("history")
+        counts = {"changed": 0, "removed": 0}
+        try:
+            if not self.conn.in_transaction:
+                self.cursor.execute("BEGIN")
+            for key, sql in RECORD_HISTORY_SQL:
+                self.cursor.execute(sql, {"t": effective_at})
+                if key:
+                    counts[key] += self.cursor.rowcount
+            self.cursor.execute("INSERT OR REPLACE INTO history_loads (effective_at, changed, removed) VALUES (?, ?, ?)",
+                                (effective_at, counts["changed"], counts["removed"]))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            self.logger.error(f"Recording price history failed: {e}")
+            raise Exception(f"Recording price history failed: {e}")
+        self.logger.info(f"Recorded price history at {self.format_timestamp(effective_at)}: {counts}")
+        return counts
+
+    def price_trend(self, name: Optional[str] = None, seller: Optional[str] = None, level: Optional[int] = None,
+                    kind: Optional[str] = None, since: Optional[int] = None,
+                    until: Optional[int] = None) -> List[sqlite3.Row]:
+        """Return the history entries of the items named `name` and/or sold by `seller`, per item in time order.
+
+        Removals appear as entries with removed = 1 (and no seller, so they are
+        only listed when filtering by name). Raises ValueError without a name or seller.
+        """
+        if not name and not seller:
+            raise ValueError("A price trend needs an item name or a seller")
+        if kind is not None and kind not in SEARCH_KINDS:
+            raise ValueError(f"Invalid kind '{kind}'. Must be one of {list(SEARCH_KINDS)}")
+        # Naming both kinds lets name lookups seek idx_price_items_name (kind, name, level_id)
+        kinds = SEARCH_KINDS if kind is None else (kind,)
+        conditions = [f"i.kind IN ({', '.join('?' * len(kinds))})"]
+        params: List[Any] = list(kinds)
+        for condition, value in (("i.name = ?", name), ("h.seller_source = ?", seller), ("i.level_id = ?", level),
+                                 ("h.effective_at >= ?", since), ("h.effective_at <= ?", until)):
+            if value is not None and value != "":
+                conditions.append(condition)
+                params.append(value)
+        sql = ("SELECT i.item_id, i.kind, i.level_id, i.name, h.effective_at, h.amount AS price, h.unit_cost, "
+               "h.units, h.seller_source, h.removed FROM price_items i JOIN price_history h ON h.item_id = i.item_id "
+               "WHERE " + " AND ".join(conditions) + " ORDER BY h.item_id, h.effective_at")
+        return self.query(sql, tuple(params))
+
+    @staticmethod
+    def build_search(text: str, level: Optional[int] = None, min_price: Optional[float] = None,
+                     max_price: Optional[float] = None, kind: Optional[str] = None,
+                     limit: int = SEARCH_DEFAULT_LIMIT) -> Tuple[str, Tuple]:
+        """Return the parameterized full-text query issued by /search.
+
+        Every word of `text` must match as a prefix of a word in the item name
+        or seller; hits are ranked by BM25 with names weighted over sellers.
+        """
+        words = re.findall(r"\w+", text)
+        if not words:
+            raise ValueError("Search text must contain at least one word")
+        conditions = ["cost_search MATCH ?"]
+        params: List[Any] = [" ".join(f'"{word}"*' for word in words)]
+        if level:
+            conditions.append("level_id = ?")
+            params.append(level)
+        if min_price is not None:
+            conditions.append("price >= ?")
+            params.append(min_price)
+        if max_price is not None:
+            conditions.append("price <= ?")
+            params.append(max_price)
+        if kind:
+            conditions.append("kind = ?")
+            params.append(kind)
+        params.append(limit)
+        sql = (
+            f"SELECT kind, rowid >> 1 AS id, level_id, name, seller_source, price, "
+            f"bm25(cost_search, {SEARCH_NAME_WEIGHT}, {SEARCH_SELLER_WEIGHT}) AS score FROM cost_search "
+            f"WHERE {' AND '.join(conditions)} ORDER BY score LIMIT ?"
+        )
+        return sql, tuple(params)
+
+    def search(self, text: str, level: Optional[int] = None, min_price: Optional[float] = None,
+               max_price: Optional[float] = None, kind: Optional[str] = None,
+               limit: int = SEARCH_DEFAULT_LIMIT) -> List[sqlite3.Row]:
+        """Full-text search over cost item names and sellers, best matches first."""
+        return self.query(*self.build_search(text, level, min_price, max_price, kind, limit))
+
+    def aggregates(self, by: str = "level", level: Optional[int] = None) -> List[sqlite3.Row]:
+        """Read trigger-maintained totals per level, level x unit_type or level x seller_source."""
+        sql = AGGREGATE_SQL[by]
+        params: Tuple = ()
+        if level:
+            sql += f" WHERE {AGGREGATE_LEVEL_COLUMNS[by]} = ?"
+            params = (level,)
+        return self.query(sql, params)
+
+    @contextmanager
+    def _bulk_transaction(self):
+        """Run the body in one explicit transaction tuned for mass inserts.
+
+        Secondary indexes and the rollup/search triggers are dropped for the
+        duration and rebuilt once at the end (the rollups and search index are
+        recomputed in one pass), and synchronous/cache PRAGMAs are relaxed until
+        the load finishes. Any error rolls the whole transaction back.
+        """
+        self.connect()
+        synchronous = self.cursor.execute("PRAGMA synchronous").fetchone()[0]
+        cache_size = self.cursor.execute("PRAGMA cache_size").fetchone()[0]
+        self.cursor.execute("PRAGMA synchronous=OFF")
+        self.cursor.execute(f"PRAGMA cache_size=-{BULK_CACHE_SIZE_KIB}")
+        try:
+            self.cursor.execute("BEGIN")
+            deferred_sql = self._drop_deferred_objects()
+            yield
+            self._progress("index")
+            for sql in deferred_sql:
+                self.cursor.execute(sql)
+            self.rebuild_aggregates()
+            self.rebuild_search_index()
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            self.logger.error(f"Bulk load failed: {e}")
+            if isinstance(e, sqlite3.Error):
+                raise Exception(f"Bulk load failed: {e}")
+            raise
+        finally:
+            self.cursor.execute(f"PRAGMA synchronous={int(synchronous)}")
+            self.cursor.execute(f"PRAGMA cache_size={int(cache_size)}")
+
+    def bulk_insert(self, records: Iterable[Tuple[str, Tuple]], batch_size: int = BULK_BATCH_SIZE,
+                    total: Any = None) -> Dict[str, int]:
+        """Insert (kind, row) records in one bulk transaction (see _bulk_transaction).
+
+        Rows are buffered per table and flushed with executemany every
+        `batch_size` rows. Progress is reported every `batch_size` records
+        against `total` (a count, or a callable estimating it; see _progress).
+        """
+        buffers: Dict[str, List[Tuple]] = {kind: [] for kind in INSERT_SQL}
+        counts = {kind: 0 for kind in INSERT_SQL}
+        with self._bulk_transaction():
+            for done, (kind, row) in enumerate(records, 1):
+                if done % batch_size == 0:
+                    self._progress("insert", done, total)
+                buffer = buffers[kind]
+                buffer.append(row)
+                if len(buffer) >= batch_size:
+                    self.cursor.executemany(INSERT_SQL[kind], buffer)
+                    counts[kind] += len(buffer)
+                    buffer.clear()
+            for kind, buffer in buffers.items():
+                if buffer:
+                    self.cursor.executemany(INSERT_SQL[kind], buffer)
+                    counts[kind] += len(buffer)
+        return counts
+
+    def load_many(self, source: str, drop_if_exists: bool = False, workers: Optional[int] = None,
+                  effective_at: Optional[int] = None) -> Dict[str, Any]:
+        """Load every catalog in a directory or matching a glob pattern.
+
+        Files are parsed and validated by parse_catalog_file in a pool of
+        `workers` processes (default: CPU count) while this connection is the
+        single writer. Parsed files are written in path order, each under its own
+        savepoint inside one bulk transaction, so a file that fails to parse,
+        validate or insert is skipped and reported without affecting the rest.
+        Returns the totals of load_json plus per-file results. Price changes
+        are recorded at `effective_at` as in load_json.
+        """
+        paths = catalog_paths(source)
+        if not paths:
+            self.logger.error(f"No catalog files match {source}")
+            raise FileNotFoundError(f"No catalog files match {source}")
+        workers = min(workers or os.cpu_count() or 1, len(paths))
+        self.connect()
+        self.create_tables(drop_if_exists=drop_if_exists)
+        if self.record_history:
+            effective_at = self._history_timestamp(effective_at)
+        self._clear_content_hashes()
+        start = time.perf_counter()
+        counts = {kind: 0 for kind in INSERT_SQL}
+        files = []
+        # spawn: the caller may be a threaded server, where forking is unsafe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            with self._bulk_transaction():
+                pending: "deque" = deque()
+                remaining = iter(paths)
+                for path in remaining:
+                    pending.append(pool.submit(parse_catalog_file, path))
+                    if len(pending) >= 2 * workers:
+                        break
+                while pending:
+                    result = pending.popleft().result()
+                    for path in remaining:
+                        pending.append(pool.submit(parse_catalog_file, path))
+                        break
+                    files.append(self._write_catalog_rows(result, counts))
+                    done = sum(counts.values())
+                    self._progress("insert", done, done * len(paths) // len(files))
+        history = self.record_price_history(effective_at) if self.record_history else None
+        self.cursor.execute("PRAGMA optimize")
+        self.bump_generation(self.db_path)
+        MemoryReplica.refresh_path(self.db_path)
+        stats = self._load_stats(counts, time.perf_counter() - start)
+        if history is not None:
+            stats["history"] = history
+        LOAD_SECONDS.observe(stats["seconds"], "many")
+        LOAD_ROWS.inc(stats["rows"], "many")
+        stats["files"] = files
+        stats["failed"] = sum(1 for file in files if "error" in file)
+        self.logger.info(f"Loaded {len(files) - stats['failed']}/{len(files)} catalogs ({stats['rows']} rows, "
+                         f"{stats['rows_per_sec']} rows/sec) from {source}")
+        return stats
+
+    def _write_catalog_rows(self, result: Dict[str, Any], counts: Dict[str, int]) -> Dict[str, Any]:
+        """Insert one parsed catalog under a savepoint, returning its per-file result."""
+        path = result["path"]
+        if "error" in result:
+            self.logger.error(f"Skipping catalog {path}: {result['error']}")
+            return {"path": path, "error": result["error"]}
+        try:
+            self.cursor.execute("SAVEPOINT catalog_file")
+            for kind, rows in result["rows"].items():
+                self.cursor.executemany(INSERT_SQL[kind], rows)
+            self.cursor.execute("RELEASE catalog_file")
+        except sqlite3.Error as e:
+            self.cursor.execute("ROLLBACK TO catalog_file")
+            self.cursor.execute("RELEASE catalog_file")
+            self.logger.error(f"Skipping catalog {path}: {e}")
+            return {"path": path, "error": f"Insert failed: {e}"}
+        file_counts = {kind: len(rows) for kind, rows in result["rows"].items()}
+        for kind, count in file_counts.items():
+            counts[kind] += count
+        return {"path": path, "levels": file_counts["level"], "monthly_costs": file_counts["monthly"],
+                "fixed_costs": file_counts["fixed"], "rows": sum(file_counts.values())}
+
+    def query(self, sql: str, params: Tuple = ()) -> List[sqlite3.Row]:
+        """Execute a query and return all rows."""
+        self.connect()
+        start, progress = time.perf_counter(), self.vm_progress
+        try:
+            self.cursor.execute(sql, params)
+            rows = self.cursor.fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(f"Query failed: {e}")
+            raise Exception(f"Query failed: {e}")
+        self._record_query(sql, params, len(rows), time.perf_counter() - start, self.vm_progress - progress)
+        return rows
+
+    @staticmethod
+    def build_query(query_type: str, level: Optional[int] = None, after: Optional[int] = None,
+                    limit: Optional[int] = None, filters: Optional[Dict[str, Any]] = None,
+                    sort: Optional[str] = None, fields: Optional[List[str]] = None,
+                    as_of: Optional[int] = None) -> Tuple[str, Tuple]:
+        """Return the parameterized SELECT issued by /query/{query_type}.
+
+        - filters: Column filters from QUERY_FILTERS[query_type] (e.g. seller,
+          unit_type, min_total); None values are ignored.
+        - sort: Column from QUERY_COLUMNS to order by, prefixed with '-' for
+          descending; ties are broken by primary key.
+        - fields: Columns to return (default: all). The primary key is added
+          when paginating so the next cursor can be read from the last row.
+        - as_of: Unix seconds; read the rows as they stood then from the price
+          history (AS_OF_SQL) instead of the current tables. Cost item ids are
+          then price_items ids.
+
+        `after`/`limit` page through the table by primary key (keyset
+        pagination): rows come back in key order starting after `after`. The
+        (level_id) indexes keep rowid order, so level-filtered pages are seeks too.
+        Only values are ever bound as parameters; every identifier is checked
+        against QUERY_COLUMNS/QUERY_FILTERS, so a query shape maps to one
+        reusable prepared statement. Raises ValueError for unknown names.
+        """
+        table, level_column, key_column = QUERY_TABLES[query_type]
+        columns = QUERY_COLUMNS[query_type]
+        conditions, params = [], []
+        if level:
+            conditions.append(f"{level_column} = ?")
+            params.append(level)
+        for name, value in sorted((filters or {}).items()):
+            if value is None:
+                continue
+            if name not in QUERY_FILTERS[query_type]:
+                raise ValueError(f"Unsupported filter '{name}' for {query_type}. Must be one of {sorted(QUERY_FILTERS[query_type])}")
+            column, operator = QUERY_FILTERS[query_type][name]
+            conditions.append(f"{column} {operator} ?")
+            params.append(value)
+        if after is not None:
+            if sort and sort != key_column:
+                raise ValueError(f"after can only be combined with the default ascending sort ({key_column})")
+            conditions.append(f"{key_column} > ?")
+            params.append(after)
+
+        selected = "*"
+        if fields:
+            unknown = [field for field in fields if field not in columns]
+            if unknown:
+                raise ValueError(f"Unknown fields {unknown} for {query_type}. Must be among {columns}")
+            if (after is not None or limit is not None) and key_column not in fields:
+                fields = list(fields) + [key_column]
+            selected = ", ".join(fields)
+        if as_of is not None:
+            table = f"({AS_OF_SQL[query_type]}) AS {table}"
+            params.insert(0, as_of)
+        sql = f"SELECT {selected} FROM {table}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if sort:
+            column = sort.lstrip("-")
+            if column not in columns:
+                raise ValueError(f"Unknown sort column '{column}' for {query_type}. Must be one of {columns}")
+            direction = " DESC" if sort.startswith("-") else ""
+            sql += f" ORDER BY {column}{direction}"
+            if column != key_column:
+                sql += f", {key_column}{direction}"
+        elif after is not None or limit is not None:
+            sql += f" ORDER BY {key_column}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return sql, tuple(params)
+
+    def iter_query(self, sql: str, params: Tuple = (), fetch_size: int = QUERY_FETCH_SIZE) -> Iterator[List[sqlite3.Row]]:
+        """Execute a query and yield its rows in chunks of `fetch_size`.
+
+        Only the time spent inside SQLite counts towards the query metrics, not
+        the time the consumer takes between chunks.
+        """
+        self.connect()
+        cursor = self.conn.cursor()
+        seconds, progress, count = 0.0, 0, 0
+        try:
+            start, steps = time.perf_counter(), self.vm_progress
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                seconds += time.perf_counter() - start
+                progress += self.vm_progress - steps
+                if not rows:
+                    break
+                count += len(rows)
+                yield rows
+                start, steps = time.perf_counter(), self.vm_progress
+        except sqlite3.Error as e:
+            self.logger.error(f"Query failed: {e}")
+            raise Exception(f"Query failed: {e}")
+        finally:
+            cursor.close()
+            self._record_query(sql, params, count, seconds, progress)
+
+    @staticmethod
+    def report_queries(level: Optional[int] = None, as_of: Optional[int] = None) -> Dict[str, Tuple[str, Tuple]]:
+        """Return the parameterized SELECTs issued by /report.
+
+        Each child table is read on its own, ordered by level and name through
+        its covering (level_id, name, ...) index, so the report never builds
+        the monthly x fixed product and its entry order does not depend on
+        which index the planner picks.
+        With `as_of` the tables are replaced by their AS_OF_SQL history views.
+        """
+        params: Tuple = (level,) if level else ()
+        level_filter = " WHERE level = ?" if level else ""
+        child_filter = " WHERE level_id = ?" if level else ""
+        tables = {"levels": "levels", "monthly": "monthly_costs", "fixed": "fixed_costs"}
+        child_order = " ORDER BY level_id, name"
+        if as_of is not None:
+            tables = {name: f"({AS_OF_SQL[name]}) AS {table}" for name, table in tables.items()}
+            params = (as_of,) + params
+        return {
+            "levels": (f"SELECT level, name, description, total_monthly, total_fixed FROM {tables['levels']}"
+                       + level_filter + " ORDER BY level", params),
+            "monthly": (f"SELECT level_id, name || ': ' || amount FROM {tables['monthly']}"
+                        + child_filter + child_order, params),
+            "fixed": (f"SELECT level_id, name || ': ' || total FROM {tables['fixed']}"
+                      + child_filter + child_order, params),
+        }
+
+    def explain(self, sql: str, params: Tuple = ()) -> List[str]:
+        """Return the EXPLAIN QUERY PLAN detail lines for a statement."""
+        return [row["detail"] for row in self.query(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+    def full_scans(self, level: int = 1) -> Dict[str, List[str]]:
+        """Return the full-table-scan plan steps of each level-filtered or paginated API query.
+
+        An empty dict means every /query/{query_type}?level=N (with or without
+        after/limit), every unfiltered keyset page, the seller/unit_type filtered
+        fixed-cost queries and every /report?level=N statement is answered
+        through an index.
+        """
+        statements = {query_type: self.build_query(query_type, level) for query_type in QUERY_TABLES}
+        for query_type in QUERY_TABLES:
+            statements[f"{query_type}_page"] = self.build_query(query_type, level, after=0, limit=100)
+            statements[f"{query_type}_all_page"] = self.build_query(query_type, after=0, limit=100)
+        statements["fixed_seller"] = self.build_query("fixed", level, filters={"seller": ""})
+        statements["fixed_unit_type"] = self.build_query("fixed", level, filters={"unit_type": ""})
+        for name, statement in self.report_queries(level).items():
+            statements[f"report_{name}"] = statement
+        scans = {}
+        for name, (sql, params) in statements.items():
+            steps = [detail for detail in self.explain(sql, params) if detail.startswith("SCAN")]
+            if steps:
+                scans[name] = steps
+        return scans
+
+    @staticmethod
+    def _entries_for(rows: "RowGroups", level_id: int) -> Iterator[str]:
+        """Render one level's "name: value" entries comma-separated, in bounded chunks."""
+        chunk: List[str] = []
+        first = True
+        for entry in rows.take(level_id):
+            chunk.append(entry)
+            if len(chunk) >= REPORT_CHUNK_ENTRIES:
+                yield ("" if first else ",") + ",".join(chunk)
+                first = False
+                chunk.clear()
+        if chunk:
+            yield ("" if first else ",") + ",".join(chunk)
+        elif first:
+            yield "None"
+
+    @classmethod
+    def report_header(cls, as_of: Optional[int] = None) -> str:
+        """Return the report title block, stamped with the current time."""
+        header = f"# OffGridDB Cost Report\n\nGenerated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+        if as_of is not None:
+            header += f"Prices as of: {cls.format_timestamp(as_of)}\n\n"
+        return header
+
+    def iter_report(self, level: Optional[int] = None, as_of: Optional[int] = None,
+                    header: bool = True) -> Iterator[str]:
+        """Render the Markdown cost report incrementally.
+
+        Levels, monthly and fixed rows are read through three cursors ordered by
+        level and merged as they are consumed, so time and memory grow linearly
+        with the data and the first chunk is available immediately. With
+        `as_of` (Unix seconds) the report shows the prices recorded at that time.
+        With `header=False` the title block (see report_header) is left out.
+        """
+        self.connect()
+        queries = self.report_queries(level, as_of)
+        cursors = {name: self.conn.cursor().execute(sql, params) for name, (sql, params) in queries.items()}
+        monthly = RowGroups(cursors["monthly"])
+        fixed = RowGroups(cursors["fixed"])
+        total = None
+        if self.progress_callback is not None:
+            sql, params = queries["levels"]
+            total = self.conn.execute(f"SELECT COUNT(*) FROM ({sql})", params).fetchone()[0]
+        if header:
+            yield self.report_header(as_of)
+        for done, row in enumerate(cursors["levels"]):
+            self._progress("render", done, total)
+            yield (f"## Level {row['level']}: {row['name']}\n"
+                   f"- **Description**: {row['description']}\n"
+                   f"- **Total Monthly Cost**: ${row['total_monthly']}\n"
+                   f"- **Total Fixed Cost**: ${row['total_fixed']}\n"
+                   f"- **Monthly Costs**: ")
+            yield from self._entries_for(monthly, row["level"])
+            yield "\n- **Fixed Costs**: "
+            yield from self._entries_for(fixed, row["level"])
+            yield "\n\n"
+
+    def report(self, level: Optional[int] = None, output: Optional[str] = None, as_of: Optional[int] = None,
+               header: bool = True) -> str:
+        """Build the Markdown cost report (as of `as_of`, if given), optionally writing it to `output`."""
+        parts = []
+        start = time.perf_counter()
+        f = open(output, "w") if output else None
+        try:
+            for chunk in self.iter_report(level, as_of, header):
+                parts.append(chunk)
+                if f:
+                    f.write(chunk)
+        finally:
+            if f:
+                f.close()
+        REPORT_SECONDS.observe(time.perf_counter() - start)
+        return "".join(parts)
+
+    def close(self):
+        """Close the database connection (or return it to the pool)."""
+        if self.conn is not None:
+            self._flush_trace()
+            self.conn.set_progress_handler(None, 0)
+            self.conn.set_trace_callback(None)
+            if self.pool is not None:
+                self.pool.release(self.conn)
+            else:
+                self.conn.close()
+                self.logger.info(f"Closed connection to database: {self.db_path}")
+        self.conn = None
+        self.cursor = None
+
+
+class QueueFullError(Exception):
+    """Raised when an AsyncOffGridDB queue has no free slot for new work."""
+
+
+class AsyncOffGridDB:
+    """Awaitable facade running OffGridDB work off the event loop.
+
+    Reads run on a bounded pool of reader threads and writes on a single writer
+    thread, each against a pooled connection, so readers keep flowing (WAL) while
+    a long load is in progress. Each queue admits at most `max_pending_*` jobs
+    (running plus waiting); further submissions fail fast with QueueFullError.
+    With `replica=True` reads are served from the in-memory MemoryReplica,
+    which every successful load refreshes and swaps. Shared facades are kept
+    warm by the class-wide DatabaseRegistry (`registry`).
+    """
+
+    registry: "DatabaseRegistry"
+
+    def __init__(self, db_path: str, readers: int = 4, max_pending_reads: int = 64, max_pending_writes: int = 4,
+                 replica: bool = False):
+        """Start the reader and writer executors for `db_path`."""
+        self.db_path = db_path
+        self.replica = replica
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="offgrid-reader")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="offgrid-writer")
+        self._read_slots = threading.BoundedSemaphore(max_pending_reads)
+        self._write_slots = threading.BoundedSemaphore(max_pending_writes)
+        # Data derived from the database (e.g. /project's cost arrays), kept only while the handle is warm
+        self.derived: Dict[str, Any] = {}
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def for_path(cls, db_path: str, **kwargs) -> "AsyncOffGridDB":
+        """Return the shared facade for `db_path` without leasing it (see DatabaseRegistry.lease)."""
+        return cls.registry.get(db_path, **kwargs)
+
+    @classmethod
+    def close_all(cls):
+        """Shut down every shared facade, e.g. on application shutdown."""
+        cls.registry.close_all()
+
+    def _run(self, fn: Callable, args: Tuple, kwargs: Dict[str, Any], replica: bool = False):
+        with OffGridDB(self.db_path, pooled=True, replica=replica) as db:
+            return fn(db, *args, **kwargs)
+
+    def _enqueue(self, executor: ThreadPoolExecutor, slots: threading.BoundedSemaphore, kind: str,
+                 fn: Callable, args: Tuple, kwargs: Dict[str, Any], replica: bool = False, wait: bool = False) -> Future:
+        if not slots.acquire(blocking=wait):
+            self.logger.warning(f"{kind} queue full for {self.db_path}")
+            raise QueueFullError(f"Too many pending {kind}s for {self.db_path}")
+        try:
+            future = executor.submit(self._run, fn, args, kwargs, replica)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    async def _submit(self, executor: ThreadPoolExecutor, slots: threading.BoundedSemaphore, kind: str,
+                      fn: Callable, args: Tuple, kwargs: Dict[str, Any], replica: bool = False):
+        return await asyncio.wrap_future(self._enqueue(executor, slots, kind, fn, args, kwargs, replica))
+
+    def run_blocking(self, write: bool, fn: Callable, *args, **kwargs):
+        """Run `fn(db, *args, **kwargs)` on the writer (or a reader) thread from a plain thread.
+
+        Unlike run_read/run_write this waits for a free queue slot instead of
+        raising QueueFullError; used by background jobs.
+        """
+        if write:
+            future = self._enqueue(self._writer, self._write_slots, "write", fn, args, kwargs, wait=True)
+        else:
+            future = self._enqueue(self._readers, self._read_slots, "read", fn, args, kwargs, self.replica, wait=True)
+        return future.result()
+
+    async def run_read(self, fn: Callable, *args, **kwargs):
+        """Run `fn(db, *args, **kwargs)` on a reader thread with a connected OffGridDB."""
+        return await self._submit(self._readers, self._read_slots, "read", fn, args, kwargs, self.replica)
+
+    async def run_write(self, fn: Callable, *args, **kwargs):
+        """Run `fn(db, *args, **kwargs)` on the writer thread with a connected OffGridDB."""
+        return await self._submit(self._writer, self._write_slots, "write", fn, args, kwargs)
+
+    async def query(self, sql: str, params: Tuple = ()) -> List[sqlite3.Row]:
+        """Awaitable OffGridDB.query."""
+        return await self.run_read(OffGridDB.query, sql, params)
+
+    async def load_json(self, json_path: str, drop_if_exists: bool = False, bulk: bool = False,
+                        stream: bool = False, delta: bool = False, effective_at: Optional[int] = None) -> Dict[str, Any]:
+        """Awaitable OffGridDB.load_json."""
+        return await self.run_write(OffGridDB.load_json, json_path, drop_if_exists=drop_if_exists, bulk=bulk,
+                                    stream=stream, delta=delta, effective_at=effective_at)
+
+    async def load_many(self, source: str, drop_if_exists: bool = False, workers: Optional[int] = None,
+                        effective_at: Optional[int] = None) -> Dict[str, Any]:
+        """Awaitable OffGridDB.load_many."""
+        return await self.run_write(OffGridDB.load_many, source, drop_if_exists=drop_if_exists, workers=workers,
+                                    effective_at=effective_at)
+
+    async def aggregates(self, by: str = "level", level: Optional[int] = None) -> List[sqlite3.Row]:
+        """Awaitable OffGridDB.aggregates."""
+        return await self.run_read(OffGridDB.aggregates, by, level)
+
+    async def search(self, text: str, level: Optional[int] = None, min_price: Optional[float] = None,
+                     max_price: Optional[float] = None, kind: Optional[str] = None,
+                     limit: int = SEARCH_DEFAULT_LIMIT) -> List[sqlite3.Row]:
+        """Awaitable OffGridDB.search."""
+        return await self.run_read(OffGridDB.search, text, level, min_price, max_price, kind, limit)
+
+    async def price_trend(self, name: Optional[str] = None, seller: Optional[str] = None, level: Optional[int] = None,
+                          kind: Optional[str] = None, since: Optional[int] = None,
+                          until: Optional[int] = None) -> List[sqlite3.Row]:
+        """Awaitable OffGridDB.price_trend."""
+        return await self.run_read(OffGridDB.price_trend, name, seller, level, kind, since, until)
+
+    async def report(self, level: Optional[int] = None, output: Optional[str] = None, as_of: Optional[int] = None,
+                     header: bool = True) -> str:
+        """Awaitable OffGridDB.report."""
+        return await self.run_read(OffGridDB.report, level, output, as_of, header)
+
+    def stream_query(self, sql: str, params: Tuple = ()) -> Iterator[bytes]:
+        """Yield query rows as NDJSON lines, fetched and serialised chunk by chunk.
+
+        Like stream_report, this is a plain generator for StreamingResponse.
+        """
+        with OffGridDB(self.db_path, pooled=True, replica=self.replica) as db:
+            for rows in db.iter_query(sql, params):
+                yield "".join(json.dumps(dict(row)) + "\n" for row in rows).encode()
+
+    def stream_report(self, level: Optional[int] = None, output: Optional[str] = None,
+                      as_of: Optional[int] = None) -> Iterator[str]:
+        """Yield report chunks from a pooled connection, teeing them into `output`.
+
+        This is a plain generator for StreamingResponse, which iterates it in
+        the server's thread pool rather than on the event loop.
+        """
+        f = open(output, "w") if output else None
+        try:
+            with OffGridDB(self.db_path, pooled=True, replica=self.replica) as db:
+                for chunk in db.iter_report(level, as_of):
+                    if f:
+                        f.write(chunk)
+                    yield chunk
+        finally:
+            if f:
+                f.close()
+
+    def close(self):
+        """Wait for queued work, stop the executor threads and drop the derived data."""
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self.derived.clear()
+
+
+class DatabaseRegistry:
+    """LRU of warm AsyncOffGridDB handles, one per database file.
+
+    At most `max_open` handles (each with its reader/writer threads, pooled
+    connections and optional replica) are kept; opening another one retires
+    the least recently used. A retired handle is closed once its last lease
+    is released, so in-flight requests finish on it. fan_out() runs a read
+    against many databases at once without churning the LRU: warm databases
+    use their pools, cold ones a one-off connection.
+    """
+
+    def __init__(self, max_open: int = DEFAULT_MAX_OPEN_DBS, fanout_workers: int = FANOUT_WORKERS):
+        self.max_open = max_open
+        self.fanout_workers = fanout_workers
+        self._handles: "OrderedDict[str, AsyncOffGridDB]" = OrderedDict()
+        self._leases: Dict[AsyncOffGridDB, int] = {}
+        self._lock = threading.Lock()
+        self._fanout: Optional[ThreadPoolExecutor] = None
+        self.logger = logging.getLogger(__name__)
+
+    def acquire(self, db_path: str, create: bool = True, **kwargs) -> Optional[AsyncOffGridDB]:
+        """Lease the handle for `db_path`, opening it (and retiring the LRU handle) if needed.
+
+        With `create=False` only an already warm handle is leased; None otherwise.
+        `kwargs` are passed to AsyncOffGridDB when the handle is opened.
+        """
+        key = os.path.abspath(db_path)
+        evicted = []
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is None:
+                if not create:
+                    return None
+                handle = AsyncOffGridDB(db_path, **kwargs)
+                self._handles[key] = handle
+                while len(self._handles) > max(self.max_open, 1):
+                    evicted.append(self._handles.popitem(last=False)[1])
+            else:
+                self._handles.move_to_end(key)
+            self._leases[handle] = self._leases.get(handle, 0) + 1
+            idle = [old for old in evicted if old not in self._leases]
+            OPEN_DATABASES.set(len(self._handles))
+        for old in evicted:
+            DATABASE_EVICTIONS.inc()
+            self.logger.info(f"Evicting warm handle for {old.db_path}")
+        for old in idle:
+            self._close_handle(old)
+        return handle
+
+    def release(self, handle: AsyncOffGridDB):
+        """Return a lease; a retired handle is closed when its last lease is returned."""
+        with self._lock:
+            leases = self._leases.get(handle, 0) - 1
+            if leases > 0:
+                self._leases[handle] = leases
+                return
+            self._leases.pop(handle, None)
+            retired = self._handles.get(os.path.abspath(handle.db_path)) is not handle
+        if retired:
+            self._close_handle(handle)
+
+    @contextmanager
+    def lease(self, db_path: str, **kwargs) -> Iterator[AsyncOffGridDB]:
+        """Hold the handle for `db_path` for the duration of the block."""
+        handle = self.acquire(db_path, **kwargs)
+        try:
+            yield handle
+        finally:
+            self.release(handle)
+
+    def get(self, db_path: str, **kwargs) -> AsyncOffGridDB:
+        """Return the (warmed) handle for `db_path` without holding a lease on it."""
+        handle = self.acquire(db_path, **kwargs)
+        self.release(handle)
+        return handle
+
+    def open_paths(self) -> List[str]:
+        """Paths of the warm handles, least recently used first."""
+        with self._lock:
+            return list(self._handles)
+
+    def _close_handle(self, handle: AsyncOffGridDB):
+        """Close a retired handle off the caller's thread, dropping its pool and replica unless reopened."""
+        def close():
+            handle.close()
+            key = os.path.abspath(handle.db_path)
+            with self._lock:
+                reopened = key in self._handles
+            if not reopened:
+                ConnectionPool.close_path(key)
+                MemoryReplica.close_path(key)
+        threading.Thread(target=close, name="offgrid-evict", daemon=True).start()
+
+    def prewarm(self, paths: Iterable[str], **kwargs) -> List[str]:
+        """Open handles for up to `max_open` of `paths` and run a query on each; returns the warmed paths."""
+        warmed = []
+        for path in list(paths)[:self.max_open]:
+            try:
+                with self.lease(path, **kwargs) as handle:
+                    handle.run_blocking(False, OffGridDB.query, "SELECT COUNT(*) FROM levels")
+                warmed.append(path)
+            except Exception as e:
+                self.logger.error(f"Could not pre-warm {path}: {e}")
+        self.logger.info(f"Pre-warmed {len(warmed)} databases")
+        return warmed
+
+    def _run_on(self, db_path: str, fn: Callable, args: Tuple):
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"Database not found: {db_path}")
+        handle = self.acquire(db_path, create=False)
+        try:
+            with OffGridDB(db_path, pooled=handle is not None, replica=handle is not None and handle.replica) as db:
+                return fn(db, *args)
+        finally:
+            if handle is not None:
+                self.release(handle)
+
+    async def fan_out(self, paths: Iterable[str], fn: Callable, *args) -> List[Tuple[str, Any, Optional[str]]]:
+        """Run `fn(db, *args)` against every database in parallel.
+
+        Returns (path, result, error) per path in the given order; a failing
+        database yields its error message instead of failing the whole call.
+        """
+        with self._lock:
+            if self._fanout is None:
+                self._fanout = ThreadPoolExecutor(max_workers=self.fanout_workers, thread_name_prefix="offgrid-fanout")
+            pool = self._fanout
+        loop = asyncio.get_running_loop()
+
+        async def run(path: str) -> Tuple[str, Any, Optional[str]]:
+            try:
+                return path, await loop.run_in_executor(pool, self._run_on, path, fn, args), None
+            except Exception as e:
+                self.logger.error(f"Fan-out query failed for {path}: {e}")
+                return path, None, str(e)
+
+        return list(await asyncio.gather(*(run(path) for path in paths)))
+
+    def close_all(self):
+        """Close every handle and the fan-out threads, e.g. on application shutdown."""
+        with self._lock:
+            handles = list(self._handles.values())
+            self._handles.clear()
+            self._leases.clear()
+            fanout, self._fanout = self._fanout, None
+            OPEN_DATABASES.set(0)
+        for handle in handles:
+            handle.close()
+        if fanout is not None:
+            fanout.shutdown(wait=True)
+
+
+AsyncOffGridDB.registry = DatabaseRegistry()
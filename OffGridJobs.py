@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List, Dict, Any, Optional, Tuple, Callable
+
+from OffGridMetrics import metrics
+
+JOBS_DB = "offgrid_jobs.db"
+JOB_WORKERS = 2
+JOB_POLL_SECONDS = 1.0  # Idle workers re-check the table this often (new submissions wake them at once)
+PROGRESS_WRITE_SECONDS = 0.5  # Minimum interval between progress updates of one job
+
+JOBS_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        db_path TEXT NOT NULL,
+        params TEXT NOT NULL,
+        dedup_key TEXT NOT NULL,
+        status TEXT NOT NULL,
+        phase TEXT,
+        rows_done INTEGER NOT NULL DEFAULT 0,
+        rows_total INTEGER,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        updated_at REAL,
+        finished_at REAL,
+        result TEXT,
+        error TEXT
+    )""",
+    # At most one queued or running job per dedup key
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active ON jobs(dedup_key) WHERE status IN ('queued', 'running')",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(status, created_at)",
+]
+
+JOBS_FINISHED = metrics.counter("offgrid_jobs_total", "Background jobs finished, by kind and final status.", ["kind", "status"])
+JOB_SECONDS = metrics.histogram("offgrid_job_seconds", "Run time of background jobs.", ["kind"])
+
+# Handler signature: handler(job, progress) -> result dict, where progress(phase, rows_done, rows_total)
+JobHandler = Callable[[Dict[str, Any], Callable[[str, Optional[int], Optional[int]], None]], Dict[str, Any]]
+
+
+class JobQueue:
+    """Background jobs persisted in a local SQLite table and run by in-process worker threads.
+
+    submit() records a job and returns at once; a job with the same kind,
+    database and parameters that is still queued or running is returned
+    instead of a duplicate. Handlers report progress (phase, rows done,
+    rows total) which get() turns into a fraction and an ETA. Jobs left
+    running by a previous process are re-queued on start, so work survives
+    a restart (loads run in one transaction, so a re-run starts clean).
+    """
+
+    def __init__(self, path: str = JOBS_DB, handlers: Optional[Dict[str, JobHandler]] = None, workers: int = JOB_WORKERS):
+        """Open (creating if needed) the jobs database; workers start on start() or the first submit()."""
+        self.path = path
+        self.handlers: Dict[str, JobHandler] = dict(handlers or {})
+        self.workers = workers
+        self.conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        for sql in JOBS_SCHEMA:
+            self.conn.execute(sql)
+        self.conn.commit()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        """Re-queue jobs interrupted by a previous shutdown and start the worker threads (idempotent)."""
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping = False
+            interrupted = self.conn.execute(
+                "UPDATE jobs SET status = 'queued', phase = 'requeued', updated_at = ? WHERE status = 'running'",
+                (time.time(),)).rowcount
+            self.conn.commit()
+            if interrupted:
+                self.logger.warning(f"Re-queued {interrupted} interrupted jobs from {self.path}")
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"offgrid-job-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop the workers after their current job; unfinished jobs stay in the table."""
+        with self._lock:
+            self._stopping = True
+            threads, self._threads = self._threads, []
+            self._wake.notify_all()
+        for thread in threads:
+            thread.join(timeout)
+
+    def close(self):
+        """Stop the workers and close the jobs database."""
+        self.stop()
+        with self._lock:
+            self.conn.close()
+
+    def submit(self, kind: str, db_path: str, params: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        """Queue a job, returning (job, created); created is False when an identical active job exists."""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind '{kind}'")
+        self.start()
+        db_path = os.path.abspath(db_path)
+        params_json = json.dumps(params, sort_keys=True)
+        dedup_key = json.dumps([kind, db_path, params_json])
+        with self._lock:
+            while True:
+                existing = self.conn.execute(
+                    "SELECT id FROM jobs WHERE dedup_key = ? AND status IN ('queued', 'running')", (dedup_key,)).fetchone()
+                if existing is not None:
+                    job_id = existing["id"]
+                    break
+                job_id = uuid.uuid4().hex
+                try:
+                    self.conn.execute(
+                        "INSERT INTO jobs (id, kind, db_path, params, dedup_key, status, phase, created_at, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, 'queued', 'queued', ?, ?)",
+                        (job_id, kind, db_path, params_json, dedup_key, time.time(), time.time()))
+                except sqlite3.IntegrityError:
+                    # Another process sharing the jobs database queued the same job first; return that one
+                    self.conn.rollback()
+                    continue
+                self.conn.commit()
+                self._wake.notify()
+                self.logger.info(f"Queued {kind} job {job_id} for {db_path}")
+                break
+        return self.get(job_id), existing is None
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return a job's status, progress, ETA and result, or None if it does not exist."""
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {key: row[key] for key in ("id", "kind", "db_path", "status", "phase", "rows_done", "rows_total",
+                                         "attempts", "created_at", "started_at", "finished_at", "error")}
+        job["params"] = json.loads(row["params"])
+        job["result"] = json.loads(row["result"]) if row["result"] else None
+        job["progress"] = None
+        job["eta_seconds"] = None
+        if row["status"] == "succeeded":
+            job["progress"] = 1.0
+        elif row["rows_total"] and row["rows_done"]:
+            job["progress"] = round(min(row["rows_done"] / row["rows_total"], 1.0), 4)
+            if row["status"] == "running":
+                elapsed = time.time() - row["started_at"]
+                job["eta_seconds"] = round(elapsed * max(row["rows_total"] - row["rows_done"], 0) / row["rows_done"], 1)
+        return job
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        """Mark the oldest queued job running and return it (caller holds the lock)."""
+        now = time.time()
+        row = self.conn.execute(
+            "UPDATE jobs SET status = 'running', phase = 'starting', attempts = attempts + 1, started_at = ?, updated_at = ? "
+            "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1) "
+            "RETURNING id, kind, db_path, params", (now, now)).fetchone()
+        self.conn.commit()
+        return row
+
+    def _work(self):
+        while True:
+            with self._lock:
+                job = None
+                while not self._stopping:
+                    job = self._claim()
+                    if job is not None:
+                        break
+                    self._wake.wait(JOB_POLL_SECONDS)
+                if job is None:
+                    return
+            self._run(dict(job))
+
+    def _run(self, job: Dict[str, Any]):
+        job_id, kind = job["id"], job["kind"]
+        job["params"] = json.loads(job["params"])
+        last_write = [0.0, None]
+
+        def progress(phase: str, rows_done: Optional[int] = None, rows_total: Optional[int] = None):
+            now = time.monotonic()
+            if phase == last_write[1] and now - last_write[0] < PROGRESS_WRITE_SECONDS:
+                return
+            last_write[:] = [now, phase]
+            with self._lock:
+                self.conn.execute(
+                    "UPDATE jobs SET phase = ?, rows_done = COALESCE(?, rows_done), rows_total = COALESCE(?, rows_total), "
+                    "updated_at = ? WHERE id = ?", (phase, rows_done, rows_total, time.time(), job_id))
+                self.conn.commit()
+
+        self.logger.info(f"Running {kind} job {job_id}")
+        start = time.perf_counter()
+        status, result, error = "succeeded", None, None
+        try:
+            result = self.handlers[kind](job, progress)
+        except Exception as e:
+            status, error = "failed", str(e)
+            self.logger.error(f"{kind} job {job_id} failed: {e}")
+        JOB_SECONDS.observe(time.perf_counter() - start, kind)
+        JOBS_FINISHED.inc(1, kind, status)
+        rows = result.get("rows") if isinstance(result, dict) else None
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, phase = ?, result = ?, error = ?, finished_at = ?, updated_at = ?, "
+                "rows_done = COALESCE(?, rows_done), rows_total = COALESCE(?, rows_total) WHERE id = ?",
+                (status, "done" if status == "succeeded" else "failed", json.dumps(result) if result is not None else None,
+                 error, time.time(), time.time(), rows, rows, job_id))
+            self.conn.commit()
+        self.logger.info(f"{kind} job {job_id} {status}")
@@ -3,12 +3,21 @@ import sqlite3
 import json
 import os
 import time
+import asyncio
+import shutil
+import tempfile
+import threading
+from unittest import mock
 from datetime import datetime
 import pytest
 from httpx import Client
 from fastapi.testclient import TestClient
-from offgrid_api import app  # Import the FastAPI app
-from OffGridDB import OffGridDB
+from offgrid_api import app, close_jobs  # Import the FastAPI app
+from OffGridDB import OffGridDB, ConnectionPool, MemoryReplica, AsyncOffGridDB, QueueFullError, DatabaseRegistry
+from CatalogSchema import SchemaValidationError
+from OffGridJobs import JobQueue, JOBS_DB
+from BenchOffGridDB import write_catalog, compare
+import CodeEnumerator as code_enumerator
 
 class TestOffGridDB(unittest.TestCase):
     @classmethod
@@ -140,6 +149,152 @@ class TestOffGridDB(unittest.TestCase):
             self.log_result("test_load_json_invalid_data", "FAIL", f"Unexpected error: {str(e)}")
             self.fail(str(e))
 
+    def test_load_json_schema_errors(self):
+        """Test that every schema error is reported with its JSON path, for document and streaming loads."""
+        level = dict(self.test_json["levels"][0], level="1", monthly_costs=[{"name": "food"}, {"name": "fuel", "amount": 5}])
+        level["fixed_costs"] = [dict(level["fixed_costs"][0], total=True)]
+        del level["description"]
+        invalid_path = "test_offgrid_invalid.json"
+        with open(invalid_path, 'w') as f:
+            json.dump({"levels": [self.test_json["levels"][0], level]}, f)
+        expected = [
+            ("$.levels[1].level", "expected integer, got string"),
+            ("$.levels[1].description", "missing required field"),
+            ("$.levels[1].monthly_costs[0].amount", "missing required field"),
+            ("$.levels[1].fixed_costs[0].total", "expected number, got boolean"),
+        ]
+        try:
+            self.db.load_json(self.json_path, drop_if_exists=True)
+            for stream in (False, True):
+                with self.assertRaises(SchemaValidationError) as raised:
+                    self.db.load_json(invalid_path, stream=stream)
+                self.assertEqual(sorted(raised.exception.errors), sorted(expected))
+                self.assertEqual(self.db.query("SELECT COUNT(*) FROM monthly_costs")[0][0], 1, "Invalid catalog should not be loaded")
+            self.log_result("test_load_json_schema_errors", "PASS", "All schema errors reported in one pass")
+        except Exception as e:
+            self.log_result("test_load_json_schema_errors", "FAIL", f"Schema errors not reported: {str(e)}")
+            self.fail(str(e))
+        finally:
+            if os.path.exists(invalid_path):
+                os.remove(invalid_path)
+
+    def test_load_json_schema_errors_non_arrays(self):
+        """Test that cost lists that are not arrays, and levels that are not objects, fail alike in both load paths."""
+        level = dict(self.test_json["levels"][0], monthly_costs={"name": "food", "amount": 100}, fixed_costs="none")
+        invalid_path = "test_offgrid_invalid.json"
+        with open(invalid_path, 'w') as f:
+            json.dump({"levels": [self.test_json["levels"][0], level, 7]}, f)
+        expected = [
+            ("$.levels[1].monthly_costs", "expected array, got object"),
+            ("$.levels[1].fixed_costs", "expected array, got string"),
+            ("$.levels[2]", "expected an object"),
+        ]
+        try:
+            for stream in (False, True):
+                with self.assertRaises(SchemaValidationError) as raised:
+                    self.db.load_json(invalid_path, stream=stream)
+                self.assertEqual(sorted(raised.exception.errors), sorted(expected), f"stream={stream}")
+            self.log_result("test_load_json_schema_errors_non_arrays", "PASS", "Both load paths reported the same type errors")
+        except Exception as e:
+            self.log_result("test_load_json_schema_errors_non_arrays", "FAIL", f"Type errors differ between load paths: {str(e)}")
+            self.fail(str(e))
+        finally:
+            if os.path.exists(invalid_path):
+                os.remove(invalid_path)
+
+    def test_job_queue(self):
+        """Test job deduplication, progress reporting and resuming after a restart."""
+        jobs_path = "test_jobs.db"
+        release = threading.Event()
+
+        def handler(job, progress):
+            progress("insert", 5, 10)
+            release.wait(10)
+            return {"rows": 10, "value": job["params"]["value"]}
+
+        try:
+            queue = JobQueue(jobs_path, {"load": handler}, workers=1)
+            job, created = queue.submit("load", self.db_path, {"value": 1})
+            duplicate, duplicate_created = queue.submit("load", self.db_path, {"value": 1})
+            self.assertTrue(created)
+            self.assertEqual((duplicate["id"], duplicate_created), (job["id"], False), "Identical active jobs should be deduplicated")
+            for _ in range(100):
+                if queue.get(job["id"])["rows_done"] == 5:
+                    break
+                time.sleep(0.05)
+            running = queue.get(job["id"])
+            self.assertEqual((running["status"], running["phase"], running["progress"]), ("running", "insert", 0.5))
+            release.set()
+            for _ in range(100):
+                if queue.get(job["id"])["status"] == "succeeded":
+                    break
+                time.sleep(0.05)
+            done = queue.get(job["id"])
+            self.assertEqual((done["status"], done["result"]["value"], done["rows_done"]), ("succeeded", 1, 10))
+            queue.close()
+
+            # A job claimed by a process that then died is re-queued and run by the next one
+            crashed = JobQueue(jobs_path, {"load": handler}, workers=0)
+            job, _ = crashed.submit("load", self.db_path, {"value": 2})
+            with crashed._lock:
+                crashed._claim()
+            crashed.conn.close()
+            queue = JobQueue(jobs_path, {"load": handler}, workers=1)
+            queue.start()
+            for _ in range(100):
+                if queue.get(job["id"])["status"] == "succeeded":
+                    break
+                time.sleep(0.05)
+            self.assertEqual((queue.get(job["id"])["status"], queue.get(job["id"])["attempts"]), ("succeeded", 2))
+            queue.close()
+            self.log_result("test_job_queue", "PASS", "Jobs deduplicated, tracked and resumed after restart")
+        except Exception as e:
+            self.log_result("test_job_queue", "FAIL", f"Job queue failed: {str(e)}")
+            self.fail(str(e))
+        finally:
+            release.set()
+            for path in (jobs_path, jobs_path + "-wal", jobs_path + "-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_job_queue_shared_database_race(self):
+        """Test a submit that loses the dedup race to another process returns that process's job."""
+        jobs_path = "test_jobs.db"
+
+        class RacingConnection:
+            """Lets the other queue insert between this queue's dedup SELECT and its INSERT."""
+            def __init__(self, conn, race):
+                self.conn, self.race = conn, race
+
+            def execute(self, sql, params=()):
+                if self.race and sql.startswith("SELECT id FROM jobs WHERE dedup_key"):
+                    race, self.race = self.race, None
+                    race()
+                    return mock.Mock(fetchone=mock.Mock(return_value=None))
+                return self.conn.execute(sql, params)
+
+            def __getattr__(self, name):
+                return getattr(self.conn, name)
+
+        try:
+            first = JobQueue(jobs_path, {"load": lambda job, progress: {}}, workers=0)
+            second = JobQueue(jobs_path, {"load": lambda job, progress: {}}, workers=0)
+            winner = {}
+            first.conn = RacingConnection(first.conn, lambda: winner.update(second.submit("load", self.db_path, {"value": 1})[0]))
+            job, created = first.submit("load", self.db_path, {"value": 1})
+            self.assertEqual((job["id"], created), (winner["id"], False), "The losing submit should return the active job")
+            self.assertEqual(first.conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0], 1)
+            first.close()
+            second.close()
+            self.log_result("test_job_queue_shared_database_race", "PASS", "Lost dedup race returned the existing job")
+        except Exception as e:
+            self.log_result("test_job_queue_shared_database_race", "FAIL", f"Shared jobs database race failed: {str(e)}")
+            self.fail(str(e))
+        finally:
+            for path in (jobs_path, jobs_path + "-wal", jobs_path + "-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+
     def test_query(self):
         """Test custom query execution."""
         try:
@@ -164,6 +319,639 @@ class TestOffGridDB(unittest.TestCase):
             self.log_result("test_close", "FAIL", f"Closing connection failed: {str(e)}")
             self.fail(str(e))
 
+    def test_load_json_bulk(self):
+        """Test bulk loading with executemany and deferred index rebuild."""
+        try:
+            self.db.connect()
+            self.db.create_tables(drop_if_exists=True)
+            self.db.cursor.execute("CREATE INDEX test_fixed_name ON fixed_costs(name)")
+            self.db.conn.commit()
+            stats = self.db.load_json(self.json_path, bulk=True)
+            self.assertEqual(stats["rows"], 3, "Level, monthly and fixed rows should be counted")
+            self.assertEqual(stats["fixed_costs"], 1)
+            self.assertIn("rows_per_sec", stats)
+            result = self.db.query("SELECT name FROM fixed_costs WHERE level_id = ?", (1,))
+            self.assertEqual(result[0][0], "Test Item", "Fixed cost name should match")
+            indexes = self.db.query("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'test_fixed_name'")
+            self.assertEqual(len(indexes), 1, "Deferred index should be rebuilt after the load")
+            self.log_result("test_load_json_bulk", "PASS", f"Bulk load inserted {stats['rows']} rows")
+        except Exception as e:
+            self.log_result("test_load_json_bulk", "FAIL", f"Bulk load failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_load_json_stream(self):
+        """Test streaming load of a JSON document and of NDJSON levels."""
+        ndjson_path = "test_offgrid.ndjson"
+        try:
+            stats = self.db.load_json(self.json_path, drop_if_exists=True, stream=True)
+            self.assertEqual(stats["rows"], 3, "Level, monthly and fixed rows should be streamed")
+            second_level = dict(self.test_json["levels"][0], level=2, name="Second Level")
+            with open(ndjson_path, 'w') as f:
+                f.write(json.dumps(self.test_json["levels"][0]) + "\n" + json.dumps(second_level) + "\n")
+            stats = self.db.load_json(ndjson_path, drop_if_exists=True, stream=True)
+            self.assertEqual(stats["levels"], 2, "Each NDJSON line should load one level")
+            result = self.db.query("SELECT name FROM fixed_costs WHERE level_id = ?", (2,))
+            self.assertEqual(result[0][0], "Test Item", "Fixed cost name should match")
+            self.log_result("test_load_json_stream", "PASS", "Streaming JSON and NDJSON loaded successfully")
+        except Exception as e:
+            self.log_result("test_load_json_stream", "FAIL", f"Streaming load failed: {str(e)}")
+            self.fail(str(e))
+        finally:
+            if os.path.exists(ndjson_path):
+                os.remove(ndjson_path)
+
+    def test_query_plans_use_indexes(self):
+        """Test that level-filtered API queries never fall back to a full scan."""
+        try:
+            self.db.load_json(self.json_path, drop_if_exists=True)
+            scans = self.db.full_scans(level=1)
+            self.assertEqual(scans, {}, f"API queries should use indexes: {scans}")
+            self.log_result("test_query_plans_use_indexes", "PASS", "All level-filtered API queries use indexes")
+        except Exception as e:
+            self.log_result("test_query_plans_use_indexes", "FAIL", f"Query plan check failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_report_no_duplicates(self):
+        """Test the report lists each cost item once per level."""
+        self.test_json["levels"][0]["monthly_costs"].append({"name": "propane", "amount": 20})
+        self.test_json["levels"][0]["fixed_costs"].append(dict(self.test_json["levels"][0]["fixed_costs"][0], name="Second Item"))
+        with open(self.json_path, 'w') as f:
+            json.dump(self.test_json, f)
+        try:
+            self.db.load_json(self.json_path, drop_if_exists=True)
+            report = self.db.report(level=1)
+            self.assertIn("- **Monthly Costs**: food: 100.0,propane: 20.0\n", report)
+            self.assertIn("- **Fixed Costs**: Second Item: 50.0,Test Item: 50.0\n", report)
+            self.log_result("test_report_no_duplicates", "PASS", "Report lists each item once")
+        except Exception as e:
+            self.log_result("test_report_no_duplicates", "FAIL", f"Report duplication check failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_report_order_by_name(self):
+        """Test report entries are name-ordered whichever index the planner picks, without a sort step."""
+        self.test_json["levels"][0]["monthly_costs"] = [{"name": name, "amount": 10} for name in ("water", "food", "propane")]
+        with open(self.json_path, 'w') as f:
+            json.dump(self.test_json, f)
+        try:
+            self.db.load_json(self.json_path, drop_if_exists=True)
+            self.db.conn.execute("ANALYZE")
+            report = self.db.report(level=1)
+            self.assertIn("- **Monthly Costs**: food: 10.0,propane: 10.0,water: 10.0\n", report)
+            for name in ("monthly", "fixed"):
+                plan = " ".join(self.db.explain(*OffGridDB.report_queries(level=1)[name]))
+                self.assertNotIn("TEMP B-TREE", plan, f"{name} entries should come off the covering index in order")
+            self.log_result("test_report_order_by_name", "PASS", "Report entries were name-ordered from the covering index")
+        except Exception as e:
+            self.log_result("test_report_order_by_name", "FAIL", f"Report order check failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_load_json_delta(self):
+        """Test delta loads touch only changed rows."""
+        try:
+            self.db.load_json(self.json_path, drop_if_exists=True)
+            stats = self.db.load_json(self.json_path, delta=True)
+            self.assertEqual((stats["inserted"], stats["updated"], stats["deleted"], stats["unchanged"]), (0, 0, 0, 3))
+            self.test_json["levels"][0]["fixed_costs"][0]["unit_cost"] = 75
+            self.test_json["levels"][0]["monthly_costs"] = [{"name": "propane", "amount": 30}]
+            with open(self.json_path, 'w') as f:
+                json.dump(self.test_json, f)
+            stats = self.db.load_json(self.json_path, delta=True)
+            self.assertEqual((stats["inserted"], stats["updated"], stats["deleted"], stats["unchanged"]), (1, 1, 1, 1))
+            result = self.db.query("SELECT unit_cost FROM fixed_costs WHERE level_id = ?", (1,))
+            self.assertEqual(result[0][0], 75, "Changed price should be updated in place")
+            result = self.db.query("SELECT name FROM monthly_costs")
+            self.assertEqual([row[0] for row in result], ["propane"], "Removed item should be deleted")
+            self.log_result("test_load_json_delta", "PASS", "Delta load applied only the changed rows")
+        except Exception as e:
+            self.log_result("test_load_json_delta", "FAIL", f"Delta load failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_price_history(self):
+        """Test price changes are recorded append-only and read back as of a time."""
+        try:
+            day1, day2 = OffGridDB.parse_timestamp("2025-01-01"), OffGridDB.parse_timestamp("2025-02-01")
+            stats = self.db.load_json(self.json_path, drop_if_exists=True, effective_at=day1)
+            self.assertEqual(stats["history"], {"changed": 3, "removed": 0})
+            self.test_json["levels"][0]["fixed_costs"][0].update(unit_cost=75, total=75)
+            self.test_json["levels"][0]["monthly_costs"] = [{"name": "propane", "amount": 30}]
+            with open(self.json_path, 'w') as f:
+                json.dump(self.test_json, f)
+            stats = self.db.load_json(self.json_path, delta=True, effective_at=day2)
+            self.assertEqual(stats["history"], {"changed": 2, "removed": 1})
+            stats = self.db.load_json(self.json_path, drop_if_exists=True, bulk=True, effective_at=day2 + 60)
+            self.assertEqual(stats["history"], {"changed": 0, "removed": 0}, "An unchanged reload should add no history")
+            as_of = OffGridDB.parse_timestamp("2025-01-15", end_of_day=True)
+            rows = self.db.query(*OffGridDB.build_query("fixed", 1, fields=["name", "total"], as_of=as_of))
+            self.assertEqual([tuple(row) for row in rows], [("Test Item", 50.0)])
+            rows = self.db.query(*OffGridDB.build_query("monthly", as_of=as_of, fields=["name"]))
+            self.assertEqual([row[0] for row in rows], ["food"])
+            rows = self.db.query(*OffGridDB.build_query("monthly", fields=["name"], as_of=day2))
+            self.assertEqual([row[0] for row in rows], ["propane"])
+            self.assertIn("Test Item: 50.0", self.db.report(1, as_of=as_of))
+            trend = self.db.price_trend(seller="Test Seller")
+            self.assertEqual([(row["effective_at"], row["price"]) for row in trend], [(day1, 50.0), (day2, 75.0)])
+            trend = self.db.price_trend(name="food")
+            self.assertEqual([row["removed"] for row in trend], [0, 1], "A removed item should end with a tombstone")
+            with self.assertRaises(ValueError):
+                self.db.load_json(self.json_path, delta=True, effective_at=day1)
+            with self.assertRaises(ValueError):
+                OffGridDB.parse_timestamp("last tuesday")
+            self.log_result("test_price_history", "PASS", "Price history recorded changes and answered as-of queries")
+        except Exception as e:
+            self.log_result("test_price_history", "FAIL", f"Price history failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_aggregates_follow_triggers(self):
+        """Test rollup tables track inserts, updates and deletes."""
+        try:
+            self.db.load_json(self.json_path, drop_if_exists=True)
+            self.db.cursor.execute(
+                "INSERT INTO fixed_costs (level_id, name, units, unit_type, unit_cost, total, seller_source) VALUES (1, 'Panel', 2, 'panel', 100, 200, 'Renogy')"
+            )
+            self.db.cursor.execute("UPDATE fixed_costs SET total = 80 WHERE name = 'Test Item'")
+            self.db.cursor.execute("DELETE FROM monthly_costs")
+            self.db.conn.commit()
+            totals = dict(self.db.aggregates("level", level=1)[0])
+            self.assertEqual((totals["fixed_total"], totals["fixed_items"]), (280, 2))
+            self.assertEqual((totals["monthly_total"], totals["monthly_items"]), (0, 0))
+            sellers = {row["seller_source"]: row["fixed_total"] for row in self.db.aggregates("seller_source", level=1)}
+            self.assertEqual(sellers, {"Renogy": 200, "Test Seller": 80})
+            self.log_result("test_aggregates_follow_triggers", "PASS", "Rollups maintained by triggers")
+        except Exception as e:
+            self.log_result("test_aggregates_follow_triggers", "FAIL", f"Aggregate maintenance failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_search(self):
+        """Test full-text search follows inserts, updates and deletes."""
+        try:
+            self.db.load_json(self.json_path, drop_if_exists=True, bulk=True)
+            self.db.cursor.execute(
+                "INSERT INTO fixed_costs (level_id, name, units, unit_type, unit_cost, total, seller_source) VALUES (1, 'LiFePO4 Battery', 1, 'unit', 900, 900, 'Renogy')"
+            )
+            self.db.cursor.execute("UPDATE fixed_costs SET seller_source = 'Starlink' WHERE name = 'Test Item'")
+            self.db.conn.commit()
+            hits = self.db.search("lifep")
+            self.assertEqual([(row["kind"], row["name"], row["price"]) for row in hits], [("fixed", "LiFePO4 Battery", 900)])
+            self.assertEqual([row["name"] for row in self.db.search("star")], ["Test Item"])
+            self.assertEqual([row["name"] for row in self.db.search("foo", kind="monthly")], ["food"])
+            self.assertEqual(self.db.search("renogy", max_price=500), [])
+            self.db.cursor.execute("DELETE FROM fixed_costs WHERE name = 'LiFePO4 Battery'")
+            self.db.conn.commit()
+            self.assertEqual(self.db.search("renogy"), [])
+            self.log_result("test_search", "PASS", "Search index maintained by triggers")
+        except Exception as e:
+            self.log_result("test_search", "FAIL", f"Search failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_pooled_connection(self):
+        """Test pooled mode reuses a WAL-configured connection."""
+        try:
+            with OffGridDB(self.db_path, pooled=True) as first:
+                first.load_json(self.json_path, drop_if_exists=True)
+                conn = first.conn
+                journal_mode = first.query("PRAGMA journal_mode")[0][0]
+                synchronous = first.query("PRAGMA synchronous")[0][0]
+            self.assertEqual(journal_mode, "wal", "Pooled connections should use WAL mode")
+            self.assertEqual(synchronous, 1, "Pooled connections should use synchronous=NORMAL")
+            with OffGridDB(self.db_path, pooled=True) as second:
+                self.assertIs(second.conn, conn, "Released connection should be reused")
+                self.assertEqual(len(second.query("SELECT * FROM levels")), 1)
+            ConnectionPool.close_all()
+            self.log_result("test_pooled_connection", "PASS", "Pooled connection reused with WAL mode")
+        except Exception as e:
+            ConnectionPool.close_all()
+            self.log_result("test_pooled_connection", "FAIL", f"Pooled connection failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_async_facade(self):
+        """Test awaitable load/query and backpressure on a full read queue."""
+        async_db = AsyncOffGridDB(self.db_path, readers=1, max_pending_reads=1)
+        release = threading.Event()
+        try:
+            async def scenario():
+                await async_db.load_json(self.json_path, drop_if_exists=True)
+                rows = await async_db.query("SELECT * FROM fixed_costs WHERE level_id = ?", (1,))
+                self.assertEqual(rows[0]["name"], "Test Item", "Fixed cost name should match")
+                blocked = asyncio.ensure_future(async_db.run_read(lambda db: release.wait(5)))
+                await asyncio.sleep(0.05)
+                with self.assertRaises(QueueFullError):
+                    await async_db.query("SELECT * FROM levels")
+                release.set()
+                await blocked
+                self.assertEqual(len(await async_db.query("SELECT * FROM levels")), 1)
+            asyncio.run(scenario())
+            self.log_result("test_async_facade", "PASS", "Async facade served queries and applied backpressure")
+        except Exception as e:
+            self.log_result("test_async_facade", "FAIL", f"Async facade failed: {str(e)}")
+            self.fail(str(e))
+        finally:
+            release.set()
+            async_db.close()
+            ConnectionPool.close_all()
+
+    def test_benchmark_catalog(self):
+        """Test the benchmark catalog generator and regression comparison."""
+        catalog = "test_bench_catalog.json"
+        try:
+            counts = write_catalog(catalog, 25, seed=1)
+            with open(catalog) as f:
+                first = f.read()
+            write_catalog(catalog, 25, seed=1)
+            with open(catalog) as f:
+                self.assertEqual(f.read(), first, "Catalogs should be deterministic per seed")
+            stats = self.db.load_json(catalog, drop_if_exists=True, stream=True)
+            self.assertEqual((stats["monthly_costs"], stats["fixed_costs"]), (counts["monthly_costs"], counts["fixed_costs"]))
+            self.assertEqual(counts["monthly_costs"] + counts["fixed_costs"], 25)
+            baseline = {"benchmarks": {"25/load_bulk": {"p50": 1.0, "p95": 1.0, "rows_per_sec": 100, "peak_memory_bytes": 10}}}
+            results = {"benchmarks": {"25/load_bulk": {"p50": 1.5, "p95": 1.1, "rows_per_sec": 90, "peak_memory_bytes": 10}}}
+            self.assertEqual([(r["benchmark"], r["metric"]) for r in compare(results, baseline, 0.25)], [("25/load_bulk", "p50")])
+            self.log_result("test_benchmark_catalog", "PASS", f"Generated and loaded {stats['rows']} benchmark rows")
+        except Exception as e:
+            self.log_result("test_benchmark_catalog", "FAIL", f"Benchmark catalog failed: {str(e)}")
+            self.fail(str(e))
+        finally:
+            if os.path.exists(catalog):
+                os.remove(catalog)
+
+    def test_query_instrumentation(self):
+        """Test query timing, VM step counting, statement tracing and the slow-query log."""
+        from OffGridDB import QUERY_SECONDS, SLOW_QUERIES, STATEMENT_EXECUTIONS
+        threshold, tracing = OffGridDB.slow_query_seconds, OffGridDB.trace_statements
+        try:
+            OffGridDB.slow_query_seconds, OffGridDB.trace_statements = 0, True
+            self.db.load_json(self.json_path, drop_if_exists=True)
+            label = "SELECT * FROM fixed_costs WHERE level_id = ?"
+            count = QUERY_SECONDS.series.get((label,), [0, 0])[-2]
+            slow = SLOW_QUERIES.values.get((label,), 0)
+            with self.assertLogs("OffGridDB", level="WARNING") as logs:
+                self.db.query(label, (1,))
+            self.assertEqual(QUERY_SECONDS.series[(label,)][-2], count + 1)
+            self.assertEqual(SLOW_QUERIES.values[(label,)], slow + 1)
+            self.assertIn("idx_fixed_costs_level", logs.output[0], "Slow-query log should carry the plan")
+            self.db.close()
+            traced = [name for name in STATEMENT_EXECUTIONS.values if name[0].startswith("INSERT INTO fixed_costs")]
+            self.assertTrue(traced, "Traced statements should be recorded")
+            self.log_result("test_query_instrumentation", "PASS", "Query metrics and slow-query log recorded")
+        except Exception as e:
+            self.log_result("test_query_instrumentation", "FAIL", f"Query instrumentation failed: {str(e)}")
+            self.fail(str(e))
+        finally:
+            OffGridDB.slow_query_seconds, OffGridDB.trace_statements = threshold, tracing
+
+    def test_load_many(self):
+        """Test parallel directory/glob ingestion with per-file results."""
+        catalog_dir = "test_catalogs"
+        try:
+            os.makedirs(catalog_dir, exist_ok=True)
+            for i in (1, 2):
+                with open(os.path.join(catalog_dir, f"site{i}.json"), 'w') as f:
+                    json.dump({"levels": [dict(self.test_json["levels"][0], level=i, name=f"Site {i}")]}, f)
+            with open(os.path.join(catalog_dir, "broken.json"), 'w') as f:
+                json.dump({"levels": [{"level": 3}]}, f)
+            stats = self.db.load_many(os.path.join(catalog_dir, "*.json"), drop_if_exists=True, workers=2)
+            self.assertEqual((stats["levels"], stats["fixed_costs"], stats["failed"]), (2, 2, 1))
+            results = {os.path.basename(file["path"]): file for file in stats["files"]}
+            self.assertIn("missing required field", results["broken.json"]["error"])
+            self.assertEqual(results["site2.json"]["rows"], 3)
+            self.assertEqual([row["level"] for row in self.db.query("SELECT level FROM levels ORDER BY level")], [1, 2])
+            self.assertEqual(len(self.db.search("test")), 2, "Search index should be rebuilt after the load")
+            self.log_result("test_load_many", "PASS", f"Loaded {stats['rows']} rows from {len(stats['files'])} catalogs")
+        except Exception as e:
+            self.log_result("test_load_many", "FAIL", f"Multi-file load failed: {str(e)}")
+            self.fail(str(e))
+        finally:
+            for name in ("site1.json", "site2.json", "broken.json"):
+                path = os.path.join(catalog_dir, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            if os.path.isdir(catalog_dir):
+                os.rmdir(catalog_dir)
+
+    def test_query_builder(self):
+        """Test pushed-down filters, sort and projection in build_query."""
+        try:
+            self.test_json["levels"][0]["fixed_costs"] = [
+                {"name": "Panel", "units": 2, "unit_type": "panel", "unit_cost": 150, "total": 300, "seller_source": "Renogy"},
+                {"name": "Battery", "units": 1, "unit_type": "battery", "unit_cost": 900, "total": 900, "seller_source": "Renogy"},
+                {"name": "Dish", "units": 1, "unit_type": "unit", "unit_cost": 500, "total": 500, "seller_source": "Starlink"},
+            ]
+            with open(self.json_path, 'w') as f:
+                json.dump(self.test_json, f)
+            self.db.load_json(self.json_path, drop_if_exists=True)
+            sql, params = OffGridDB.build_query("fixed", 1, filters={"seller": "Renogy", "min_total": 400}, sort="-total",
+                                                fields=["name", "total"])
+            self.assertNotIn("Renogy", sql, "Filter values must be bound, not inlined")
+            self.assertEqual([tuple(row) for row in self.db.query(sql, params)], [("Battery", 900)])
+            sql, params = OffGridDB.build_query("fixed", sort="-total", limit=2, fields=["name"])
+            self.assertEqual([row["name"] for row in self.db.query(sql, params)], ["Battery", "Dish"])
+            self.assertEqual(OffGridDB.build_query("fixed", 1, filters={"seller": "A"})[0],
+                             OffGridDB.build_query("fixed", 2, filters={"seller": "B"})[0], "Same shape, same statement")
+            for bad in ({"filters": {"seller": "x"}, "query_type": "monthly"}, {"sort": "total; DROP TABLE levels"},
+                        {"fields": ["name", "1 AS x"]}, {"sort": "-id", "after": 1}):
+                with self.assertRaises(ValueError):
+                    OffGridDB.build_query(bad.pop("query_type", "fixed"), **bad)
+            self.log_result("test_query_builder", "PASS", "Query builder pushed filters into SQL")
+        except Exception as e:
+            self.log_result("test_query_builder", "FAIL", f"Query builder failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_database_registry(self):
+        """Test LRU eviction of warm handles, leases and cross-database fan-out."""
+        registry = DatabaseRegistry(max_open=2)
+        paths = [f"test_site{i}.db" for i in range(3)]
+        try:
+            for i, path in enumerate(paths):
+                with open(self.json_path, 'w') as f:
+                    json.dump({"levels": [dict(self.test_json["levels"][0], level=i + 1)]}, f)
+                with OffGridDB(path) as db:
+                    db.load_json(self.json_path, drop_if_exists=True)
+            held = registry.acquire(paths[0])
+            registry.get(paths[1])
+            registry.get(paths[2])
+            self.assertEqual(registry.open_paths(), [os.path.abspath(path) for path in paths[1:]], "Oldest handle should be evicted")
+            rows = asyncio.run(held.query("SELECT COUNT(*) AS n FROM levels"))
+            self.assertEqual(rows[0]["n"], 1, "A leased handle should stay usable after eviction")
+            registry.release(held)
+
+            async def fan_out():
+                return await registry.fan_out(paths + ["missing.db"], OffGridDB.query, "SELECT level FROM levels", ())
+            results = asyncio.run(fan_out())
+            self.assertEqual([result[0]["level"] for _, result, _ in results[:3]], [1, 2, 3])
+            self.assertIn("not found", results[3][2])
+            self.assertFalse(os.path.exists("missing.db"), "Fan-out should not create missing databases")
+            self.log_result("test_database_registry", "PASS", "Registry evicted, leased and fanned out correctly")
+        except Exception as e:
+            self.log_result("test_database_registry", "FAIL", f"Registry failed: {str(e)}")
+            self.fail(str(e))
+        finally:
+            registry.close_all()
+            ConnectionPool.close_all()
+            for path in paths:
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+
+    def test_memory_replica(self):
+        """Test replica reads are isolated from the file until a load swaps them."""
+        try:
+            self.db.load_json(self.json_path, drop_if_exists=True)
+            with OffGridDB(self.db_path, replica=True) as reader:
+                self.assertEqual(reader.query("SELECT name FROM levels")[0]["name"], "Test Level")
+                with self.assertRaises(Exception):
+                    reader.query("DELETE FROM levels")
+                self.test_json["levels"][0]["name"] = "Reloaded Level"
+                with open(self.json_path, 'w') as f:
+                    json.dump(self.test_json, f)
+                self.db.load_json(self.json_path, drop_if_exists=True, bulk=True)
+                # A connection checked out before the swap keeps its consistent copy
+                self.assertEqual(reader.query("SELECT name FROM levels")[0]["name"], "Test Level")
+            with OffGridDB(self.db_path, replica=True) as reader:
+                self.assertEqual(reader.query("SELECT name FROM levels")[0]["name"], "Reloaded Level")
+                self.assertEqual(len(reader.search("test")), 1, "Replica should carry the search index")
+            self.log_result("test_memory_replica", "PASS", "Replica swapped after load")
+        except Exception as e:
+            self.log_result("test_memory_replica", "FAIL", f"Memory replica failed: {str(e)}")
+            self.fail(str(e))
+        finally:
+            MemoryReplica.close_all()
+
+class TestCodeEnumerator(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        """Initialize class-level test results, reusing TestOffGridDB's results."""
+        if not hasattr(TestOffGridDB, 'test_results'):
+            TestOffGridDB.test_results = []
+        cls.test_results = TestOffGridDB.test_results
+
+    def setUp(self):
+        """Build a small project tree in a temp directory and run from there (header/footer files are read from the CWD)."""
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp(prefix="test_code_enumerator_")
+        os.chdir(self.tmp)
+        for name, text in (("header.txt", "HEADER"), ("footer.txt", "FOOTER"), ("additional.txt", "EXTRA")):
+            self.write(name, text)
+        self.root = "project"
+        self.write("project/.gitignore", "venv/\n*.log\n")
+        self.write("project/main.py", 'print("main")\n')
+        self.write("project/sub/util.py", "def util():\n    return 1\n")
+        self.write("project/sub/deep/data.json", '{"a": 1}')
+        self.write("project/venv/lib/site.py", "x = 1\n")
+        self.write("project/debug.log", "noise")
+
+    def tearDown(self):
+        """Remove the temp tree."""
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def write(self, rel_path, text):
+        os.makedirs(os.path.dirname(rel_path) or ".", exist_ok=True)
+        with open(rel_path, "w") as f:
+            f.write(text)
+
+    def log_result(self, test_name, status, message):
+        """Log test result, reusing TestOffGridDB's method."""
+        result = {"test": test_name, "status": status, "message": message, "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        self.test_results.append(result)
+        print(f"Test: {test_name} | Status: {status} | Message: {message}")
+
+    def test_walk_prunes_ignored_directories(self):
+        """Test ignored directories and .git are never entered."""
+        try:
+            self.write("project/.git/hooks/pre_commit.py", "pass\n")
+            scanned = []
+            real_scandir = os.scandir
+
+            def recording_scandir(path):
+                scanned.append(os.path.relpath(path, self.root))
+                return real_scandir(path)
+
+            with mock.patch.object(code_enumerator.os, "scandir", side_effect=recording_scandir):
+                files = code_enumerator.CodeEnumerator(self.root, ['.json']).get_relevant_files()
+            self.assertEqual(scanned, [".", "sub", os.path.join("sub", "deep")], "Only non-ignored directories should be scanned")
+            self.assertEqual([os.path.relpath(path, self.root) for path in files],
+                             ["main.py", os.path.join("sub", "util.py"), os.path.join("sub", "deep", "data.json")])
+            self.log_result("test_walk_prunes_ignored_directories", "PASS", "venv/ and .git were never entered")
+        except Exception as e:
+            self.log_result("test_walk_prunes_ignored_directories", "FAIL", f"Directory pruning failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_walk_order(self):
+        """Test files are listed sorted, each directory's files before its subdirectories."""
+        try:
+            self.write("project/z_last.py", "")
+            self.write("project/a_dir/a.py", "")
+            self.write("project/sub/b.py", "")
+            expected = ["main.py", "z_last.py", os.path.join("a_dir", "a.py"), os.path.join("sub", "b.py"),
+                        os.path.join("sub", "util.py"), os.path.join("sub", "deep", "data.json")]
+            for _ in range(2):
+                files = code_enumerator.CodeEnumerator(self.root, ['.json']).get_relevant_files()
+                self.assertEqual([os.path.relpath(path, self.root) for path in files], expected)
+            self.log_result("test_walk_order", "PASS", "Walk order was deterministic with files before subdirectories")
+        except Exception as e:
+            self.log_result("test_walk_order", "FAIL", f"Walk order check failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_generate_output_unchanged(self):
+        """Test the streamed summary is byte-identical to the output of the original os.walk implementation."""
+        expected = ('Folder Tree:\n|-- main.py\n|-- sub/\n  |-- deep/\n    |-- data.json\n  |-- util.py\n\nHEADER\n\n'
+                    'main.py\n```python\nprint("main")\n\n```\n\n'
+                    'sub/util.py\n```python\ndef util():\n    return 1\n\n```\n\n'
+                    'sub/deep/data.json\n```json\n{"a": 1}\n```\n\nFOOTER\n\n\'EXTRA\'')
+        try:
+            enumerator = code_enumerator.CodeEnumerator(self.root, ['.json'], workers=2)
+            self.assertEqual(enumerator.generate_output(), expected)
+            with open("summary.md", "w") as f:
+                enumerator.write_output(f)
+            with open("summary.md") as f:
+                self.assertEqual(f.read(), expected, "write_output should stream the same bytes")
+            self.log_result("test_generate_output_unchanged", "PASS", "Summary output matched the original implementation")
+        except Exception as e:
+            self.log_result("test_generate_output_unchanged", "FAIL", f"Summary output changed: {str(e)}")
+            self.fail(str(e))
+
+    def test_write_summary_replaces_atomically(self):
+        """Test a failed run keeps the previous summary and a successful one never scans its own output."""
+        try:
+            output_path = os.path.join(self.root, "code_summary.md")
+            self.write(output_path, "OLD SUMMARY")
+            enumerator = code_enumerator.CodeEnumerator(self.root, ['.json', '.md'], workers=2, output_path=output_path)
+            self.assertNotIn(os.path.abspath(output_path), [os.path.abspath(path) for path in enumerator.get_relevant_files()],
+                             "The summary file should never be scanned")
+
+            os.remove("header.txt")
+            with self.assertRaises(FileNotFoundError):
+                enumerator.write_summary()
+            self.write("header.txt", "HEADER")
+            with mock.patch.object(enumerator, "_code_block", side_effect=OSError("read failed")):
+                with self.assertRaises(OSError):
+                    enumerator.write_summary()
+            with open(output_path) as f:
+                self.assertEqual(f.read(), "OLD SUMMARY", "A failed run should leave the previous summary in place")
+            self.assertEqual(sorted(os.listdir(self.root)), [".gitignore", "code_summary.md", "debug.log", "main.py", "sub", "venv"],
+                             "A failed run should not leave temp files behind")
+
+            enumerator.write_summary()
+            with open(output_path) as f:
+                self.assertEqual(f.read(), enumerator.generate_output())
+            self.log_result("test_write_summary_replaces_atomically", "PASS", "Summary was replaced only after a complete run")
+        except Exception as e:
+            self.log_result("test_write_summary_replaces_atomically", "FAIL", f"Summary replacement failed: {str(e)}")
+            self.fail(str(e))
+
+    def age(self, *rel_paths, seconds=60):
+        """Backdate files so the manifest trusts their mtime instead of treating it as racy."""
+        past = time.time() - seconds
+        for rel_path in rel_paths:
+            os.utime(rel_path, (past, past))
+
+    def cached_pass(self, enumerator):
+        """Run a full cached pass, returning the blocks and the paths that had to be re-rendered."""
+        rendered = []
+        real_code_block = enumerator._code_block
+
+        def recording_code_block(file_path):
+            rendered.append(os.path.relpath(file_path, self.root))
+            return real_code_block(file_path)
+
+        with mock.patch.object(enumerator, "_code_block", side_effect=recording_code_block):
+            blocks = list(enumerator.iter_code_blocks())
+        return blocks, sorted(rendered)
+
+    def manifest(self, cache_path, root=None):
+        """Return {path: mtime_ns} for the manifest rows of root (default: the test project)."""
+        conn = sqlite3.connect(cache_path)
+        try:
+            return dict(conn.execute("SELECT path, mtime_ns FROM manifest WHERE root = ?",
+                                     (os.path.abspath(root or self.root),)).fetchall())
+        finally:
+            conn.close()
+
+    def test_summary_cache_hits_and_misses(self):
+        """Test unchanged files are served from the manifest and size or mtime changes force a re-read."""
+        try:
+            files = ["project/main.py", "project/sub/util.py", "project/sub/deep/data.json"]
+            self.age(*files)
+            enumerator = code_enumerator.CodeEnumerator(self.root, ['.json'], workers=2, cache_path="cache.db")
+            self.assertEqual(enumerator.cache_path, os.path.join(self.root, "cache.db"), "Relative cache paths should resolve under the root")
+            first, rendered = self.cached_pass(enumerator)
+            self.assertEqual(len(rendered), 3, "A cold cache should render every file")
+            second, rendered = self.cached_pass(enumerator)
+            self.assertEqual(rendered, [], "Unchanged files should all be cache hits")
+            self.assertEqual(second, first, "Cached blocks should match the rendered ones")
+
+            self.write("project/sub/util.py", "def util():\n    return 22\n")  # size change
+            self.age("project/sub/util.py")
+            self.write("project/main.py", 'print("MAIN")\n')  # same size, only the mtime moves
+            self.age("project/main.py", seconds=30)
+            third, rendered = self.cached_pass(enumerator)
+            self.assertEqual(rendered, ["main.py", os.path.join("sub", "util.py")], "Changed files should be re-read")
+            self.assertIn('print("MAIN")', third[0])
+            self.assertIn("return 22", third[1])
+            self.assertEqual(third[2], first[2])
+            self.log_result("test_summary_cache_hits_and_misses", "PASS", "Manifest hits and misses followed size and mtime")
+        except Exception as e:
+            self.log_result("test_summary_cache_hits_and_misses", "FAIL", f"Manifest hit/miss check failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_summary_cache_racy_mtime(self):
+        """Test a file written just before the pass is stored with mtime -1 and re-read next time."""
+        try:
+            self.age("project/sub/util.py", "project/sub/deep/data.json")  # main.py stays freshly written
+            cache_path = os.path.join(self.tmp, "cache.db")
+            enumerator = code_enumerator.CodeEnumerator(self.root, ['.json'], workers=2, cache_path=cache_path)
+            self.cached_pass(enumerator)
+            rows = self.manifest(cache_path)
+            self.assertEqual(rows["main.py"], -1, "A racy mtime should not be trusted")
+            self.assertNotEqual(rows[os.path.join("sub", "util.py")], -1)
+            _, rendered = self.cached_pass(enumerator)
+            self.assertEqual(rendered, ["main.py"], "Only the racy file should be re-read")
+            self.log_result("test_summary_cache_racy_mtime", "PASS", "Racy file was re-read on the next pass")
+        except Exception as e:
+            self.log_result("test_summary_cache_racy_mtime", "FAIL", f"Racy mtime check failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_summary_cache_pruning(self):
+        """Test deleted files are pruned after a complete pass but kept when the pass is cut short."""
+        try:
+            self.age("project/main.py", "project/sub/util.py", "project/sub/deep/data.json")
+            cache_path = os.path.join(self.tmp, "cache.db")
+            enumerator = code_enumerator.CodeEnumerator(self.root, ['.json'], workers=2, cache_path=cache_path)
+            self.cached_pass(enumerator)
+
+            os.remove("project/sub/deep/data.json")
+            blocks = enumerator.iter_code_blocks()
+            next(blocks)
+            blocks.close()
+            self.assertIn(os.path.join("sub", "deep", "data.json"), self.manifest(cache_path),
+                          "An interrupted pass should not prune entries")
+
+            self.cached_pass(enumerator)
+            self.assertEqual(sorted(self.manifest(cache_path)), ["main.py", os.path.join("sub", "util.py")],
+                             "A complete pass should prune deleted files")
+            self.log_result("test_summary_cache_pruning", "PASS", "Deleted files were pruned only after a complete pass")
+        except Exception as e:
+            self.log_result("test_summary_cache_pruning", "FAIL", f"Manifest pruning check failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_summary_cache_separate_roots(self):
+        """Test two roots sharing one cache file keep separate manifest entries."""
+        try:
+            self.write("other/main.py", 'print("other")\n')
+            self.age("project/main.py", "project/sub/util.py", "project/sub/deep/data.json", "other/main.py")
+            cache_path = os.path.join(self.tmp, "cache.db")
+            project = code_enumerator.CodeEnumerator(self.root, ['.json'], workers=2, cache_path=cache_path)
+            other = code_enumerator.CodeEnumerator("other", workers=2, cache_path=cache_path)
+            project_blocks, _ = self.cached_pass(project)
+            other_blocks, _ = self.cached_pass(other)
+            self.assertEqual(other_blocks, ['main.py\n```python\nprint("other")\n\n```'], "Another root must not reuse this root's blocks")
+            self.assertEqual(len(self.manifest(cache_path)), 3, "A complete pass of another root should not prune this root")
+            blocks, rendered = self.cached_pass(project)
+            self.assertEqual((blocks, rendered), (project_blocks, []))
+            self.log_result("test_summary_cache_separate_roots", "PASS", "Roots kept separate manifest entries")
+        except Exception as e:
+            self.log_result("test_summary_cache_separate_roots", "FAIL", f"Shared cache check failed: {str(e)}")
+            self.fail(str(e))
+
 class TestOffGridAPI(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -197,7 +985,12 @@ class TestOffGridAPI(unittest.TestCase):
 
     def tearDown(self):
         """Clean up test environment."""
-        for path in [self.db_path, self.json_path, "test_report.md"]:
+        close_jobs()
+        AsyncOffGridDB.close_all()
+        MemoryReplica.close_all()
+        ConnectionPool.close_all()  # Release pooled handles before deleting the database
+        for path in [self.db_path, self.db_path + "-wal", self.db_path + "-shm", self.json_path, "test_report.md",
+                     JOBS_DB, JOBS_DB + "-wal", JOBS_DB + "-shm"]:
             if os.path.exists(path):
                 try:
                     os.remove(path)
@@ -221,6 +1014,52 @@ class TestOffGridAPI(unittest.TestCase):
             self.log_result("test_api_load", "FAIL", f"API load failed: {str(e)}")
             self.fail(str(e))
 
+    def test_api_load_schema_errors(self):
+        """Test that the API load endpoint returns 422 with every schema error."""
+        try:
+            with open(self.json_path, 'w') as f:
+                json.dump({"levels": [{"level": 1, "name": "Test"}]}, f)
+            response = self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true")
+            self.assertEqual(response.status_code, 422, f"Expected 422: {response.text}")
+            errors = response.json()["detail"]["errors"]
+            self.assertEqual(len(errors), 5, "Each missing level field should be reported")
+            self.assertIn({"path": "$.levels[0].description", "message": "missing required field"}, errors)
+            self.log_result("test_api_load_schema_errors", "PASS", "Schema errors returned as 422")
+        except Exception as e:
+            self.log_result("test_api_load_schema_errors", "FAIL", f"API schema errors failed: {str(e)}")
+            self.fail(str(e))
+
+    def wait_for_job(self, job_id):
+        """Poll /jobs/{id} until the job has finished."""
+        for _ in range(200):
+            job = self.client.get(f"/jobs/{job_id}").json()
+            if job["status"] not in ("queued", "running"):
+                return job
+            time.sleep(0.05)
+        self.fail(f"Job {job_id} did not finish")
+
+    def test_api_background_jobs(self):
+        """Test background /load and /report jobs polled through /jobs/{id}."""
+        try:
+            response = self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true&background=true")
+            self.assertEqual(response.status_code, 202, f"Background load failed: {response.text}")
+            self.assertEqual(response.headers["location"], response.json()["location"])
+            job = self.wait_for_job(response.json()["job_id"])
+            self.assertEqual(job["status"], "succeeded", f"Load job failed: {job['error']}")
+            self.assertEqual((job["result"]["stats"]["levels"], job["rows_done"], job["progress"]), (1, 3, 1.0))
+
+            response = self.client.get(f"/report?db={self.db_path}&output=test_report.md&background=true")
+            self.assertEqual(response.status_code, 202, f"Background report failed: {response.text}")
+            job = self.wait_for_job(response.json()["job_id"])
+            self.assertEqual(job["status"], "succeeded", f"Report job failed: {job['error']}")
+            with open(job["result"]["location"]) as f:
+                self.assertIn("Test Level", f.read())
+            self.assertEqual(self.client.get("/jobs/missing").status_code, 404)
+            self.log_result("test_api_background_jobs", "PASS", "Background load and report jobs completed")
+        except Exception as e:
+            self.log_result("test_api_background_jobs", "FAIL", f"Background jobs failed: {str(e)}")
+            self.fail(str(e))
+
     def test_api_query_levels(self):
         """Test API query levels endpoint."""
         try:
@@ -272,11 +1111,230 @@ class TestOffGridAPI(unittest.TestCase):
             with open("test_report.md", "r") as f:
                 content = f.read()
                 self.assertIn("Test Level", content, "Report should contain level name")
+            # A cache hit still writes the output with a freshly stamped header
+            with mock.patch.object(OffGridDB, "report_header", return_value="# Fresh header\n\n"):
+                response = self.client.get(f"/report?db={self.db_path}&output=test_report.md")
+            with open("test_report.md", "r") as f:
+                cached = f.read()
+            self.assertEqual(cached, response.json()["report"])
+            self.assertEqual(cached, "# Fresh header\n\n" + content[content.index("## Level"):])
             self.log_result("test_api_report", "PASS", "API report endpoint executed successfully")
         except Exception as e:
             self.log_result("test_api_report", "FAIL", f"API report failed: {str(e)}")
             self.fail(str(e))
 
+    def test_api_report_stream(self):
+        """Test API report endpoint in streaming mode."""
+        try:
+            self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true")
+            response = self.client.get(f"/report?db={self.db_path}&output=test_report.md&stream=true")
+            self.assertEqual(response.status_code, 200, f"API report stream failed: {response.text}")
+            self.assertTrue(response.headers["content-type"].startswith("text/markdown"))
+            self.assertIn("## Level 1: Test Level", response.text, "Streamed report should contain level")
+            with open("test_report.md", "r") as f:
+                self.assertEqual(f.read(), response.text, "Streamed report should also be written to output")
+            self.log_result("test_api_report_stream", "PASS", "API report streamed successfully")
+        except Exception as e:
+            self.log_result("test_api_report_stream", "FAIL", f"API report stream failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_api_query_cache(self):
+        """Test cached query responses carry validators and are invalidated by a load."""
+        try:
+            self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true")
+            first = self.client.get(f"/query/levels?db={self.db_path}")
+            self.assertEqual(first.status_code, 200, f"API query failed: {first.text}")
+            etag = first.headers["etag"]
+            self.assertIn("last-modified", first.headers)
+            repeat = self.client.get(f"/query/levels?db={self.db_path}", headers={"If-None-Match": etag})
+            self.assertEqual(repeat.status_code, 304, "Unchanged data should return 304")
+            self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true")
+            reloaded = self.client.get(f"/query/levels?db={self.db_path}", headers={"If-None-Match": etag})
+            self.assertEqual(reloaded.status_code, 200, "A load should invalidate the cached result")
+            self.assertNotEqual(reloaded.headers["etag"], etag)
+            self.log_result("test_api_query_cache", "PASS", "Query cache served 304 and was invalidated by load")
+        except Exception as e:
+            self.log_result("test_api_query_cache", "FAIL", f"API query cache failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_api_query_pagination(self):
+        """Test keyset pagination and NDJSON streaming of query results."""
+        try:
+            with open(self.json_path) as f:
+                data = json.load(f)
+            item = data["levels"][0]["fixed_costs"][0]
+            data["levels"][0]["fixed_costs"] = [dict(item, name=f"Item {i}") for i in range(5)]
+            with open(self.json_path, 'w') as f:
+                json.dump(data, f)
+            self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true")
+            names, after = [], None
+            while True:
+                url = f"/query/fixed?db={self.db_path}&level=1&limit=2" + (f"&after={after}" if after else "")
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200, f"API query page failed: {response.text}")
+                names.extend(row["name"] for row in response.json())
+                after = response.headers.get("x-next-after")
+                if not after:
+                    break
+            self.assertEqual(names, [f"Item {i}" for i in range(5)], "Pages should walk every row once in key order")
+            response = self.client.get(f"/query/fixed?db={self.db_path}", headers={"Accept": "application/x-ndjson"})
+            self.assertTrue(response.headers["content-type"].startswith("application/x-ndjson"))
+            lines = [json.loads(line) for line in response.text.splitlines()]
+            self.assertEqual(len(lines), 5, "NDJSON stream should contain one line per row")
+            self.log_result("test_api_query_pagination", "PASS", "Keyset pages and NDJSON stream returned every row")
+        except Exception as e:
+            self.log_result("test_api_query_pagination", "FAIL", f"API query pagination failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_api_query_sites(self):
+        """Test /query fan-out across several databases."""
+        other_db, other_json = "test_offgrid_site2.db", "test_offgrid_site2.json"
+        try:
+            with open(self.json_path) as f:
+                catalog = json.load(f)
+            catalog["levels"][0].update(level=2, name="Second Site")
+            with open(other_json, 'w') as f:
+                json.dump(catalog, f)
+            self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true")
+            self.client.post(f"/load?json_path={other_json}&db={other_db}&drop=true")
+            response = self.client.get(f"/query/levels?sites={self.db_path},{other_db}&sort=-level&fields=name")
+            self.assertEqual(response.status_code, 200, f"Fan-out query failed: {response.text}")
+            body = response.json()
+            self.assertEqual((body["sites"], body["errors"]), (2, {}))
+            self.assertEqual([(row["site"], row["name"]) for row in body["rows"]],
+                             [(other_db, "Second Site"), (self.db_path, "Test Level")])
+            response = self.client.get(f"/query/levels?sites={self.db_path}&after=1")
+            self.assertEqual(response.status_code, 400, "after should be rejected with sites")
+            self.log_result("test_api_query_sites", "PASS", "Fan-out query merged rows from both databases")
+        except Exception as e:
+            self.log_result("test_api_query_sites", "FAIL", f"Fan-out query failed: {str(e)}")
+            self.fail(str(e))
+        finally:
+            AsyncOffGridDB.close_all()
+            ConnectionPool.close_all()
+            for path in (other_db, other_db + "-wal", other_db + "-shm", other_json):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_api_price_history(self):
+        """Test as_of on /query and /report and the /prices/trend endpoint."""
+        try:
+            self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true&effective_at=2025-01-01")
+            with open(self.json_path) as f:
+                catalog = json.load(f)
+            catalog["levels"][0]["fixed_costs"][0].update(unit_cost=60, total=60)
+            with open(self.json_path, 'w') as f:
+                json.dump(catalog, f)
+            response = self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&delta=true&effective_at=2025-03-01T12:00:00Z")
+            self.assertEqual(response.status_code, 200, f"Delta load failed: {response.text}")
+            response = self.client.get(f"/query/fixed?db={self.db_path}&fields=total&as_of=2025-02-01")
+            self.assertEqual(response.json(), [{"total": 50.0}])
+            response = self.client.get(f"/query/fixed?db={self.db_path}&fields=total")
+            self.assertEqual(response.json(), [{"total": 60.0}])
+            response = self.client.get(f"/report?db={self.db_path}&output=test_report.md&as_of=2025-02-01")
+            self.assertIn("Test Item: 50.0", response.json()["report"])
+            response = self.client.get(f"/prices/trend?db={self.db_path}&seller=Test Seller")
+            self.assertEqual(response.status_code, 200, f"Price trend failed: {response.text}")
+            points = response.json()["items"][0]["points"]
+            self.assertEqual([(point["effective_at"], point["price"]) for point in points],
+                             [("2025-01-01T00:00:00+00:00", 50.0), ("2025-03-01T12:00:00+00:00", 60.0)])
+            self.assertEqual(self.client.get(f"/prices/trend?db={self.db_path}").status_code, 400)
+            self.assertEqual(self.client.get(f"/query/fixed?db={self.db_path}&as_of=soon").status_code, 400)
+            response = self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&delta=true&effective_at=2025-02-01")
+            self.assertEqual(response.status_code, 400, "A load dated before the latest change should be rejected")
+            self.log_result("test_api_price_history", "PASS", "As-of queries and price trends returned the recorded prices")
+        except Exception as e:
+            self.log_result("test_api_price_history", "FAIL", f"Price history API failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_api_query_filters(self):
+        """Test API query filters, sort and projection."""
+        try:
+            self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true")
+            response = self.client.get(f"/query/fixed?db={self.db_path}&seller=Test Seller&max_total=60&fields=name,total&sort=-total")
+            self.assertEqual(response.status_code, 200, f"API query failed: {response.text}")
+            self.assertEqual(response.json(), [{"name": "Test Item", "total": 50.0}])
+            response = self.client.get(f"/query/fixed?db={self.db_path}&unit_type=panel")
+            self.assertEqual(response.json(), [])
+            response = self.client.get(f"/query/monthly?db={self.db_path}&seller=Test Seller")
+            self.assertEqual(response.status_code, 400, "Expected 400 status for unsupported filter")
+            self.log_result("test_api_query_filters", "PASS", "API query filters executed successfully")
+        except Exception as e:
+            self.log_result("test_api_query_filters", "FAIL", f"API query filters failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_api_aggregates(self):
+        """Test API aggregates endpoint."""
+        try:
+            self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true&bulk=true")
+            response = self.client.get(f"/aggregates?db={self.db_path}&by=unit_type")
+            self.assertEqual(response.status_code, 200, f"API aggregates failed: {response.text}")
+            self.assertEqual(response.json(), [{"level_id": 1, "unit_type": "unit", "units": 1, "fixed_total": 50.0, "items": 1}])
+            response = self.client.get(f"/aggregates?db={self.db_path}&by=invalid")
+            self.assertEqual(response.status_code, 400, "Expected 400 status for invalid breakdown")
+            self.log_result("test_api_aggregates", "PASS", "API aggregates endpoint executed successfully")
+        except Exception as e:
+            self.log_result("test_api_aggregates", "FAIL", f"API aggregates failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_api_project(self):
+        """Test API cost projection endpoint."""
+        try:
+            self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true")
+            response = self.client.get(f"/project?db={self.db_path}&months=12&scenarios=50&inflation=0&inflation_std=0"
+                                       f"&volatility=0&shock=test:1.0")
+            self.assertEqual(response.status_code, 200, f"API projection failed: {response.text}")
+            level = response.json()["levels"][0]
+            self.assertEqual(level["level"], 1)
+            self.assertEqual(len(level["cumulative"]["p50"]), 12)
+            self.assertEqual(level["final_total"], {"mean": 1300.0, "p5": 1300.0, "p50": 1300.0, "p95": 1300.0})
+            response = self.client.get(f"/project?db={self.db_path}&months=12&scenarios=200&seed=7")
+            self.assertEqual(response.json(), self.client.get(f"/project?db={self.db_path}&months=12&scenarios=200&seed=7").json())
+            p5, p95 = response.json()["levels"][0]["final_total"]["p5"], response.json()["levels"][0]["final_total"]["p95"]
+            self.assertLess(p5, p95)
+            response = self.client.get(f"/project?db={self.db_path}&shock=propane")
+            self.assertEqual(response.status_code, 400, "Expected 400 status for malformed shock")
+            handle = AsyncOffGridDB.registry.get(self.db_path)
+            self.assertIn("projection", handle.derived, "Cost arrays should be cached on the warm handle")
+            handle.close()
+            self.assertEqual(handle.derived, {}, "Closing (evicting) the handle should drop its cost arrays")
+            self.log_result("test_api_project", "PASS", "API projection endpoint executed successfully")
+        except Exception as e:
+            self.log_result("test_api_project", "FAIL", f"API projection failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_api_search(self):
+        """Test API search endpoint."""
+        try:
+            self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true")
+            response = self.client.get(f"/search?db={self.db_path}&q=test sel&level=1&min_price=10")
+            self.assertEqual(response.status_code, 200, f"API search failed: {response.text}")
+            self.assertEqual([(hit["kind"], hit["name"]) for hit in response.json()], [("fixed", "Test Item")])
+            response = self.client.get(f"/search?db={self.db_path}&q=test&max_price=10")
+            self.assertEqual(response.json(), [])
+            response = self.client.get(f"/search?db={self.db_path}&q=*")
+            self.assertEqual(response.status_code, 400, "Expected 400 status for empty search")
+            self.log_result("test_api_search", "PASS", "API search endpoint executed successfully")
+        except Exception as e:
+            self.log_result("test_api_search", "FAIL", f"API search failed: {str(e)}")
+            self.fail(str(e))
+
+    def test_api_metrics(self):
+        """Test Prometheus metrics endpoint."""
+        try:
+            self.client.post(f"/load?json_path={self.json_path}&db={self.db_path}&drop=true")
+            self.client.get(f"/query/fixed?db={self.db_path}&level=1")
+            response = self.client.get("/metrics")
+            self.assertEqual(response.status_code, 200, f"API metrics failed: {response.text}")
+            self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+            self.assertIn('offgrid_http_request_seconds_count{method="GET",endpoint="/query/{query_type}",status="200"}', response.text)
+            self.assertIn('offgrid_db_query_seconds_bucket{statement="SELECT * FROM fixed_costs WHERE level_id = ?",le="+Inf"}', response.text)
+            self.assertIn('offgrid_db_load_rows_total{mode="insert"}', response.text)
+            self.log_result("test_api_metrics", "PASS", "API metrics endpoint executed successfully")
+        except Exception as e:
+            self.log_result("test_api_metrics", "FAIL", f"API metrics failed: {str(e)}")
+            self.fail(str(e))
+
     def test_api_invalid_query_type(self):
         """Test API query with invalid query type."""
         try:
@@ -1,98 +1,584 @@
-from fastapi import FastAPI, HTTPException
-from OffGridDB import OffGridDB
-from typing import Optional
-from datetime import datetime
+from fastapi import FastAPI, HTTPException, Depends, Request, Query
+from fastapi.responses import StreamingResponse, Response, PlainTextResponse, JSONResponse
+from OffGridDB import OffGridDB, ConnectionPool, MemoryReplica, AsyncOffGridDB, QueueFullError, catalog_paths, QUERY_TABLES, AGGREGATE_SQL, SEARCH_KINDS, SEARCH_DEFAULT_LIMIT, DEFAULT_MAX_OPEN_DBS
+from CatalogSchema import SchemaValidationError
+from CostProjection import CostProjection
+from OffGridJobs import JobQueue, JOBS_DB
+from OffGridMetrics import metrics
+from typing import Optional, Dict, Any, Tuple, List, Iterator
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+import asyncio
+import glob
+import hashlib
+import json
 import os
+import threading
+import time
 
-app = FastAPI(title="OffGridDB API", description="API for managing off-grid cost data")
+LOG_FILE = "offgrid.log"
+OffGridDB.configure_logging(LOG_FILE)
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+READ_REPLICA = os.environ.get("OFFGRID_READ_REPLICA", "") == "1"  # Serve reads from an in-memory copy
+OffGridDB.slow_query_seconds = float(os.environ.get("OFFGRID_SLOW_QUERY_MS", OffGridDB.slow_query_seconds * 1000)) / 1000
+OffGridDB.trace_statements = os.environ.get("OFFGRID_TRACE_STATEMENTS", "") == "1"
+JOBS_DB_PATH = os.environ.get("OFFGRID_JOBS_DB", JOBS_DB)  # Background job table for /load and /report
+AsyncOffGridDB.registry.max_open = int(os.environ.get("OFFGRID_MAX_OPEN_DBS", DEFAULT_MAX_OPEN_DBS))  # Warm database handles
+SITES = os.environ.get("OFFGRID_SITES", "")  # Databases behind sites=all, as globs / paths separated by os.pathsep
+PREWARM = os.environ.get("OFFGRID_PREWARM", "")  # Databases opened at startup, same format as OFFGRID_SITES
+
+REQUEST_SECONDS = metrics.histogram("offgrid_http_request_seconds", "Time to produce the response headers, per endpoint.",
+                                    ["method", "endpoint", "status"])
+CACHE_ENTRIES = metrics.gauge("offgrid_result_cache_entries", "Responses held in the result cache.")
+CACHE_BYTES = metrics.gauge("offgrid_result_cache_bytes", "Body bytes held in the result cache.")
+
+class ResultCache:
+    """LRU cache of serialized responses, bounded by total body size.
+
+    Entries are stored with the OffGridDB.change_token they were computed at;
+    a lookup with a different token is a miss and evicts the stale entry.
+    """
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Tuple, Dict[str, Any]]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Tuple, token: Tuple) -> Optional[Dict[str, Any]]:
+        """Return the fresh entry for `key`, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry["token"] != token:
+                self._evict(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Tuple, token: Tuple, body: bytes, media_type: str,
+            headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """Store a response body and return its entry (with ETag and Last-Modified)."""
+        entry = {
+            "token": token,
+            "body": body,
+            "media_type": media_type,
+            "headers": headers or {},
+            "etag": '"' + hashlib.sha1(repr((key, token)).encode()).hexdigest()[:20] + '"',
+            "last_modified": formatdate(max(token[1::2]) / 1e9 if any(token[1::2]) else None, usegmt=True),
+        }
+        with self.lock:
+            if key in self.entries:
+                self._evict(key)
+            if len(body) <= self.max_bytes:
+                self.entries[key] = entry
+                self.size += len(body)
+                while self.size > self.max_bytes:
+                    self._evict(next(iter(self.entries)))
+        return entry
+
+    def _evict(self, key: Tuple):
+        entry = self.entries.pop(key)
+        self.size -= len(entry["body"])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+result_cache = ResultCache()
+
+def not_modified(request: Request, entry: Dict[str, Any]) -> bool:
+    """Evaluate If-None-Match / If-Modified-Since against a cache entry."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return entry["etag"] in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(entry["last_modified"]) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def cached_response(request: Request, entry: Dict[str, Any]) -> Response:
+    """Build a 200 or 304 response for a cache entry."""
+    headers = dict(entry["headers"], **{"ETag": entry["etag"], "Last-Modified": entry["last_modified"], "Cache-Control": "no-cache"})
+    if not_modified(request, entry):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], media_type=entry["media_type"], headers=headers)
+
+def write_text(path: str, text: str):
+    with open(path, "w") as f:
+        f.write(text)
+
+def run_load_job(job: Dict[str, Any], progress) -> Dict[str, Any]:
+    """Background /load: run the load on the database's writer thread, reporting progress."""
+    params = job["params"]
+
+    def load(db: OffGridDB) -> Dict[str, Any]:
+        db.progress_callback = progress
+        if params["many"]:
+            return db.load_many(params["json_path"], drop_if_exists=params["drop"], workers=params["workers"],
+                                effective_at=params.get("effective_at"))
+        return db.load_json(params["json_path"], drop_if_exists=params["drop"], bulk=params["bulk"],
+                            stream=params["stream"], delta=params["delta"], effective_at=params.get("effective_at"))
+
+    with AsyncOffGridDB.registry.lease(job["db_path"], replica=READ_REPLICA) as handle:
+        stats = handle.run_blocking(True, load)
+    return {"message": f"Successfully loaded {params['json_path']} into {job['db_path']}", "stats": stats,
+            "location": job["db_path"], "rows": stats.get("rows")}
+
+def run_report_job(job: Dict[str, Any], progress) -> Dict[str, Any]:
+    """Background /report: render the report on a reader thread straight into the output file."""
+    params = job["params"]
+
+    def report(db: OffGridDB) -> int:
+        db.progress_callback = progress
+        return len(db.report(params["level"], params["output"], params.get("as_of")))
+
+    with AsyncOffGridDB.registry.lease(job["db_path"], replica=READ_REPLICA) as handle:
+        size = handle.run_blocking(False, report)
+    return {"message": f"Report generated at {params['output']}", "location": params["output"], "characters": size}
+
+_jobs: Optional[JobQueue] = None
+_jobs_lock = threading.Lock()
+
+def get_jobs() -> JobQueue:
+    """Return the background job queue, opening JOBS_DB_PATH on first use."""
+    global _jobs
+    with _jobs_lock:
+        if _jobs is None:
+            _jobs = JobQueue(JOBS_DB_PATH, {"load": run_load_job, "report": run_report_job})
+        return _jobs
+
+def close_jobs():
+    """Stop the job workers after their current job; queued jobs resume on the next start."""
+    global _jobs
+    with _jobs_lock:
+        jobs, _jobs = _jobs, None
+    if jobs is not None:
+        jobs.close()
+
+def job_accepted(job: Dict[str, Any], created: bool) -> JSONResponse:
+    """202 response pointing at /jobs/{id}; `deduplicated` marks an already active identical job."""
+    location = f"/jobs/{job['id']}"
+    return JSONResponse(status_code=202, headers={"Location": location},
+                        content={"job_id": job["id"], "status": job["status"], "deduplicated": not created, "location": location})
+
+def site_paths(spec: str) -> List[str]:
+    """Expand globs / paths separated by os.pathsep (or commas) into sorted, distinct database paths."""
+    paths = set()
+    for part in spec.replace(",", os.pathsep).split(os.pathsep):
+        part = part.strip()
+        if part:
+            paths.update(glob.glob(part) if glob.has_magic(part) else [part])
+    return sorted(paths)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Pre-warm OFFGRID_PREWARM and resume queued background jobs on start; close jobs, pooled SQLite connections and replicas when the server stops."""
+    if PREWARM:
+        await asyncio.to_thread(AsyncOffGridDB.registry.prewarm, site_paths(PREWARM), replica=READ_REPLICA)
+    get_jobs().start()
+    yield
+    close_jobs()
+    AsyncOffGridDB.close_all()
+    MemoryReplica.close_all()
+    ConnectionPool.close_all()
+
+app = FastAPI(title="OffGridDB API", description="API for managing off-grid cost data", lifespan=lifespan)
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    """Observe per-endpoint latency, labelled by route template (e.g. /query/{query_type})."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, endpoint, str(status))
+
+def get_db(db: str = "offgrid.db") -> Iterator[AsyncOffGridDB]:
+    """
+    FastAPI dependency leasing the async OffGridDB facade for a database.
+    Work runs on its reader/writer threads against pooled connections; with
+    OFFGRID_READ_REPLICA=1 reads use the in-memory replica. Facades are kept
+    warm in an LRU of OFFGRID_MAX_OPEN_DBS handles; a lease keeps an evicted
+    one open until the request is done.
+    - db: Path to the SQLite database (default: offgrid.db).
+    """
+    with AsyncOffGridDB.registry.lease(db, replica=READ_REPLICA) as handle:
+        yield handle
+
+def busy(e: QueueFullError) -> HTTPException:
+    """Map a full work queue to 503 so clients back off and retry."""
+    return HTTPException(status_code=503, detail=f"Server busy: {str(e)}", headers={"Retry-After": "1"})
+
+def parse_time(value: Optional[str], name: str, end_of_day: bool = False) -> Optional[int]:
+    """Parse an ISO date/datetime parameter into Unix seconds, answering 400 when it is invalid."""
+    if value is None:
+        return None
+    try:
+        return OffGridDB.parse_timestamp(value, end_of_day)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"{name}: {str(e)}")
 
 @app.post("/load")
-async def load_json(json_path: str, db: str = "offgrid.db", drop: bool = False):
+async def load_json(json_path: str, drop: bool = False, bulk: bool = False, stream: bool = False,
+                    delta: bool = False, workers: Optional[int] = Query(None, ge=1), background: bool = False,
+                    effective_at: Optional[str] = None, db_instance: AsyncOffGridDB = Depends(get_db)):
     """
     Load JSON data into the database.
-    - json_path: Path to the JSON file.
+    - json_path: Path to the JSON file (checked against the schema file; violations return 422 listing every error), or a directory / glob pattern (e.g. catalogs/*.json) of catalogs
+      parsed in parallel and written in one transaction; the response lists per-file results.
     - db: Path to the SQLite database (default: offgrid.db).
     - drop: Drop existing tables before loading (default: False).
+    - bulk: Batched single-transaction load for large catalogs (default: False).
+    - stream: Parse the file incrementally in constant memory; .ndjson/.jsonl files hold one level per line (default: False).
+    - delta: Upsert/delete only rows whose content hash changed; reports inserted/updated/deleted/unchanged (default: False).
+    - workers: Parser processes for directory/glob loads (default: CPU count).
+    - background: Queue the load as a job and return 202 with its id at once; poll /jobs/{id} (default: False).
+    - effective_at: ISO date/datetime (UTC unless an offset is given) the price changes are recorded at in the
+      price history; may not precede the latest recorded change (default: now).
     """
+    effective_time = parse_time(effective_at, "effective_at")
     try:
-        if not os.path.exists(json_path):
+        many = os.path.isdir(json_path) or glob.has_magic(json_path)
+        if not many and not os.path.exists(json_path):
             raise HTTPException(status_code=400, detail="JSON file not found")
-        
-        db_instance = OffGridDB(db, log_file="offgrid.log")
-        with db_instance:
-            db_instance.load_json(json_path, drop_if_exists=drop)
-        return {"message": f"Successfully loaded {json_path} into {db}"}
+        if delta and drop:
+            raise HTTPException(status_code=400, detail="delta cannot be combined with drop")
+        if many:
+            if delta:
+                raise HTTPException(status_code=400, detail="delta cannot be combined with a directory or glob")
+            if not catalog_paths(json_path):
+                raise HTTPException(status_code=400, detail="No JSON files match json_path")
+        if background:
+            params = {"json_path": os.path.abspath(json_path), "many": many, "drop": drop, "bulk": bulk,
+                      "stream": stream, "delta": delta, "workers": workers, "effective_at": effective_time}
+            return job_accepted(*await asyncio.to_thread(get_jobs().submit, "load", db_instance.db_path, params))
+        if many:
+            stats = await db_instance.load_many(json_path, drop_if_exists=drop, workers=workers, effective_at=effective_time)
+        else:
+            stats = await db_instance.load_json(json_path, drop_if_exists=drop, bulk=bulk, stream=stream, delta=delta,
+                                                effective_at=effective_time)
+        return {"message": f"Successfully loaded {json_path} into {db_instance.db_path}", "stats": stats}
+    except HTTPException:
+        raise
+    except QueueFullError as e:
+        raise busy(e)
+    except SchemaValidationError as e:
+        raise HTTPException(status_code=422, detail={
+            "message": str(e), "total": e.total,
+            "errors": [{"path": path, "message": message} for path, message in e.errors]})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 @app.get("/query/{query_type}")
-async def query_data(query_type: str, level: Optional[int] = None, db: str = "offgrid.db"):
+async def query_data(request: Request, query_type: str, level: Optional[int] = None,
+                     after: Optional[int] = None, limit: Optional[int] = Query(None, ge=1),
+                     stream: bool = False, name: Optional[str] = None, seller: Optional[str] = None,
+                     unit_type: Optional[str] = None, min_amount: Optional[float] = None,
+                     max_amount: Optional[float] = None, min_total: Optional[float] = None,
+                     max_total: Optional[float] = None, sort: Optional[str] = None, fields: Optional[str] = None,
+                     sites: Optional[str] = None, as_of: Optional[str] = None,
+                     db_instance: AsyncOffGridDB = Depends(get_db)):
     """
     Query the database.
     - query_type: Type of data to query (levels, monthly, fixed).
     - level: Filter by level ID (optional).
+    - name: Filter by exact item name (monthly, fixed) (optional).
+    - seller, unit_type: Filter fixed costs by seller_source / unit_type (optional).
+    - min_amount, max_amount: Monthly amount range (optional).
+    - min_total, max_total: Fixed cost total range (optional).
+    - sort: Column to sort by, '-' prefix for descending, e.g. -total (optional).
+    - fields: Comma-separated columns to return, e.g. name,total (optional).
+    - after: Return rows whose primary key is greater than this cursor (optional).
+    - limit: Page size; a full page sets X-Next-After to the cursor of the next page (optional).
+    - stream: Stream rows as NDJSON (also selected by Accept: application/x-ndjson) (default: False).
+    - sites: Query these databases in parallel instead of db: 'all' (OFFGRID_SITES) or globs / paths separated
+      by commas. Returns {"rows", "sites", "errors"}; each row carries its "site", rows are merged by sort and cut to limit (optional).
+    - as_of: ISO date/datetime; return the rows as recorded in the price history at that time (a bare date
+      includes the whole day). Cost item ids are then stable history ids (optional).
     - db: Path to the SQLite database (default: offgrid.db).
     """
-    valid_query_types = ["levels", "monthly", "fixed"]
+    valid_query_types = list(QUERY_TABLES)
     if query_type not in valid_query_types:
         raise HTTPException(status_code=400, detail=f"Invalid query_type. Must be one of {valid_query_types}")
 
+    filters = {"name": name, "seller": seller, "unit_type": unit_type, "min_amount": min_amount,
+               "max_amount": max_amount, "min_total": min_total, "max_total": max_total}
+    field_list = [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+    if sites is not None and sort and field_list and sort.lstrip("-") not in field_list:
+        field_list.append(sort.lstrip("-"))  # Needed to merge the sites' rows
     try:
-        db_instance = OffGridDB(db, log_file="offgrid.log")
-        with db_instance:
-            if query_type == "levels":
-                query = "SELECT * FROM levels" + (f" WHERE level = {level}" if level else "")
-            elif query_type == "monthly":
-                query = "SELECT * FROM monthly_costs" + (f" WHERE level_id = {level}" if level else "")
-            elif query_type == "fixed":
-                query = "SELECT * FROM fixed_costs" + (f" WHERE level_id = {level}" if level else "")
-            
-            results = db_instance.query(query)
-            return [dict(row) for row in results]  # Convert rows to dictionaries for JSON response
+        query, params = OffGridDB.build_query(query_type, level, after, limit, filters, sort, field_list,
+                                              parse_time(as_of, "as_of", end_of_day=True))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if sites is not None:
+        return await query_sites(sites, query, params, sort, limit, after is not None or stream)
+    if stream or "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(db_instance.stream_query(query, params), media_type="application/x-ndjson")
+    try:
+        key = (os.path.abspath(db_instance.db_path), "query", query, params)
+        token = OffGridDB.change_token(db_instance.db_path)
+        entry = result_cache.get(key, token)
+        if entry is None:
+            results = await db_instance.query(query, params)
+            body = json.dumps([dict(row) for row in results]).encode()  # Convert rows to dictionaries for JSON response
+            headers = {}
+            if limit is not None and len(results) == limit and sort in (None, QUERY_TABLES[query_type][2]):
+                headers["X-Next-After"] = str(results[-1][QUERY_TABLES[query_type][2]])
+            entry = result_cache.put(key, token, body, "application/json", headers)
+        return cached_response(request, entry)
+    except QueueFullError as e:
+        raise busy(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Query failed: {str(e)}")
 
+async def query_sites(sites: str, query: str, params: Tuple, sort: Optional[str], limit: Optional[int],
+                      unsupported: bool) -> Dict[str, Any]:
+    """Fan a /query statement out to several databases and merge the rows."""
+    if unsupported:
+        raise HTTPException(status_code=400, detail="after and stream are not supported with sites")
+    paths = site_paths(SITES if sites == "all" else sites)
+    if not paths:
+        raise HTTPException(status_code=400, detail="No databases match sites")
+    results = await AsyncOffGridDB.registry.fan_out(paths, OffGridDB.query, query, params)
+    rows = [dict(row, site=path) for path, result, error in results if error is None for row in result]
+    if sort:
+        column = sort.lstrip("-")
+        rows.sort(key=lambda row: (row[column] is not None, row[column]), reverse=sort.startswith("-"))  # NULLs sort lowest, as in SQLite
+    if limit is not None:
+        rows = rows[:limit]
+    return {"rows": rows, "sites": len(paths), "errors": {path: error for path, _, error in results if error is not None}}
+
+@app.get("/sites")
+async def list_sites():
+    """
+    List the databases behind sites=all (OFFGRID_SITES) and the warm handles, least recently used first.
+    """
+    registry = AsyncOffGridDB.registry
+    return {"sites": site_paths(SITES), "open": registry.open_paths(), "max_open": registry.max_open}
+
+@app.get("/aggregates")
+async def aggregates(request: Request, by: str = "level", level: Optional[int] = None, db_instance: AsyncOffGridDB = Depends(get_db)):
+    """
+    Read trigger-maintained cost rollups.
+    - by: Breakdown to return (level, unit_type, seller_source) (default: level).
+    - level: Filter by level ID (optional).
+    - db: Path to the SQLite database (default: offgrid.db).
+    """
+    valid_breakdowns = list(AGGREGATE_SQL)
+    if by not in valid_breakdowns:
+        raise HTTPException(status_code=400, detail=f"Invalid breakdown. Must be one of {valid_breakdowns}")
+
+    try:
+        key = (os.path.abspath(db_instance.db_path), "aggregates", by, level)
+        token = OffGridDB.change_token(db_instance.db_path)
+        entry = result_cache.get(key, token)
+        if entry is None:
+            results = await db_instance.aggregates(by, level)
+            entry = result_cache.put(key, token, json.dumps([dict(row) for row in results]).encode(), "application/json")
+        return cached_response(request, entry)
+    except QueueFullError as e:
+        raise busy(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Aggregate query failed: {str(e)}")
+
+@app.get("/search")
+async def search(request: Request, q: str, level: Optional[int] = None, min_price: Optional[float] = None,
+                 max_price: Optional[float] = None, kind: Optional[str] = None,
+                 limit: int = Query(SEARCH_DEFAULT_LIMIT, ge=1, le=1000), db_instance: AsyncOffGridDB = Depends(get_db)):
+    """
+    Full-text search over cost item names and sellers, ranked by relevance (BM25).
+    - q: Search words; each matches as a prefix (e.g. "lifep reno").
+    - level: Filter by level ID (optional).
+    - min_price, max_price: Filter by amount (monthly) or total (fixed) (optional).
+    - kind: Restrict to monthly or fixed costs (optional).
+    - limit: Maximum number of hits (default: 50).
+    - db: Path to the SQLite database (default: offgrid.db).
+    """
+    if kind is not None and kind not in SEARCH_KINDS:
+        raise HTTPException(status_code=400, detail=f"Invalid kind. Must be one of {list(SEARCH_KINDS)}")
+
+    try:
+        OffGridDB.build_search(q)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        key = (os.path.abspath(db_instance.db_path), "search", q, level, min_price, max_price, kind, limit)
+        token = OffGridDB.change_token(db_instance.db_path)
+        entry = result_cache.get(key, token)
+        if entry is None:
+            results = await db_instance.search(q, level, min_price, max_price, kind, limit)
+            entry = result_cache.put(key, token, json.dumps([dict(row) for row in results]).encode(), "application/json")
+        return cached_response(request, entry)
+    except QueueFullError as e:
+        raise busy(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+
 @app.get("/report")
-async def generate_report(level: Optional[int] = None, db: str = "offgrid.db", output: str = "report.md"):
+async def generate_report(request: Request, level: Optional[int] = None, output: str = "report.md", stream: bool = False,
+                          background: bool = False, as_of: Optional[str] = None,
+                          db_instance: AsyncOffGridDB = Depends(get_db)):
     """
     Generate a cost report.
     - level: Generate report for a specific level (optional).
     - db: Path to the SQLite database (default: offgrid.db).
     - output: Output file for the report (default: report.md).
+    - stream: Stream the Markdown as it is rendered instead of returning JSON (default: False).
+    - background: Queue the report as a job writing `output` and return 202 with its id at once; poll /jobs/{id} (default: False).
+    - as_of: ISO date/datetime; report the prices recorded in the price history at that time (a bare date
+      includes the whole day) (optional).
     """
+    as_of_time = parse_time(as_of, "as_of", end_of_day=True)
+    if background:
+        params = {"level": level, "output": os.path.abspath(output), "as_of": as_of_time}
+        return job_accepted(*await asyncio.to_thread(get_jobs().submit, "report", db_instance.db_path, params))
+    if stream:
+        return StreamingResponse(db_instance.stream_report(level, output, as_of_time), media_type="text/markdown")
     try:
-        db_instance = OffGridDB(db, log_file="offgrid.log")
-        with db_instance:
-            query = """
-                SELECT l.level, l.name, l.description, l.total_monthly, l.total_fixed,
-                       GROUP_CONCAT(m.name || ': ' || m.amount) as monthly_costs,
-                       GROUP_CONCAT(f.name || ': ' || f.total) as fixed_costs
-                FROM levels l
-                LEFT JOIN monthly_costs m ON l.level = m.level_id
-                LEFT JOIN fixed_costs f ON l.level = f.level_id
-            """
-            if level:
-                query += f" WHERE l.level = {level}"
-            query += " GROUP BY l.level"
-            
-            results = db_instance.query(query)
-            
-            report = f"# OffGridDB Cost Report\n\nGenerated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-            for row in results:
-                report += f"## Level {row['level']}: {row['name']}\n"
-                report += f"- **Description**: {row['description']}\n"
-                report += f"- **Total Monthly Cost**: ${row['total_monthly']}\n"
-                report += f"- **Total Fixed Cost**: ${row['total_fixed']}\n"
-                report += f"- **Monthly Costs**: {row['monthly_costs'] or 'None'}\n"
-                report += f"- **Fixed Costs**: {row['fixed_costs'] or 'None'}\n\n"
-            
-            with open(output, "w") as f:
-                f.write(report)
-            
-            return {"message": f"Report generated at {output}", "report": report}
+        # Only the body is cached: the header is stamped fresh, so output never claims an older generation time
+        key = (os.path.abspath(db_instance.db_path), "report", level, as_of_time)
+        token = OffGridDB.change_token(db_instance.db_path)
+        entry = result_cache.get(key, token)
+        if entry is None:
+            markdown = await db_instance.report(level, None, as_of_time, header=False)
+            entry = result_cache.put(key, token, markdown.encode(), "text/markdown")
+        report = OffGridDB.report_header(as_of_time) + entry["body"].decode()
+        await asyncio.to_thread(write_text, output, report)
+        body = json.dumps({"message": f"Report generated at {output}", "report": report}).encode()
+        return cached_response(request, dict(entry, body=body, media_type="application/json"))
+    except QueueFullError as e:
+        raise busy(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Report generation failed: {str(e)}")
 
+async def load_projection(db_instance: AsyncOffGridDB) -> CostProjection:
+    """Return the cost arrays for a database, reloading them only after it changed.
+
+    They are kept on the registry handle, so they are dropped with it when the
+    database is evicted from the warm LRU.
+    """
+    token = OffGridDB.change_token(db_instance.db_path)
+    cached = db_instance.derived.get("projection")
+    if cached is None or cached[0] != token:
+        cached = (token, await db_instance.run_read(CostProjection.from_db))
+        db_instance.derived["projection"] = cached
+    return cached[1]
+
+@app.get("/project")
+async def project_costs(months: int = Query(36, ge=1, le=600), scenarios: int = Query(1000, ge=1, le=100000),
+                        inflation: float = 0.03, inflation_std: float = Query(0.01, ge=0), volatility: float = Query(0.1, ge=0),
+                        shock: List[str] = Query([]), level: List[int] = Query([]), seed: Optional[int] = None,
+                        db_instance: AsyncOffGridDB = Depends(get_db)):
+    """
+    Project cumulative cost per level with a Monte Carlo scenario engine.
+    - months: Projection horizon in months (default: 36).
+    - scenarios: Number of simulated scenarios (default: 1000).
+    - inflation, inflation_std: Mean and spread of annual inflation (default: 0.03, 0.01).
+    - volatility: Lognormal spread of per-item price levels (default: 0.1).
+    - shock: Price shocks as name:change, e.g. propane:0.2 (repeatable, optional).
+    - level: Restrict to these levels (repeatable, optional).
+    - seed: Random seed for reproducible results (optional).
+    - db: Path to the SQLite database (default: offgrid.db).
+    """
+    shocks = {}
+    for item in shock:
+        name, _, change = item.rpartition(":")
+        try:
+            shocks[name] = float(change)
+        except ValueError:
+            name = ""
+        if not name:
+            raise HTTPException(status_code=400, detail=f"Invalid shock '{item}'. Expected name:change")
+
+    try:
+        projection = await load_projection(db_instance)
+        return await asyncio.to_thread(projection.simulate, months=months, scenarios=scenarios, inflation=inflation,
+                                       inflation_std=inflation_std, volatility=volatility, shocks=shocks,
+                                       levels=level or None, seed=seed)
+    except QueueFullError as e:
+        raise busy(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Projection failed: {str(e)}")
+
+@app.get("/prices/trend")
+async def price_trend(request: Request, name: Optional[str] = None, seller: Optional[str] = None,
+                      level: Optional[int] = None, kind: Optional[str] = None, since: Optional[str] = None,
+                      until: Optional[str] = None, db_instance: AsyncOffGridDB = Depends(get_db)):
+    """
+    Price history of the items with a name and/or from a seller, one series per item.
+    - name: Exact item name (name or seller is required).
+    - seller: Seller source of fixed cost items.
+    - level: Filter by level ID (optional).
+    - kind: Restrict to monthly or fixed costs (optional).
+    - since, until: ISO dates/datetimes bounding the changes returned (a bare until date includes the whole day) (optional).
+    - db: Path to the SQLite database (default: offgrid.db).
+    Returns {"items": [{item_id, kind, level_id, name, points: [{effective_at, price, unit_cost, units,
+    seller_source, removed}]}]}, with effective_at as ISO datetimes in UTC.
+    """
+    if not name and not seller:
+        raise HTTPException(status_code=400, detail="name or seller is required")
+    if kind is not None and kind not in SEARCH_KINDS:
+        raise HTTPException(status_code=400, detail=f"Invalid kind. Must be one of {list(SEARCH_KINDS)}")
+    since_time, until_time = parse_time(since, "since"), parse_time(until, "until", end_of_day=True)
+    try:
+        key = (os.path.abspath(db_instance.db_path), "trend", name, seller, level, kind, since_time, until_time)
+        token = OffGridDB.change_token(db_instance.db_path)
+        entry = result_cache.get(key, token)
+        if entry is None:
+            rows = await db_instance.price_trend(name, seller, level, kind, since_time, until_time)
+            items: List[Dict[str, Any]] = []
+            for row in rows:
+                if not items or items[-1]["item_id"] != row["item_id"]:
+                    items.append({"item_id": row["item_id"], "kind": row["kind"], "level_id": row["level_id"],
+                                  "name": row["name"], "points": []})
+                items[-1]["points"].append({
+                    "effective_at": OffGridDB.format_timestamp(row["effective_at"]), "price": row["price"],
+                    "unit_cost": row["unit_cost"], "units": row["units"], "seller_source": row["seller_source"],
+                    "removed": bool(row["removed"])})
+            entry = result_cache.put(key, token, json.dumps({"items": items}).encode(), "application/json")
+        return cached_response(request, entry)
+    except QueueFullError as e:
+        raise busy(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Price trend failed: {str(e)}")
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Report a background /load or /report job.
+    - job_id: Id returned by /load?background=true or /report?background=true.
+    Returns status (queued, running, succeeded, failed), phase, rows_done/rows_total,
+    progress (0-1), eta_seconds, and the result (with its location) or error.
+    """
+    job = await asyncio.to_thread(get_jobs().get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Prometheus text exposition of request latency, query timings, slow queries, loads and cache usage.
+    """
+    CACHE_ENTRIES.set(len(result_cache.entries))
+    CACHE_BYTES.set(result_cache.size)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file